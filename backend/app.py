@@ -1,144 +1,117 @@
 # Dotenv
 from dotenv import dotenv_values
 # FastAPI
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, Response, Query
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 # Influx DB
-from influxdb_client import InfluxDBClient, Point 
-from influxdb_client.client.write_api import SYNCHRONOUS
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import WriteOptions, SYNCHRONOUS
+from influxdb_client.rest import ApiException
 # Schedule
-from apscheduler.schedulers.background import BackgroundScheduler
-import requests
-# etree for fast xml parsing
-from lxml import etree as etree_lxml
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 import os
+import asyncio
 import json
 import sys
-from datetime import datetime
+import time
 from request_models import *
 from defaults import *
+import datex2
+import mst_snapshot
+import line_protocol
+import storage_schema
+from response_cache import ResponseCache
+from query_executor import QueryExecutor
+from station_index import StationIndex, ALL_CANTONS
+from spatial_index import SpatialIndex
+from hot_window import HotWindow, parse_flux_duration, parse_relative_start, to_datetime
+import rollups
+import columnar
+import downsampling
+import metrics
+from query_log import QueryLog
+from push import PushHub
+from ingest_client import MsrClient, DATEX2_PULL_URL
+from ingest_pipeline import IngestPipeline, COALESCE
+from write_spool import WriteSpool, SpoolDrainer
+from ingest_leader import IngestLeaderLock, SharedIngestState, LEADER
 
 def ensure_file(file_path):
     if not os.path.isfile(file_path):
         sys.exit(f"Expected file '{file_path}' but was not found...")
 
-def read_mst_from_file():
-    ensure_file(MST_FILE_PATH)
-    with open(MST_FILE_PATH, "r") as f:
-        mst = json.load(f)
-    return mst
-
-def detector_id_to_station_id(detector_id):
-    # Dectector Id: CH:0002.01
-    # Station Id: CH:0002
-    return detector_id.split(".")[0]
-
-def parse_msr(xml_content):
-    tree = etree_lxml.fromstring(xml_content)
-    ns = {
-        "dx223": "http://datex2.eu/schema/2/2_0",
-        "xsi": "http://www.w3.org/2001/XMLSchema-instance"
-    }
-
-    site_measurement_nodes = tree.xpath(
-        './/dx223:siteMeasurements',
-        namespaces=ns)
-
-    result = dict()
-    detector_measurements = []
-    for node in site_measurement_nodes:
-        current_detector_measurement = {}
-        current_sensor_measurements = []
-
-        id_node = node.xpath(
-            './/dx223:measurementSiteReference[@id]', namespaces=ns)[0]
-
-        time_node = node.xpath(
-            './/dx223:measurementTimeDefault', namespaces=ns)[0]
-
-        measured_value_nodes = node.xpath(
-            './/dx223:measuredValue[@index]', namespaces=ns)
-
-        for measured_value_node in measured_value_nodes:
-            index = int(measured_value_node.attrib["index"])
-            current_sensor_measurement = {}
-            measurement_kind = measured_value_node.xpath(
-                './/dx223:basicData/@xsi:type', namespaces=ns)[0]
-
-            has_data_error_nodes = measured_value_node.xpath(
-                './/dx223:basicData//dx223:dataError', namespaces=ns)
-
-            measured_value = 0
-            error_reason = None
-            kind = None
-            has_data_error = len(has_data_error_nodes) > 0
-            if has_data_error:
-                error_reason_node = measured_value_node.xpath(
-                    './/dx223:basicData//dx223:reasonForDataError//dx223:value', namespaces=ns)[0]
-                error_reason = error_reason_node.text
-            else:
-                if measurement_kind == "dx223:TrafficFlow":
-                    kind = "trafficFlow"
-                    value_node = measured_value_node.xpath(
-                        './/dx223:basicData//dx223:vehicleFlowRate', namespaces=ns)[0]
-                    measured_value = float(value_node.text)
-                elif measurement_kind == "dx223:TrafficSpeed":
-                    kind = "trafficSpeed"
-                    number_of_input_values_node = measured_value_node.xpath(
-                        './/dx223:basicData//dx223:averageVehicleSpeed[@numberOfInputValuesUsed]', namespaces=ns)[0]
-
-                    number_of_input_values_used = number_of_input_values_node.attrib[
-                        "numberOfInputValuesUsed"]
-                    value_node = measured_value_node.xpath(
-                        './/dx223:basicData//dx223:speed', namespaces=ns)[0]
-                    measured_value = float(value_node.text)
-                    current_sensor_measurement["numberOfInputValuesUsed"] = int(
-                        number_of_input_values_used)
-
-            current_sensor_measurement["value"] = measured_value
-            current_sensor_measurement["hasError"] = has_data_error
-            current_sensor_measurement["errorReason"] = error_reason
-            current_sensor_measurement["index"] = index
-            current_sensor_measurement["kind"] = kind
-
-            current_sensor_measurements.append(current_sensor_measurement)
-
-        detector_id = id_node.attrib["id"]
-        current_detector_measurement["id"] = detector_id
-        current_detector_measurement["time"] = time_node.text
-        current_detector_measurement["sensorMeasurements"] = current_sensor_measurements
-        current_detector_measurement["canton"] = DETECTOR_ID_TO_CANTON_MAPPING.get(detector_id, None)
-        current_detector_measurement["stationId"] = detector_id_to_station_id(detector_id)
-
-        detector_measurements.append(current_detector_measurement)
-
-    result["detector_measurements"] = detector_measurements
-    return result
+def load_compiled_mst():
+    # The snapshot written by preprocessing.py is much faster to load, the JSON is only used without one
+    start = time.perf_counter()
+    if not os.path.isfile(MST_SNAPSHOT_FILE_PATH):
+        ensure_file(MST_FILE_PATH)
+    compiled_mst, source = mst_snapshot.load_compiled_mst(MST_SNAPSHOT_FILE_PATH, MST_FILE_PATH)
+    print(f"Loaded MST from {source} in {(time.perf_counter() - start) * 1000:.1f} ms...")
+    return compiled_mst
 
-def load_detector_id_to_canton_mapping():
-    ensure_file(MST_FILE_PATH)
-    detector_id_canton_mapping = {}
-    with open(MST_FILE_PATH, "r") as f:
-        stations = json.load(f)
-    for station in stations:
-        for detector in station["detectors"]:
-            detector_id = detector["id"]
-            canton = station["canton"]
-            detector_id_canton_mapping[detector_id] = canton
-    return detector_id_canton_mapping
-
-def parse_msr_from_request():
-    url = "https://api.opentransportdata.swiss/TDP/Soap_Datex2/Pull"
-
-    headers = {
-        'Content-Type': 'text/xml; charset=utf-8',
-        "Authorization": TOKEN,
-        "SOAPAction": "http://opentransportdata.swiss/TDP/Soap_Datex2/Pull/v1/pullMeasuredData"
-    }
-    response = requests.request("POST", url, headers=headers, data=MSR_PAYLOAD)
-    result = parse_msr(response.text.encode())
-    return result
+def get_mst_snapshot_version():
+    # Changes whenever preprocessing.py replaced the snapshot
+    try:
+        stat = os.stat(MST_SNAPSHOT_FILE_PATH)
+    except FileNotFoundError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+def create_cantons(canton_names):
+    cantons = [{
+        "label": "All Cantons",
+        "value": ALL_CANTONS
+    }]
+    cantons += [{"label": canton_name, "value": canton_name} for canton_name in canton_names]
+    return cantons
+
+def load_mst_indexes():
+    # Runs on a thread, everything derived from the MST is built before any of it is swapped in
+    version = get_mst_snapshot_version()
+    compiled_mst = load_compiled_mst()
+    station_index = StationIndex(compiled_mst["mst"], compiled_mst["stationFragments"])
+    spatial_index = SpatialIndex(compiled_mst["mst"])
+    return version, compiled_mst, station_index, spatial_index
+
+def swap_mst(version, compiled_mst, station_index, spatial_index):
+    # Must be called on the event loop (or before it runs). Swapped in a single step, so a request sees
+    # either the old or the new MST but never a mix of both. Requests which are still running keep the
+    # (unchanged) objects they already have.
+    global MST_SNAPSHOT_VERSION, COMPILED_MST, MST, DETECTOR_ID_TO_CANTON_MAPPING, DETECTOR_ID_TO_STATION_ID_MAPPING, \
+        DETECTOR_MEASUREMENT_TAG_SETS, STATION_INDEX, SPATIAL_INDEX, CANTON_NAMES, CANTONS
+    MST_SNAPSHOT_VERSION = version
+    COMPILED_MST = compiled_mst
+    MST = compiled_mst["mst"]
+    DETECTOR_ID_TO_CANTON_MAPPING = compiled_mst["detectorIdToCanton"]
+    DETECTOR_ID_TO_STATION_ID_MAPPING = compiled_mst["detectorIdToStationId"]
+    # The cached tag sets contain the canton and station, they are built again by the next ingest
+    DETECTOR_MEASUREMENT_TAG_SETS = line_protocol.create_tag_sets(STORAGE_SCHEMA)
+    STATION_INDEX = station_index
+    SPATIAL_INDEX = spatial_index
+    CANTON_NAMES = compiled_mst["cantonNames"]
+    CANTONS = create_cantons(CANTON_NAMES)
+    RESPONSE_CACHE.invalidate()
+
+async def reload_mst_if_changed():
+    version = get_mst_snapshot_version()
+    if version is None or version == MST_SNAPSHOT_VERSION:
+        return
+    try:
+        version, compiled_mst, station_index, spatial_index = await asyncio.to_thread(load_mst_indexes)
+    except Exception as error:
+        # Keep serving the MST we have
+        print(f"Failed to reload the MST because {error}")
+        return
+    swap_mst(version, compiled_mst, station_index, spatial_index)
+    changes = compiled_mst.get("changes", {})
+    print(f"Reloaded MST with {len(MST)} stations, {len(changes.get('added', []))} added, "
+          f"{len(changes.get('removed', []))} removed and {len(changes.get('changed', []))} changed...")
+
+def parse_msr(xml_content, detector_id_to_canton_mapping, detector_id_to_station_id_mapping):
+    # Single pass streaming parser, see datex2.py
+    return datex2.parse_msr(xml_content, detector_id_to_canton_mapping, detector_id_to_station_id_mapping)
 
 def load_msr_payload_and_token():
     token = SECRETS.get("OPEN_TRANSPORT_DATA_AUTH_TOKEN", "")
@@ -156,6 +129,15 @@ def load_msr_payload_and_token():
 
 def create_app():
     app = FastAPI()
+    # Every route reports its latency, see metrics.py
+    app.router.route_class = metrics.TimedRoute
+    app.add_middleware(
+        metrics.MetricsMiddleware,
+        request_duration=HTTP_REQUEST_DURATION,
+        request_phase_duration=HTTP_REQUEST_PHASE_DURATION,
+        # The event stream stays open as long as the dashboard does
+        excluded_paths=["/metrics", "/events"]
+    )
 
     # Allow CORS
     app.add_middleware(
@@ -174,7 +156,8 @@ def connect_to_db():
         url = SECRETS["INFLUXDB_URL"]
 
         print(f"Connecting to InfluxDB with the following configuration\n token => {token}\n org => {org}\n url => {url}")
-        write_client = InfluxDBClient(url=url, token=token, org=org)
+        # The timeout (in ms) bounds every single request, a query thread can therefore not hang forever
+        write_client = InfluxDBClient(url=url, token=token, org=org, enable_gzip=True, timeout=int(INFLUXDB_QUERY_TIMEOUT_SECONDS * 1000))
     except Exception as error:
         sys.exit(f"Error in connecting to InfluxDB, reason: {error}")
     return write_client
@@ -188,42 +171,181 @@ def load_secrets():
     secrets = dotenv_values(ENV_FILE_PATH)
     return secrets
 
+def invalidate_cached_responses():
+    RESPONSE_CACHE.invalidate()
+    # Also those of the other workers
+    if SHARED_INGEST_STATE is not None:
+        SHARED_INGEST_STATE.publish_written()
+
+def on_write_success(conf, data):
+    print(f"Wrote batch of detector measurements ({len(data)} bytes) into db...")
+    INFLUXDB_WRITE_BATCHES.inc(result="success")
+    INFLUXDB_WRITE_BYTES.inc(len(data))
+    # New data is available, cached responses are outdated
+    invalidate_cached_responses()
+
+def on_write_error(conf, data, exception):
+    print(f"Failed to write batch of detector measurements because {exception}")
+    INFLUXDB_WRITE_BATCHES.inc(result="error")
+
+def on_write_retry(conf, data, exception):
+    print(f"Retrying to write batch of detector measurements because {exception}")
+    INFLUXDB_WRITE_BATCHES.inc(result="retry")
+
+def create_write_api():
+    # The batching write api flushes in the background, either when a batch is full or when the flush interval passed
+    return db_client.write_api(write_options=WRITE_OPTIONS, success_callback=on_write_success,
+                               error_callback=on_write_error, retry_callback=on_write_retry)
+
+def create_spool_write_api():
+    # The drainer sends large batches itself and retries them, see write_spool.py
+    return db_client.write_api(write_options=SYNCHRONOUS)
+
+def open_write_spool():
+    # Only the ingest leader opens the spool, it is not shared between processes
+    return WriteSpool(
+        SECRETS.get("WRITE_SPOOL_DIRECTORY") or "./data/spool",
+        segment_max_bytes=int(SECRETS.get("WRITE_SPOOL_SEGMENT_MB") or 16) * MEGABYTE,
+        max_bytes=int(SECRETS.get("WRITE_SPOOL_MAX_MB") or 2048) * MEGABYTE
+    )
+
+def create_spool_drainer(write_spool):
+    return SpoolDrainer(write_spool, write_spooled_lines, batch_max_bytes=WRITE_SPOOL_BATCH_BYTES,
+                        on_written=on_spool_written, on_failed=on_spool_write_failed,
+                        is_permanent=is_permanent_write_error, on_rejected=on_spool_write_rejected,
+                        on_replayed=on_spool_replayed_late)
+
+def write_spooled_lines(body):
+    # Runs on the drainer thread
+    spool_write_api.write(bucket=BUCKET, org=db_client.org, record=body, write_precision=WritePrecision.NS)
+
+def on_spool_written(batch, duration):
+    print(f"Replayed {batch.number_of_lines} spooled detector measurements ({batch.number_of_bytes} bytes) into db in {duration:.2f} s...")
+    # New data is available, cached responses are outdated
+    invalidate_cached_responses()
+    SPOOL_REPLAYED_LINES.inc(batch.number_of_lines)
+    SPOOL_REPLAYED_BYTES.inc(batch.number_of_bytes)
+    SPOOL_REPLAY_DURATION.observe(duration)
+
+def on_spool_write_failed(batch, error):
+    SPOOL_REPLAY_FAILURES.inc()
+
+def is_permanent_write_error(error):
+    # InfluxDB rejected the points themselves (e.g a field type conflict or outside the retention),
+    # writing them again can never succeed. Everything else (unavailable, unauthorized, missing bucket,
+    # too many requests) may go away.
+    return isinstance(error, ApiException) and error.status in PERMANENT_WRITE_ERROR_STATUSES
+
+def on_spool_write_rejected(batch, error):
+    SPOOL_REJECTED_LINES.inc(batch.number_of_lines)
+
+def on_spool_replayed_late(oldest_appended_at, newest_appended_at):
+    # Runs on the drainer thread. The rollup tasks already aggregated the bins of measurements which
+    # were written late (e.g after InfluxDB was down), those bins are built again.
+    if not ROLLUPS_ENABLED:
+        return
+    start = oldest_appended_at - LATE_MEASUREMENTS_MARGIN_NANOSECONDS
+    try:
+        with INGEST_STAGE_DURATION.time(stage="rebuild_rollups"):
+            rollups.backfill_rollups(db_client, BUCKET, ROLLUP_BUCKET, ERROR_FILTER, start, newest_appended_at)
+    except Exception as error:
+        print(f"Failed to rebuild the error rollups of the replayed measurements because {error}")
+        return
+    RESPONSE_CACHE.invalidate()
+
 def write_detector_measurements_from_msr(msr):
+    # Returns the number of points spooled (or queued) for writing
     try:
-        with db_client.write_api(write_options=WRITE_OPTIONS) as api:
-            detector_measurements = []
-            for detector_measurement in msr["detector_measurements"]:
-                for sensor_measurement in detector_measurement["sensorMeasurements"]:
-                    data = {
-                        "measurement": "detector_measurement",
-                        "tags": {
-                            "id": detector_measurement["id"],
-                            "index": int(sensor_measurement["index"]),
-                            "hasError": bool(sensor_measurement["hasError"]),
-                            "canton": detector_measurement.get("canton", "none"),
-                            "stationId": detector_measurement.get("stationId", "none"),
-                            "kind": "none" if sensor_measurement["kind"] == None else sensor_measurement["kind"]
-                        },
-                        "fields": {
-                            "value": float(sensor_measurement["value"]),
-                            "numberOfInputValuesUsed": int(sensor_measurement.get("numberOfInputValuesUsed", 0)),
-                            "errorReason": "none" if sensor_measurement["errorReason"] == None else sensor_measurement["errorReason"]
-                        },
-                        "time": datetime.utcnow()
-                    }
-                    detector_measurements.append(data)
-            print(f"Writing {len(detector_measurements)} detector measurements into db...")
-            api.write(bucket=BUCKET, org=db_client.org, record=detector_measurements)
-            print("Finished...")
+        # Measurements which were already written (e.g the feed did not advance since the last pull) are skipped
+        number_of_skipped_points = LAST_SEEN_INDEX.number_of_skipped_points
+        detector_measurements = line_protocol.detector_measurements_to_lines(msr["detector_measurements"], DETECTOR_MEASUREMENT_TAG_SETS, LAST_SEEN_INDEX)
+        number_of_skipped_points = LAST_SEEN_INDEX.number_of_skipped_points - number_of_skipped_points
+        print(f"Queueing {len(detector_measurements)} detector measurements for writing into db, skipped {number_of_skipped_points} unchanged ones...")
+        if len(detector_measurements) == 0:
+            return 0
+        if WRITE_SPOOL is not None:
+            try:
+                WRITE_SPOOL.append(detector_measurements)
+                return len(detector_measurements)
+            except OSError as error:
+                # e.g the disk is full, the batching writer still has a chance
+                print(f"Failed to spool MSR data because {error}, writing it directly...")
+        write_api.write(bucket=BUCKET, org=db_client.org, record=detector_measurements, write_precision=WritePrecision.NS)
+        return len(detector_measurements)
     except Exception as error:
         print(f"Failed to write MSR data because {error}")
+        return 0
+
+# The stages of the ingest pipeline, see ingest_pipeline.py
+async def fetch_msr():
+    with INGEST_STAGE_DURATION.time(stage="fetch"):
+        content = await MSR_CLIENT.fetch()
+    # The other workers parse the same pull, see follow_ingest_leader
+    if SHARED_INGEST_STATE is not None:
+        with INGEST_STAGE_DURATION.time(stage="share"):
+            await asyncio.to_thread(SHARED_INGEST_STATE.publish_pull, content)
+    return content
+
+def parse_fetched_msr(xml_content):
+    # Runs on a thread. The mappings are taken from a single compiled MST so a reload can not swap
+    # them halfway through.
+    compiled_mst = COMPILED_MST
+    with INGEST_STAGE_DURATION.time(stage="parse"):
+        return parse_msr(xml_content, compiled_mst["detectorIdToCanton"], compiled_mst["detectorIdToStationId"])
+
+def store_msr(msr):
+    # Runs on a thread, one pull after the other. The points are spooled first, the in memory hot window
+    # and push must never cost a write.
+    # Only spools the points, they are written to InfluxDB in the background (see on_spool_written)
+    with INGEST_STAGE_DURATION.time(stage="write"):
+        number_of_points = write_detector_measurements_from_msr(msr)
+    if HOT_WINDOW is not None:
+        try:
+            with INGEST_STAGE_DURATION.time(stage="hot_window"):
+                HOT_WINDOW.append_msr(msr)
+        except Exception as error:
+            print(f"Failed to append the latest msr data to the hot window because {error}")
+    delta = None
+    try:
+        with INGEST_STAGE_DURATION.time(stage="push"):
+            delta = PUSH_HUB.create_delta(msr)
+    except Exception as error:
+        print(f"Failed to create the push delta of the latest msr data because {error}")
+    return number_of_points, delta
+
+def complete_ingest_cycle(result):
+    number_of_points, delta = result
+    # Subscribed dashboards get what the cycle brought instead of having to re-fetch
+    PUSH_HUB.publish(delta)
+    INGEST_POINTS_PER_CYCLE.observe(number_of_points)
+    if delta is not None:
+        INGEST_DATA_AGE.observe(time.time() - line_protocol.parse_timestamp(delta["time"]) / 1e9)
 
-def update_detector_measurements_in_db():
+def follow_msr(msr):
+    # Runs on a thread, what store_msr does in a worker which does not write
+    if HOT_WINDOW is not None:
+        try:
+            with INGEST_STAGE_DURATION.time(stage="hot_window"):
+                HOT_WINDOW.append_msr(msr)
+        except Exception as error:
+            print(f"Failed to append the followed msr data to the hot window because {error}")
+    with INGEST_STAGE_DURATION.time(stage="push"):
+        return PUSH_HUB.create_delta(msr)
+
+async def follow_ingest_leader():
+    # Runs in every worker which is not the ingest leader
+    content, written = await asyncio.to_thread(SHARED_INGEST_STATE.poll)
+    if written:
+        RESPONSE_CACHE.invalidate()
+    if content is None:
+        return
     try:
-        msr = parse_msr_from_request()
-        write_detector_measurements_from_msr(msr)
+        msr = await asyncio.to_thread(parse_fetched_msr, content)
+        delta = await asyncio.to_thread(follow_msr, msr)
     except Exception as error:
-        print(f"Failed to get latest msr data because of {error}")
+        print(f"Failed to follow the latest msr data of the ingest leader because {error}")
+        return
+    PUSH_HUB.publish(delta)
 
 def create_query_from_template(template, placeholder, elements, operator):
         query = ""
@@ -235,6 +357,60 @@ def create_query_from_template(template, placeholder, elements, operator):
                 query += template.replace(placeholder, str(element))
         return query
 
+def observe_query(endpoint, query, seconds, number_of_rows, error=None):
+    INFLUXDB_QUERY_DURATION.observe(seconds, endpoint=endpoint, result="success" if error is None else "failure")
+    metrics.add_query_seconds(seconds)
+    QUERY_LOG.log(endpoint, query, seconds, number_of_rows, error)
+
+async def run_query(endpoint, query, function, count_rows):
+    # The query and reading its results run on the query executor, see query_executor.py
+    start = time.perf_counter()
+    try:
+        result = await QUERY_EXECUTOR.run(endpoint, function)
+    except Exception as error:
+        observe_query(endpoint, query, time.perf_counter() - start, None, error)
+        raise
+    observe_query(endpoint, query, time.perf_counter() - start, count_rows(result))
+    return result
+
+async def query_records(endpoint, query):
+    return await run_query(endpoint, query, lambda: list(db_client.query_api().query_stream(query)), len)
+
+async def query_tables(endpoint, query):
+    return await run_query(endpoint, query, lambda: db_client.query_api().query(query),
+                           lambda tables: sum([len(table.records) for table in tables]))
+
+def escape_flux_string(value):
+    # Values coming from a request end up inside a Flux string literal
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+def sort_by_canton(item):
+    # Measurements of detectors without a known canton come last
+    canton = item[0]
+    return (canton is None, canton or "")
+
+def get_hot_window_start(time_str):
+    # Start of the requested range if it can be answered from memory, None if InfluxDB has to be asked
+    if HOT_WINDOW is None:
+        return None
+    return HOT_WINDOW.get_start(time_str)
+
+def create_rollup_query(time_str, measurement, columns, canton, bin_size=None):
+    # Returns a query combining the error count rollups with the raw measurements of the edges which
+    # are not rolled up yet, None if rollups are disabled, the range is absolute or too short to profit
+    if not ROLLUPS_ENABLED or ROLLED_UP_SINCE is None:
+        return None
+    stop = time.time_ns()
+    start = parse_relative_start(time_str, stop)
+    if start is None:
+        return None
+    segments = rollups.plan_segments(start, stop, rollups.get_rollups(bin_size), since=ROLLED_UP_SINCE)
+    if all(segment_bin_size is None for segment_bin_size, _, _ in segments):
+        return None
+    canton_filter = None if canton is None else escape_flux_string(canton)
+    query = rollups.create_segments_query(segments, BUCKET, ROLLUP_BUCKET, ERROR_FILTER, measurement, columns, canton_filter)
+    return query, start, stop
+
 def get_value_or_default(value, default):
     if value == None or value == "":
         return default
@@ -243,146 +419,573 @@ def get_value_or_default(value, default):
 # Global variables
 MSR_FILE_PATH = "./data/msr.json"
 MST_FILE_PATH = "./data/mst.json"
+MST_SNAPSHOT_FILE_PATH = "./data/mst.snapshot"
 PAYLOAD_MSR_FILE_PATH = "./data/payload_pull_msr.xml"
 
 
 ENV_FILE_PATH = "./.env-local"
-WRITE_OPTIONS = SYNCHRONOUS
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+EVENT_STREAM_MEDIA_TYPE = "text/event-stream"
 
-UPDATE_DETECTOR_MEASUREMENTS_IN_DB_INTERVAL_MINUTES = '*/1  ' # CRON Job notation, e.g every 1 Minute
 SECRETS = load_secrets()
 BUCKET = SECRETS["DOCKER_INFLUXDB_INIT_BUCKET"]
 
-MST = read_mst_from_file()
+WRITE_OPTIONS = WriteOptions(
+    batch_size=int(SECRETS.get("INFLUXDB_WRITE_BATCH_SIZE") or 5000),
+    flush_interval=int(SECRETS.get("INFLUXDB_WRITE_FLUSH_INTERVAL_MS") or 1000),
+    jitter_interval=0,
+    retry_interval=5000,
+    max_retries=3,
+    max_retry_time=60_000
+)
+
+# Everything derived from the MST is replaced as a whole when preprocessing.py wrote a new snapshot
+MST_SNAPSHOT_VERSION = get_mst_snapshot_version()
+COMPILED_MST = load_compiled_mst()
+MST = COMPILED_MST["mst"]
+# Seconds between checks for a new MST snapshot, 0 disables the reload
+MST_RELOAD_INTERVAL_SECONDS = int(SECRETS.get("MST_RELOAD_INTERVAL_SECONDS") or 60)
 MSR_PAYLOAD, TOKEN = load_msr_payload_and_token()
-# Load the mapping so we know which detector id is mapped to which canton
-DETECTOR_ID_TO_CANTON_MAPPING = load_detector_id_to_canton_mapping()
+# Keeps its connections alive between the pulls, see ingest_client.py
+MSR_CLIENT = MsrClient(
+    MSR_PAYLOAD,
+    TOKEN,
+    url=SECRETS.get("DATEX2_PULL_URL") or DATEX2_PULL_URL,
+    timeout_seconds=float(SECRETS.get("DATEX2_PULL_TIMEOUT_SECONDS") or 30),
+    max_retries=int(SECRETS.get("DATEX2_PULL_MAX_RETRIES") or 3)
+)
+# Mappings so we know which detector id belongs to which canton and station
+DETECTOR_ID_TO_CANTON_MAPPING = COMPILED_MST["detectorIdToCanton"]
+DETECTOR_ID_TO_STATION_ID_MAPPING = COMPILED_MST["detectorIdToStationId"]
+# Schema the measurements are written and queried in, see storage_schema.py
+STORAGE_SCHEMA = storage_schema.ensure_schema(SECRETS.get("INFLUXDB_STORAGE_SCHEMA") or storage_schema.LEGACY)
+ERROR_FILTER = storage_schema.ERROR_FILTERS[STORAGE_SCHEMA]
+# Serialized tag sets for each detector and index, reused for every write. They are built by the first
+# ingest (in its worker thread) instead of on startup, the canton and station of a measurement come
+# from the MST mappings anyway.
+DETECTOR_MEASUREMENT_TAG_SETS = line_protocol.create_tag_sets(STORAGE_SCHEMA)
+# Newest written timestamp for each detector and index
+LAST_SEEN_INDEX = line_protocol.LastSeenIndex()
+# The last hours of measurements kept in memory, a value of 0 disables it
+HOT_WINDOW_HOURS = float(SECRETS.get("HOT_WINDOW_HOURS") or 4)
+HOT_WINDOW = HotWindow(HOT_WINDOW_HOURS) if HOT_WINDOW_HOURS > 0 else None
+# Error counts pre aggregated by InfluxDB tasks into a separate bucket, see rollups.py
+ROLLUP_BUCKET = SECRETS.get("INFLUXDB_ROLLUP_BUCKET") or f"{BUCKET}_rollups"
+ROLLUPS_ENABLED = (SECRETS.get("ROLLUPS_ENABLED") or "true").lower() != "false"
+# From when on the rollups are complete, older ranges are read from the raw measurements. Unknown
+# until the rollups were set up (or, by a follower, read back). Read back again at the given interval
+# by every worker, a backfill (e.g backfill.py --rollups or by the leader) moves it back.
+ROLLED_UP_SINCE = None
+ROLLED_UP_SINCE_RELOAD_INTERVAL_SECONDS = int(SECRETS.get("ROLLED_UP_SINCE_RELOAD_INTERVAL_SECONDS") or 60)
+# Responses of the aggregating endpoints, invalidated whenever new measurements were written
+RESPONSE_CACHE = ResponseCache(
+    max_entries=int(SECRETS.get("RESPONSE_CACHE_MAX_ENTRIES") or 256),
+    max_age_seconds=float(SECRETS.get("RESPONSE_CACHE_MAX_AGE_SECONDS") or 60)
+)
+
+# Queries run on a bounded thread pool with a limited number of concurrent queries per endpoint
+INFLUXDB_QUERY_TIMEOUT_SECONDS = float(SECRETS.get("INFLUXDB_QUERY_TIMEOUT_SECONDS") or 30)
+QUERY_EXECUTOR = QueryExecutor(
+    max_workers=int(SECRETS.get("INFLUXDB_QUERY_WORKERS") or 8),
+    max_concurrent_queries_per_endpoint=int(SECRETS.get("INFLUXDB_QUERY_CONCURRENCY_PER_ENDPOINT") or 4),
+    timeout_seconds=INFLUXDB_QUERY_TIMEOUT_SECONDS
+)
+# Stations per canton with their pre serialized JSON
+STATION_INDEX = StationIndex(MST, COMPILED_MST["stationFragments"])
+# Grid over the station coordinates for the map viewport
+SPATIAL_INDEX = SpatialIndex(MST)
+# Up to this zoom level the viewport returns clusters instead of single stations
+STATIONS_CLUSTER_MAX_ZOOM = float(SECRETS.get("STATIONS_CLUSTER_MAX_ZOOM") or 10)
+
+PUSH_HUB = PushHub(
+    max_pending_events=int(SECRETS.get("PUSH_MAX_PENDING_EVENTS") or 16),
+    keepalive_seconds=float(SECRETS.get("PUSH_KEEPALIVE_SECONDS") or 15)
+)
+PUSH_MAX_DETECTORS_PER_SUBSCRIPTION = int(SECRETS.get("PUSH_MAX_DETECTORS_PER_SUBSCRIPTION") or 256)
+
+CANTON_NAMES = COMPILED_MST["cantonNames"]
+CANTONS = create_cantons(CANTON_NAMES)
 
-ALL_CANTONS = "all"
-CANTON_NAMES = list(set([station["canton"] for station in MST]))
-CANTONS = [{
-    "label": "All Cantons",
-    "value": ALL_CANTONS
-}]
+# Ingest appends every cycle to a spool on the local disk first, a drainer replays it into InfluxDB so
+# nothing is lost while InfluxDB is slow or down (see write_spool.py)
+MEGABYTE = 1024 * 1024
+WRITE_SPOOL_ENABLED = (SECRETS.get("WRITE_SPOOL_ENABLED") or "true").lower() != "false"
+WRITE_SPOOL_BATCH_BYTES = int(SECRETS.get("WRITE_SPOOL_BATCH_MB") or 8) * MEGABYTE
+# Bad request and unprocessable entity, see is_permanent_write_error
+PERMANENT_WRITE_ERROR_STATUSES = {400, 422}
+# Measurements are older than the time they were spooled at, by the age of the feed
+LATE_MEASUREMENTS_MARGIN_NANOSECONDS = 60 * 60 * 1_000_000_000
+# Opened once this worker became the ingest leader
+WRITE_SPOOL = None
+SPOOL_DRAINER = None
 
-CANTONS += [{"label": canton_name, "value": canton_name} for canton_name in CANTON_NAMES]
+# With several API workers (uvicorn reads their number from WEB_CONCURRENCY) only the worker holding
+# the lock file runs the ingest, the others follow it through the shared directory (see ingest_leader.py)
+API_WORKERS = int(os.environ.get("WEB_CONCURRENCY") or 1)
+INGEST_LEADER_LOCK = IngestLeaderLock(SECRETS.get("INGEST_LEADER_LOCK_FILE") or "./data/ingest.lock")
+INGEST_LEADER_RETRY_SECONDS = float(SECRETS.get("INGEST_LEADER_RETRY_SECONDS") or 5)
+INGEST_INTERVAL_SECONDS = float(SECRETS.get("INGEST_INTERVAL_SECONDS") or 60)
+# A shared pull older than an interval is stale, e.g left over from an earlier run
+SHARED_INGEST_STATE = SharedIngestState(SECRETS.get("INGEST_SHARED_DIRECTORY") or "./data/shared",
+                                        max_pull_age_seconds=INGEST_INTERVAL_SECONDS) if API_WORKERS > 1 else None
+SHARED_INGEST_POLL_SECONDS = float(SECRETS.get("INGEST_SHARED_POLL_SECONDS") or 1)
+FOLLOW_INGEST_LEADER_JOB_ID = "follow_ingest_leader"
+ELECT_INGEST_LEADER_JOB_ID = "elect_ingest_leader"
+
+# Prometheus metrics served under /metrics, see metrics.py
+METRICS = metrics.MetricsRegistry("astra_")
+HTTP_REQUEST_DURATION = METRICS.histogram("http_request_duration_seconds", "Duration of the requests until their last byte was sent",
+                                          ["method", "endpoint", "status"])
+HTTP_REQUEST_PHASE_DURATION = METRICS.histogram("http_request_phase_duration_seconds", "Time a request spent in InfluxDB queries and encoding its response",
+                                                ["endpoint", "phase"])
+INFLUXDB_QUERY_DURATION = METRICS.histogram("influxdb_query_duration_seconds", "Duration of the InfluxDB queries including reading their results",
+                                            ["endpoint", "result"])
+INGEST_STAGE_DURATION = METRICS.histogram("ingest_stage_duration_seconds", "Duration of the stages of an ingest cycle", ["stage"],
+                                          [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0])
+INGEST_LAG = METRICS.histogram("ingest_lag_seconds", "Time from a pull being due until it was spooled",
+                               buckets=[0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0])
+INGEST_DATA_AGE = METRICS.histogram("ingest_data_age_seconds", "Age of the newest measurement of a pull when it was written",
+                                    buckets=[15.0, 30.0, 60.0, 90.0, 120.0, 180.0, 300.0, 600.0])
+INGEST_TICKS = METRICS.counter("ingest_ticks_total", "Due pulls by what the missed tick policy did with them", ["outcome"])
+INGEST_POINTS_PER_CYCLE = METRICS.histogram("ingest_points_per_cycle", "Points an ingest cycle queued for writing",
+                                            buckets=[0, 100, 1000, 2500, 5000, 10_000, 25_000, 50_000, 100_000])
+INGEST_CYCLES = METRICS.counter("ingest_cycles_total", "Completed ingest cycles", ["result"])
+INFLUXDB_WRITE_BATCHES = METRICS.counter("influxdb_write_batches_total", "Batches the background writer sent to InfluxDB", ["result"])
+INFLUXDB_WRITE_BYTES = METRICS.counter("influxdb_write_bytes_total", "Bytes of line protocol written to InfluxDB")
+METRICS.gauge("query_executor_running", "Queries running per endpoint",
+              lambda: [((endpoint,), stats["running"]) for endpoint, stats in QUERY_EXECUTOR.get_stats()["endpoints"].items()], ["endpoint"])
+METRICS.gauge("query_executor_waiting", "Queries waiting for a free slot per endpoint",
+              lambda: [((endpoint,), stats["waiting"]) for endpoint, stats in QUERY_EXECUTOR.get_stats()["endpoints"].items()], ["endpoint"])
+METRICS.gauge("ingest_queue_depth", "Items waiting in front of each stage of the ingest pipeline",
+              lambda: [((queue,), size) for queue, size in INGEST_PIPELINE.get_queue_sizes().items()], ["queue"])
+SPOOL_REPLAYED_LINES = METRICS.counter("spool_replayed_points_total", "Points replayed from the write spool into InfluxDB")
+SPOOL_REPLAYED_BYTES = METRICS.counter("spool_replayed_bytes_total", "Bytes of line protocol replayed from the write spool into InfluxDB")
+SPOOL_REPLAY_DURATION = METRICS.histogram("spool_replay_duration_seconds", "Duration of a batch written from the write spool into InfluxDB",
+                                          buckets=[0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0])
+SPOOL_REJECTED_LINES = METRICS.counter("spool_rejected_points_total", "Points InfluxDB rejected permanently, they were given up")
+SPOOL_REPLAY_FAILURES = METRICS.counter("spool_replay_failures_total", "Failed writes of a write spool batch, each is retried")
+METRICS.gauge("spool_pending_bytes", "Bytes in the write spool which were not written into InfluxDB yet",
+              lambda: 0 if WRITE_SPOOL is None else WRITE_SPOOL.get_size())
+METRICS.gauge("spool_lag_seconds", "Age of the oldest record in the write spool which was not written into InfluxDB yet",
+              lambda: 0 if WRITE_SPOOL is None else WRITE_SPOOL.get_lag_seconds())
+METRICS.gauge("spool_segments", "Segment files of the write spool", lambda: 0 if WRITE_SPOOL is None else len(WRITE_SPOOL.segment_sizes))
+METRICS.gauge("ingest_leader", "Whether this worker runs the ingest", lambda: 1 if INGEST_LEADER_LOCK.get_role() == LEADER else 0)
+METRICS.gauge("push_subscribers", "Dashboards subscribed to /events", lambda: len(PUSH_HUB.subscriptions))
+METRICS.gauge("hot_window_series", "Series kept in the hot window", lambda: 0 if HOT_WINDOW is None else HOT_WINDOW.get_stats()["series"])
+# Only a sample of the queries is logged, slow and failed ones always
+QUERY_LOG = QueryLog(
+    sample_rate=float(SECRETS.get("QUERY_LOG_SAMPLE_RATE") or 0.01),
+    slow_query_seconds=float(SECRETS.get("QUERY_LOG_SLOW_SECONDS") or 1)
+)
+
+# Pulls every interval at offset seconds past it (e.g 60 and 20 pulls at hh:mm:20, shortly after the
+# feed published the minute), the next pull is already fetched while the previous one is written
+INGEST_PIPELINE = IngestPipeline(
+    fetch_msr,
+    parse_fetched_msr,
+    store_msr,
+    complete_ingest_cycle,
+    interval_seconds=INGEST_INTERVAL_SECONDS,
+    offset_seconds=float(SECRETS.get("INGEST_OFFSET_SECONDS") or 0),
+    missed_tick_policy=SECRETS.get("INGEST_MISSED_TICK_POLICY") or COALESCE,
+    max_pending_ticks=int(SECRETS.get("INGEST_MAX_PENDING_TICKS") or 5),
+    queue_size=int(SECRETS.get("INGEST_QUEUE_SIZE") or 2),
+    lag=INGEST_LAG,
+    ticks=INGEST_TICKS,
+    cycles=INGEST_CYCLES
+)
 
 app = create_app()
 db_client = connect_to_db()
+write_api = create_write_api()
+spool_write_api = create_spool_write_api()
+
+scheduler = AsyncIOScheduler()
+
+def setup_rollups():
+    global ROLLUPS_ENABLED, ROLLED_UP_SINCE
+    try:
+        ROLLED_UP_SINCE = rollups.ensure_rollup_tasks(db_client, BUCKET, ROLLUP_BUCKET, ERROR_FILTER)
+    except Exception as error:
+        # Queries keep working on the raw measurements only
+        print(f"Failed to set up the error rollups, disabling them because {error}")
+        ROLLUPS_ENABLED = False
+
+def load_rolled_up_since():
+    # Followers do not set up the rollups, they read back what the leader stored
+    global ROLLED_UP_SINCE
+    if not ROLLUPS_ENABLED:
+        return
+    try:
+        since = rollups.get_rolled_up_since(db_client, ROLLUP_BUCKET)
+    except Exception as error:
+        print(f"Failed to read from when on the error rollups are complete because {error}")
+        return
+    # Not stored (yet) keeps what is known
+    if since is not None:
+        ROLLED_UP_SINCE = since
+
+async def reload_rolled_up_since():
+    await asyncio.to_thread(load_rolled_up_since)
+
+async def start_ingest():
+    global WRITE_SPOOL, SPOOL_DRAINER
+    # The leader alone creates the rollups so workers do not race, see load_rolled_up_since
+    if ROLLUPS_ENABLED:
+        await asyncio.to_thread(setup_rollups)
+    # Replays what is left in the spool right away, e.g after InfluxDB was down
+    if WRITE_SPOOL_ENABLED:
+        WRITE_SPOOL = open_write_spool()
+        SPOOL_DRAINER = create_spool_drainer(WRITE_SPOOL)
+        SPOOL_DRAINER.start()
+    # The ingest pipeline runs on the event loop of the app, the blocking stages are moved to threads
+    INGEST_PIPELINE.start()
+
+async def try_to_become_ingest_leader():
+    # Runs in every follower, succeeds once the leader released the lock (e.g because it died)
+    if not INGEST_LEADER_LOCK.try_acquire():
+        # Until the leader stored it, rollups are not used
+        if ROLLUPS_ENABLED and ROLLED_UP_SINCE is None:
+            await asyncio.to_thread(load_rolled_up_since)
+        return
+    print(f"Worker {os.getpid()} took over the ingest...")
+    for job_id in [ELECT_INGEST_LEADER_JOB_ID, FOLLOW_INGEST_LEADER_JOB_ID]:
+        if scheduler.get_job(job_id) is not None:
+            scheduler.remove_job(job_id)
+    await start_ingest()
 
 @app.on_event("startup")
-def on_startup():
-    scheduler = BackgroundScheduler()
-    scheduler.add_job(update_detector_measurements_in_db, 'cron', minute=UPDATE_DETECTOR_MEASUREMENTS_IN_DB_INTERVAL_MINUTES)
+async def on_startup():
+    if INGEST_LEADER_LOCK.try_acquire():
+        print(f"Worker {os.getpid()} runs the ingest...")
+        await start_ingest()
+    else:
+        print(f"Worker {os.getpid()} follows the ingest of another worker...")
+        if ROLLUPS_ENABLED:
+            await asyncio.to_thread(load_rolled_up_since)
+        if SHARED_INGEST_STATE is not None:
+            scheduler.add_job(follow_ingest_leader, 'interval', seconds=SHARED_INGEST_POLL_SECONDS, id=FOLLOW_INGEST_LEADER_JOB_ID)
+        scheduler.add_job(try_to_become_ingest_leader, 'interval', seconds=INGEST_LEADER_RETRY_SECONDS, id=ELECT_INGEST_LEADER_JOB_ID)
+    if MST_RELOAD_INTERVAL_SECONDS > 0:
+        scheduler.add_job(reload_mst_if_changed, 'interval', seconds=MST_RELOAD_INTERVAL_SECONDS)
+    if ROLLUPS_ENABLED and ROLLED_UP_SINCE_RELOAD_INTERVAL_SECONDS > 0:
+        scheduler.add_job(reload_rolled_up_since, 'interval', seconds=ROLLED_UP_SINCE_RELOAD_INTERVAL_SECONDS)
     scheduler.start()
 
 @app.on_event("shutdown")
-def on_shutdown():
+async def on_shutdown():
+    scheduler.shutdown(wait=False)
+    await INGEST_PIPELINE.stop()
+    await MSR_CLIENT.close()
+    # Whatever the drainer did not write yet stays in the spool for the next start
+    if SPOOL_DRAINER is not None:
+        await asyncio.to_thread(SPOOL_DRAINER.stop)
+        WRITE_SPOOL.close()
+    QUERY_EXECUTOR.shutdown()
+    # Flushes the pending batches
+    write_api.close()
+    spool_write_api.close()
     # Close db client
     db_client.close()
+    # Lets a follower take over
+    INGEST_LEADER_LOCK.release()
 
-@app.post("/stations")
-async def post_stations(stationsBody: StationsBody):
-    stations = []
-    all_cantons = stationsBody.canton == ALL_CANTONS
-    print("Got ", stationsBody.canton)
-    if all_cantons:
-        # Do not filter stations
-        print("Not filtering any cantons when doing stations request")
-        stations = MST
+async def query_stations(canton, time_str):
+    # Returns the serialized JSON of the stations, see station_index.py
+    station_id_to_error_number_mapping = await query_number_of_errors_per_station(canton, time_str)
+    # The number of errors is merged in while serializing, the stations themselves are never changed.
+    # If the mapping has no entry this means the station was not in the result set, e.g hasError was false. Therefore the number is 0.
+    return STATION_INDEX.serialize(canton, station_id_to_error_number_mapping)
+
+async def query_number_of_errors_per_station(canton, time_str):
+    all_cantons = canton == ALL_CANTONS
+    if len(STATION_INDEX.get_station_ids(canton)) == 0:
+        # Unknown canton, nothing to ask InfluxDB for
+        return {}
+
+    # Recent time ranges are answered from the in memory hot window
+    start = get_hot_window_start(time_str)
+    if start is not None:
+        return HOT_WINDOW.get_number_of_errors_per_station(start)
+
+    # Query influx to get the number of errors for each station. Longer ranges use the pre aggregated
+    # rollups and only touch the raw measurements at the edges which are not rolled up yet.
+    query = ""
+    rollup_query = create_rollup_query(time_str, rollups.STATION_ERROR_ROLLUP, ["canton", "stationId"], None if all_cantons else canton)
+    if rollup_query is not None:
+        query = rollup_query[0] + """
+            |> group(columns: ["stationId"])
+            |> sum()
+        """
+    elif not all_cantons:
+        query = """
+            from(bucket: "%bucket%")
+                |> range(start: %time%)
+                %error_filter%
+                |> filter(fn: (r) => r["canton"] == "%canton%")
+                |> group(columns: ["stationId"])
+                |> count()
+        """
+        query = query.replace("%canton%", canton)
     else:
-        print("Filtering cantons when doing stations request")
-        stations = [station for station in MST if station["canton"] == stationsBody.canton]
+        # No canton specified
+        query = """
+            from(bucket: "%bucket%")
+                |> range(start: %time%)
+                %error_filter%
+                |> group(columns: ["stationId"])
+                |> count()
+        """
+    query = query.replace("%time%", time_str).replace("%error_filter%", ERROR_FILTER).replace("%bucket%", BUCKET)
+    records = await query_records("stations", query)
 
-    # Query influx to get the number of errors for each station
-    try:
-        api = db_client.query_api()
-        time_str = get_value_or_default(stationsBody.time, DEFAULT_TIME_RANGE)
+    # Create dictionary with station id as key for fast look up
+    station_id_to_error_number_mapping = {}
+    for record in records:
+        station_id = record["stationId"]
+        number_of_errors = record["_value"]
+        station_id_to_error_number_mapping[station_id] = number_of_errors
+    return station_id_to_error_number_mapping
 
-        query = ""
-        if ALL_CANTONS:
-            query = """
-                from(bucket: "%bucket%")
-                    |> range(start: %time%)
-                    |> filter(fn: (r) => r["_measurement"] == "detector_measurement")
-                    |> filter(fn: (r) => r["hasError"] == "True")
-                    |> filter(fn: (r) => r["canton"] == "%canton%")
-                    |> group(columns: ["stationId"])
-                    |> count()
-            """
-            query = query.replace("%canton%", stationsBody.canton)
-        else:
-            # No canton specified
-            query = """
-                from(bucket: "%bucket%")
-                    |> range(start: %time%)
-                    |> filter(fn: (r) => r["_measurement"] == "detector_measurement")
-                    |> filter(fn: (r) => r["hasError"] == "True")
-                    |> group(columns: ["stationId"])
-                    |> count()
-            """
-        query = query.replace("%time%", time_str).replace("%bucket%", BUCKET)
-        print(f"Sending the following query {query}")
-        records = api.query_stream(query)
-
-        # Create dictionary with station id as key for fast look up
-        station_id_to_error_number_mapping = {}
-        for record in records:
-            station_id = record["stationId"]
-            number_of_errors = record["_value"]
-            station_id_to_error_number_mapping[station_id] = number_of_errors
-
-        # Add number_of_errors property to stations
-        for station in stations:
-            station_id = station["id"]
-            # If the mapping returns 0 this means the station was not in the result set, e.g hasError was false. Therefore we can simply set the number to 0.
-            station["numberOfErrors"] = station_id_to_error_number_mapping.get(station_id, 0)
-
-        return stations
+@app.post("/stations")
+async def post_stations(stationsBody: StationsBody):
+    canton = stationsBody.canton
+    time_str = get_value_or_default(stationsBody.time, DEFAULT_TIME_RANGE)
+    try:
+        content = await RESPONSE_CACHE.get_or_compute(("stations", canton, time_str), lambda: query_stations(canton, time_str))
+        return Response(content=content, media_type="application/json")
     except Exception as error:
         print(f"Failed to get stations because of {error}")
         return []
 
+@app.post("/stations/viewport")
+async def post_stations_viewport(stationsViewportBody: StationsViewportBody):
+    # Only the stations within the bounding box of the map, at low zoom levels stations close to each
+    # other are combined into clusters with their summed number of errors:
+    #
+    #   {"stations": [...], "clusters": [{"longitude": ..., "latitude": ..., "bounds": [west, south, east, north],
+    #                                     "numberOfStations": 12, "numberOfErrors": 3}]}
+    canton = get_value_or_default(stationsViewportBody.canton, ALL_CANTONS)
+    time_str = get_value_or_default(stationsViewportBody.time, DEFAULT_TIME_RANGE)
+    try:
+        station_id_to_error_number_mapping = await RESPONSE_CACHE.get_or_compute(
+            ("number_of_errors_per_station", canton, time_str), lambda: query_number_of_errors_per_station(canton, time_str))
+        positions = SPATIAL_INDEX.query(stationsViewportBody.west, stationsViewportBody.south,
+                                        stationsViewportBody.east, stationsViewportBody.north,
+                                        None if canton == ALL_CANTONS else canton)
+        clusters = []
+        if stationsViewportBody.zoom <= STATIONS_CLUSTER_MAX_ZOOM:
+            positions, clusters = SPATIAL_INDEX.cluster(positions, stationsViewportBody.zoom, station_id_to_error_number_mapping)
+        content = b'{"stations":' + STATION_INDEX.serialize_positions(positions, station_id_to_error_number_mapping) \
+            + b',"clusters":' + json.dumps(clusters, separators=(",", ":")).encode("utf-8") + b"}"
+        return Response(content=content, media_type="application/json")
+    except Exception as error:
+        print(f"Failed to get stations of the viewport because of {error}")
+        return {"stations": [], "clusters": []}
+
+def create_detector_measurements_query(detector_keys, time_str):
+    # Fetch all requested detectors (id and index) with a single query instead of one query per detector
+    detector_filter = " or ".join([
+        f'(r["id"] == "{escape_flux_string(id)}" and r["index"] == "{escape_flux_string(index)}")'
+        for id, index in detector_keys
+    ])
+    query = """
+        from(bucket: "%bucket%")
+          |> range(start: %time%)
+          |> filter(fn: (r) => r["_measurement"] == "%measurement%")
+          |> filter(fn: (r) => %detector_filter%)
+          |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+    """
+    return query.replace("%time%", time_str).replace("%measurement%", storage_schema.MEASUREMENTS[STORAGE_SCHEMA]) \
+        .replace("%detector_filter%", detector_filter).replace("%bucket%", BUCKET)
+
+def create_downsampled_detector_measurements_query(detector_keys, time_str, window, aggregation):
+    # One row per detector and window with the aggregated value, the summed number of input values
+    # and whether any point of the window had an error (see downsampling.py)
+    detector_filter = " or ".join([
+        f'(r["id"] == "{escape_flux_string(id)}" and r["index"] == "{escape_flux_string(index)}")'
+        for id, index in detector_keys
+    ])
+    query = """
+        data = from(bucket: "%bucket%")
+          |> range(start: %time%)
+          |> filter(fn: (r) => r["_measurement"] == "%measurement%")
+          |> filter(fn: (r) => %detector_filter%)
+
+        values = data
+          |> filter(fn: (r) => r["_field"] == "value")
+          |> group(columns: ["id", "index"])
+          |> aggregateWindow(every: %every%, fn: %aggregation%, createEmpty: false, timeSrc: "_start")
+          |> set(key: "_field", value: "value")
+
+        numberOfInputValuesUsed = data
+          |> filter(fn: (r) => r["_field"] == "numberOfInputValuesUsed")
+          |> group(columns: ["id", "index"])
+          |> aggregateWindow(every: %every%, fn: sum, createEmpty: false, timeSrc: "_start")
+          |> set(key: "_field", value: "numberOfInputValuesUsed")
+
+        hasError = data
+          %has_error_values%
+          |> group(columns: ["id", "index"])
+          |> aggregateWindow(every: %every%, fn: max, createEmpty: false, timeSrc: "_start")
+          |> set(key: "_field", value: "hasError")
+
+        union(tables: [values, numberOfInputValuesUsed, hasError])
+          |> group(columns: ["id", "index"])
+          |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+          |> sort(columns: ["_time"])
+    """
+    return query.replace("%time%", time_str).replace("%measurement%", storage_schema.MEASUREMENTS[STORAGE_SCHEMA]) \
+        .replace("%has_error_values%", storage_schema.HAS_ERROR_VALUES[STORAGE_SCHEMA]) \
+        .replace("%every%", downsampling.to_flux_duration(window)).replace("%aggregation%", aggregation) \
+        .replace("%detector_filter%", detector_filter).replace("%bucket%", BUCKET)
+
+def wants_ndjson(request):
+    return NDJSON_MEDIA_TYPE in request.headers.get("accept", "")
+
+def to_ndjson_line(detector_measurement, measurement):
+    # One measurement per line, together with the detector it belongs to
+    return json.dumps({
+        "id": detector_measurement.id,
+        "index": detector_measurement.index,
+        "name": detector_measurement.name,
+        **measurement,
+        "time": measurement["time"].isoformat()
+    }) + "\n"
+
+def iter_detector_measurement_lines(query, detectors_by_key):
+    # Runs on the query executor, rows are converted as they arrive and never collected
+    for record in db_client.query_api().query_stream(query):
+        detector_measurement = detectors_by_key.get((record["id"], record["index"]))
+        if detector_measurement is not None:
+            yield to_ndjson_line(detector_measurement, storage_schema.record_to_measurement(STORAGE_SCHEMA, record))
+
+async def stream_detector_measurements(detector_measurements, time_str, max_points=None, aggregation=downsampling.DEFAULT_AGGREGATION):
+    try:
+        # Downsampled series are bounded by max_points, there is nothing to gain from streaming rows
+        if max_points is not None:
+            results = await query_detector_measurements(detector_measurements, time_str, max_points, aggregation)
+            for detector_measurement, result in zip(detector_measurements, results):
+                yield "".join([to_ndjson_line(detector_measurement, measurement) for measurement in result["measurements"]])
+            return
+
+        # Recent time ranges are answered from the in memory hot window, which is bounded anyway
+        start = get_hot_window_start(time_str)
+        if start is not None:
+            for detector_measurement in detector_measurements:
+                measurements = HOT_WINDOW.get_measurements(detector_measurement.id, detector_measurement.index, start)
+                yield "".join([to_ndjson_line(detector_measurement, measurement) for measurement in measurements])
+            return
+
+        detectors_by_key = {(detector_measurement.id, str(detector_measurement.index)): detector_measurement for detector_measurement in detector_measurements}
+        query = create_detector_measurements_query(detectors_by_key.keys(), time_str)
+        # Includes the time the client took to read the lines
+        start = time.perf_counter()
+        number_of_lines = 0
+        try:
+            async for lines in QUERY_EXECUTOR.stream("detector_measurements", lambda: iter_detector_measurement_lines(query, detectors_by_key)):
+                number_of_lines += len(lines)
+                yield "".join(lines)
+        except Exception as error:
+            observe_query("detector_measurements", query, time.perf_counter() - start, number_of_lines, error)
+            raise
+        observe_query("detector_measurements", query, time.perf_counter() - start, number_of_lines)
+    except Exception as error:
+        # The status was already sent, the stream simply ends early
+        print(f"Failed to stream detector measurements because {error}")
+
+def format_detector_measurements(request, detector_measurements, results):
+    # Clients can ask for a columnar representation via the Accept header (see columnar.py)
+    response_format = columnar.negotiate(request.headers.get("accept"))
+    if response_format == columnar.COLUMNAR_JSON:
+        content = columnar.encode_json(columnar.detector_measurements_to_columnar(detector_measurements, results))
+    elif response_format == columnar.ARROW:
+        content = columnar.detector_measurements_to_arrow(detector_measurements, results)
+    else:
+        return results
+    return Response(content=content, media_type=columnar.MEDIA_TYPES[response_format], headers={"Vary": "Accept"})
+
+def format_cantons_number_of_errors(request, results):
+    response_format = columnar.negotiate(request.headers.get("accept"))
+    if response_format == columnar.COLUMNAR_JSON:
+        content = columnar.encode_json(columnar.cantons_number_of_errors_to_columnar(results))
+    elif response_format == columnar.ARROW:
+        content = columnar.cantons_number_of_errors_to_arrow(results)
+    else:
+        return results
+    return Response(content=content, media_type=columnar.MEDIA_TYPES[response_format], headers={"Vary": "Accept"})
+
+async def query_detector_measurements(detector_measurements, time_str, max_points=None, aggregation=downsampling.DEFAULT_AGGREGATION):
+    # Returns the measurements of every detector, reduced to at most max_points per detector if given
+    window = None
+    if max_points is not None:
+        now = time.time_ns()
+        window = downsampling.get_window(downsampling.parse_start(time_str, now), now, max_points)
+
+    # Recent time ranges are answered from the in memory hot window
+    start = get_hot_window_start(time_str)
+    if start is not None:
+        results = [{
+            "id": detector_measurement.id,
+            "name": detector_measurement.name,
+            "measurements": HOT_WINDOW.get_measurements(detector_measurement.id, detector_measurement.index, start)
+        } for detector_measurement in detector_measurements]
+        return downsample_detector_measurements(results, max_points, aggregation, window)
+
+    # Sort the rows of the single query back into the individual detectors
+    measurements_by_detector = {}
+    for detector_measurement in detector_measurements:
+        measurements_by_detector[(detector_measurement.id, str(detector_measurement.index))] = []
+    # Aggregating is left to InfluxDB so only the aggregated points have to be transferred
+    aggregate_in_db = window is not None and aggregation != downsampling.LTTB
+    if aggregate_in_db:
+        query = create_downsampled_detector_measurements_query(measurements_by_detector.keys(), time_str, window, aggregation)
+    else:
+        query = create_detector_measurements_query(measurements_by_detector.keys(), time_str)
+    records = await query_records("detector_measurements", query)
+    for record in records:
+        measurements = measurements_by_detector.get((record["id"], record["index"]))
+        if measurements is None:
+            continue
+        if aggregate_in_db:
+            measurements.append(downsampling.record_to_measurement(record))
+        else:
+            measurements.append(storage_schema.record_to_measurement(STORAGE_SCHEMA, record))
+
+    detector_measurements_result = []
+    for detector_measurement in detector_measurements:
+        result = {
+            "id": detector_measurement.id,
+            "name": detector_measurement.name,
+            "measurements": measurements_by_detector[(detector_measurement.id, str(detector_measurement.index))]
+        }
+        detector_measurements_result.append(result)
+    if aggregate_in_db:
+        return detector_measurements_result
+    return downsample_detector_measurements(detector_measurements_result, max_points, aggregation, window)
+
+def downsample_detector_measurements(results, max_points, aggregation, window):
+    if max_points is None:
+        return results
+    for result in results:
+        result["measurements"] = downsampling.downsample(result["measurements"], max_points, aggregation, window)
+    return results
+
 @app.post("/detector_measurements")
-async def post_detector_measurements(detectorMeasurementsBody: DetectorMeasurementsBody):
+async def post_detector_measurements(detectorMeasurementsBody: DetectorMeasurementsBody, request: Request):
     try:
-        api = db_client.query_api()
         detector_measurements = detectorMeasurementsBody.detectorMeasurements
         time_str = get_value_or_default(detectorMeasurementsBody.time, DEFAULT_TIME_RANGE)
-
-        detector_measurements_result = []
-        for detector_measurement in detector_measurements:
-            id = detector_measurement.id
-            name = detector_measurement.name
-            index = detector_measurement.index
-            query = """
-                from(bucket: "%bucket%")
-                  |> range(start: %time%)
-                  |> filter(fn: (r) => r["_measurement"] == "detector_measurement")
-                  |> filter(fn: (r) => r["index"] == "%index%")
-                  |> filter(fn: (r) => r["id"] == "%id%")
-                  |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
-            """
-            query = query.replace("%time%", time_str).replace("%index%", str(index)).replace("%id%", id).replace("%bucket%", BUCKET)
-            print(f"Sending the following query {query}")
-            records = api.query_stream(query)
-            measurements = []
-            for record in records:
-                measurement = {
-                    "value": record["value"],
-                    "time": record["_time"],
-                    "numberOfInputValuesUsed": record["numberOfInputValuesUsed"],
-                    "errorReason": None if record["errorReason"] == "none" else record["errorReason"],
-                    "hasError": False if record["hasError"] == "False" else True
-                }
-                measurements.append(measurement)
-            result = {
-                "id": id,
-                "name": name,
-                "measurements": measurements
-            }
-            detector_measurements_result.append(result)
-        return detector_measurements_result
+        max_points = detectorMeasurementsBody.maxPoints
+        aggregation = get_value_or_default(detectorMeasurementsBody.aggregation, downsampling.DEFAULT_AGGREGATION)
+        if len(detector_measurements) == 0:
+            # No lines at all for NDJSON
+            return Response(content="", media_type=NDJSON_MEDIA_TYPE) if wants_ndjson(request) else []
+        # Clients asking for NDJSON get the measurements streamed one per line as they arrive
+        if wants_ndjson(request):
+            return StreamingResponse(stream_detector_measurements(detector_measurements, time_str, max_points, aggregation), media_type=NDJSON_MEDIA_TYPE)
+        results = await query_detector_measurements(detector_measurements, time_str, max_points, aggregation)
+        return format_detector_measurements(request, detector_measurements, results)
     except Exception as error:
         print(error)
         print(f"Failed to get detector measurements because {error}")
@@ -392,116 +995,204 @@ async def post_detector_measurements(detectorMeasurementsBody: DetectorMeasureme
 async def get_cantons():
     return CANTONS
 
+@app.get("/ingest/stats")
+async def get_ingest_stats():
+    stats = {**LAST_SEEN_INDEX.get_stats(), "leader": INGEST_LEADER_LOCK.get_stats(), "pipeline": INGEST_PIPELINE.get_stats()}
+    if SHARED_INGEST_STATE is not None:
+        stats["shared"] = SHARED_INGEST_STATE.get_stats()
+    return stats
+
+async def query_cantons_total_number_of_errors(canton, time_str):
+    has_canton = canton != None and canton != "" and canton != ALL_CANTONS
+
+    # Recent time ranges are answered from the in memory hot window
+    start = get_hot_window_start(time_str)
+    if start is not None:
+        number_of_errors_per_canton = HOT_WINDOW.get_number_of_errors_per_canton(start)
+        return [{
+            "canton": canton_name,
+            "numberOfErrors": number_of_errors
+        } for canton_name, number_of_errors in sorted(number_of_errors_per_canton.items(), key=sort_by_canton) if not has_canton or canton_name == canton]
+
+    query = ""
+    rollup_query = create_rollup_query(time_str, rollups.CANTON_ERROR_ROLLUP, ["canton"], canton if has_canton else None)
+    if rollup_query is not None:
+        query = rollup_query[0] + """
+            |> group(columns: ["canton"])
+            |> sum()
+        """
+    elif has_canton:
+        query = """
+            from(bucket: "%bucket%")
+                |> range(start: %time%)
+                %error_filter%
+                |> filter(fn: (r) => r["canton"] == "%canton%")
+                |> group(columns: ["canton"])
+                |> count()
+        """
+        query = query.replace("%canton%", canton)
+    else:
+        # No canton specified
+        query = """
+            from(bucket: "%bucket%")
+                |> range(start: %time%)
+                %error_filter%
+                |> group(columns: ["canton"])
+                |> count()
+        """
+    query = query.replace("%time%", time_str).replace("%error_filter%", ERROR_FILTER).replace("%bucket%", BUCKET)
+    cantons_number_of_errors = []
+    records = await query_records("cantons_total_number_of_errors", query)
+    for record in records:
+        canton_number_of_errors = {
+            "canton": record["canton"],
+            "numberOfErrors": record["_value"],
+        }
+        cantons_number_of_errors.append(canton_number_of_errors)
+    return cantons_number_of_errors
+
 @app.post("/cantons/total_number_of_errors")
 async def post_cantons_total_number_of_errors(cantonTotalNumberOfErrorsBody: CantonTotalNumberOfErrorsBody):
+    canton = cantonTotalNumberOfErrorsBody.canton
+    time_str = get_value_or_default(cantonTotalNumberOfErrorsBody.time, DEFAULT_TIME_RANGE)
     try:
-        api = db_client.query_api()
-        has_canton = cantonTotalNumberOfErrorsBody.canton != None and cantonTotalNumberOfErrorsBody.canton != ""
-        canton = cantonTotalNumberOfErrorsBody.canton
-        time_str = get_value_or_default(cantonTotalNumberOfErrorsBody.time, DEFAULT_TIME_RANGE)
-
-        query = ""
-        if has_canton:
-            query = """
-                from(bucket: "%bucket%")
-                    |> range(start: %time%)
-                    |> filter(fn: (r) => r["_measurement"] == "detector_measurement")
-                    |> filter(fn: (r) => r["hasError"] == "True")
-                    |> filter(fn: (r) => r["canton"] == "%canton%")
-                    |> group(columns: ["canton"])
-                    |> count()
-            """
-            query = query.replace("%canton%", canton)
-        else:
-            # No canton specified
-            query = """
-                from(bucket: "%bucket%")
-                    |> range(start: %time%)
-                    |> filter(fn: (r) => r["_measurement"] == "detector_measurement")
-                    |> filter(fn: (r) => r["hasError"] == "True")
-                    |> group(columns: ["canton"])
-                    |> count()
-            """
-        query = query.replace("%time%", time_str).replace("%bucket%", BUCKET)
-        print(f"Sending the following query {query}")
-        cantons_number_of_errors = []
-        records = api.query_stream(query)
-        for record in records:
-            canton_number_of_errors = {
-                "canton": record["canton"],
-                "numberOfErrors": record["_value"],
-            }
-            cantons_number_of_errors.append(canton_number_of_errors)
-        return cantons_number_of_errors
+        return await RESPONSE_CACHE.get_or_compute(("cantons_total_number_of_errors", canton or "", time_str),
+                                                   lambda: query_cantons_total_number_of_errors(canton, time_str))
     except Exception as error:
         print(f"Failed to get total number of errors per canton because {error}")
         return []
 
+async def query_cantons_number_of_errors(canton, time_str, bin_size):
+    # Recent time ranges are answered from the in memory hot window
+    start = get_hot_window_start(time_str)
+    bin_size_nanoseconds = parse_flux_duration(bin_size)
+    if start is not None and bin_size_nanoseconds is not None:
+        stop = time.time_ns()
+        number_of_errors = HOT_WINDOW.get_windowed_number_of_errors_per_canton(start, bin_size_nanoseconds, stop)
+        measurements_per_canton = {}
+        for (canton_name, window_stop), count in sorted(number_of_errors.items(), key=lambda item: (sort_by_canton(item[0]), item[0][1])):
+            if canton != ALL_CANTONS and canton_name != canton:
+                continue
+            measurements_per_canton.setdefault(canton_name, []).append({
+                "numberOfErrors": count,
+                "time": to_datetime(window_stop)
+            })
+        return [{"name": canton_name, "measurements": measurements} for canton_name, measurements in measurements_per_canton.items()]
+
+    query = ""
+    # Pick the coarsest rollup the bin size is a multiple of, the bins are then summed up into the requested ones
+    rollup_query = None
+    if bin_size_nanoseconds is not None:
+        rollup_query = create_rollup_query(time_str, rollups.CANTON_ERROR_ROLLUP, ["canton"], None if canton == ALL_CANTONS else canton, bin_size_nanoseconds)
+    if rollup_query is not None:
+        query, start, stop = rollup_query
+        query += """
+            |> range(start: %start%, stop: %stop%)
+            |> group(columns: ["canton"])
+            |> aggregateWindow(every: %bin_size%, fn: sum, createEmpty: false)
+            |> sort(columns: ["_time"])
+        """
+        query = query.replace("%start%", rollups.format_time(start)).replace("%stop%", rollups.format_time(stop))
+    elif canton == ALL_CANTONS:
+        query = """
+        from(bucket: "%bucket%")
+            |> range(start: %time%)
+            %error_filter%
+            |> group(columns: ["canton"])
+            |> aggregateWindow(every: %bin_size%, fn: count, createEmpty: false)
+        """
+    else:
+        # Specific canton specified
+        query = """
+             from(bucket: "%bucket%")
+                |> range(start: %time%)
+                %error_filter%
+                |> filter(fn: (r) => r["canton"] == "%canton%")
+                |> group(columns: ["canton"])
+                |> aggregateWindow(every: %bin_size%, fn: count, createEmpty: false)
+        """
+        query = query.replace("%canton%", canton)
+
+    query = query.replace("%time%", time_str).replace("%bin_size%", bin_size).replace("%error_filter%", ERROR_FILTER).replace("%bucket%", BUCKET)
+    cantons_number_of_errors = []
+    tables = await query_tables("cantons_number_of_errors", query)
+
+    # We get one table per canton, each row is the number of errors within one bin (stamped with the end of the bin)
+    for table in tables:
+        # We can get the canton from any of the records as it is ensure that all records in the same
+        # Table do have the same canton (because we grouped by it)
+        canton_result = {
+            "name": table.records[0]["canton"]
+        }
+        measurements = []
+        for record in table.records:
+            measurement = {
+                "numberOfErrors": record["_value"],
+                "time": record["_time"]
+            }
+            measurements.append(measurement)
+
+        canton_result["measurements"] = measurements
+        cantons_number_of_errors.append(canton_result)
+    return cantons_number_of_errors
 
 @app.post("/cantons/number_of_errors")
-async def post_cantons_number_of_errors(cantonNumberOfErrorsBody: CantonNumberOfErrorsBody):
+async def post_cantons_number_of_errors(cantonNumberOfErrorsBody: CantonNumberOfErrorsBody, request: Request):
     try:
-        api = db_client.query_api()
         has_canton = cantonNumberOfErrorsBody.canton != None and cantonNumberOfErrorsBody.canton != ""
-        canton = cantonNumberOfErrorsBody.canton.strip()
-        time_str = get_value_or_default(cantonNumberOfErrorsBody.time, DEFAULT_TIME_RANGE)
-        bin_size  = cantonNumberOfErrorsBody.binSize
-
-        query = ""
         if not has_canton:
             return []
-        
-        if canton == ALL_CANTONS:
-            query = """
-            from(bucket: "%bucket%")
-                |> range(start: %time%)
-                |> filter(fn: (r) => r["_measurement"] == "detector_measurement")
-                |> filter(fn: (r) => r["hasError"] == "True")
-                |> window(every: %bin_size%)
-                |> count()
-                |> group(columns: ["_time", "canton"])
-                |> duplicate(column: "_stop", as: "_time")
-                |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
-            """
-        else:
-            # Specific canton specified
-            query = """
-                 from(bucket: "%bucket%")
-                    |> range(start: %time%)
-                    |> filter(fn: (r) => r["_measurement"] == "detector_measurement")
-                    |> filter(fn: (r) => r["hasError"] == "True")
-                    |> filter(fn: (r) => r["canton"] == "%canton%")
-                    |> window(every: %bin_size%)
-                    |> count()
-                    |> group(columns: ["_time", "canton"])
-                    |> duplicate(column: "_stop", as: "_time")
-                    |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
-            """
-            query = query.replace("%canton%", canton)
-
-        query = query.replace("%time%", time_str).replace("%bin_size%", bin_size).replace("%bucket%", BUCKET)
-        print(f"Sending the following query {query}")
-        cantons_number_of_errors = []
-        tables = api.query(query)
-        
-        # We get a table result because we window by the bin size
-        for table in tables:
-            # We can get the canton from any of the records as it is ensure that all records in the same
-            # Table do have the same canton (because we grouped by it)
-            canton_result = {
-                "name": table.records[0]["canton"]
-            }
-            measurements = []
-            for record in table.records:
-                measurement = {
-                    "numberOfErrors": record["value"],
-                    "time": record["_time"]
-                }
-                measurements.append(measurement)
-            
-            canton_result["measurements"] = measurements
-            cantons_number_of_errors.append(canton_result)
-        return cantons_number_of_errors
+        canton = cantonNumberOfErrorsBody.canton.strip()
+        time_str = get_value_or_default(cantonNumberOfErrorsBody.time, DEFAULT_TIME_RANGE)
+        bin_size = cantonNumberOfErrorsBody.binSize.strip()
+        cantons_number_of_errors = await RESPONSE_CACHE.get_or_compute(("cantons_number_of_errors", canton, time_str, bin_size),
+                                                                       lambda: query_cantons_number_of_errors(canton, time_str, bin_size))
+        return format_cantons_number_of_errors(request, cantons_number_of_errors)
     except Exception as error:
         print(f"Failed to get number of errors per canton because {error}")
-        return []
\ No newline at end of file
+        return []
+
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return RESPONSE_CACHE.get_stats()
+
+@app.get("/query/stats")
+async def get_query_stats():
+    return QUERY_EXECUTOR.get_stats()
+
+def parse_detector_key(detector):
+    # e.g CH:0002.01:11 is detector CH:0002.01 with index 11
+    detector_id, _, index = detector.rpartition(":")
+    return (detector_id, int(index))
+
+@app.get("/events")
+async def get_events(detector: list[str] = Query(default=[])):
+    # Server sent events with the changes of every ingest cycle (see push.py), the newest points are
+    # pushed for the detectors passed as e.g /events?detector=CH:0002.01:11&detector=CH:0002.02:11
+    try:
+        detector_keys = [parse_detector_key(d) for d in detector[:PUSH_MAX_DETECTORS_PER_SUBSCRIPTION]]
+    except ValueError:
+        return Response(content="Detectors must be given as <id>:<index>", status_code=400)
+    # Tell proxies like nginx not to buffer the events
+    return StreamingResponse(PUSH_HUB.events(detector_keys), media_type=EVENT_STREAM_MEDIA_TYPE,
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/events/stats")
+async def get_events_stats():
+    return PUSH_HUB.get_stats()
+
+@app.get("/spool/stats")
+async def get_spool_stats():
+    if SPOOL_DRAINER is None:
+        return {}
+    return SPOOL_DRAINER.get_stats()
+
+@app.get("/metrics")
+async def get_metrics():
+    return Response(content=METRICS.render(), media_type=metrics.TEXT_MEDIA_TYPE)
+
+@app.get("/hot_window/stats")
+async def get_hot_window_stats():
+    if HOT_WINDOW is None:
+        return {}
+    return HOT_WINDOW.get_stats()
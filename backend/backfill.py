@@ -0,0 +1,231 @@
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from dotenv import dotenv_values
+import argparse
+import gzip
+import json
+import os
+import sys
+import tarfile
+import time
+import datex2
+import line_protocol
+import mst_snapshot
+import rollups
+import storage_schema
+
+# Loads archived MSR pull responses into InfluxDB, e.g
+#
+#   python backfill.py /archive/msr/2023-11 --workers 4
+#   python backfill.py /archive/msr-2023-11.tar.gz --rollups
+#
+# A directory is read recursively (files ending with .xml or .xml.gz in name order), a tarball in archive
+# order. The files are parsed on a process pool and every point is stamped with the measurement time of
+# its site (measurements without one are skipped). Only a bounded number of files is parsed ahead of
+# the writes so memory stays flat however large the archive is. After every few files the progress is
+# stored in a checkpoint, started again with the same source the backfill continues from there. Writing a
+# file twice simply overwrites its points.
+
+ENV_FILE_PATH = "./.env-local"
+MST_FILE_PATH = "./data/mst.json"
+MST_SNAPSHOT_FILE_PATH = "./data/mst.snapshot"
+DEFAULT_CHECKPOINT_FILE_PATH = "./data/backfill.checkpoint.json"
+MSR_FILE_EXTENSIONS = (".xml", ".xml.gz")
+
+def ensure_file(file_path):
+    if not os.path.isfile(file_path):
+        sys.exit(f"Expected file '{file_path}' but was not found...")
+
+def load_secrets():
+    ensure_file(ENV_FILE_PATH)
+    return dotenv_values(ENV_FILE_PATH)
+
+def iter_directory(directory):
+    file_paths = []
+    for root, _, file_names in os.walk(directory):
+        file_paths += [os.path.join(root, file_name) for file_name in file_names if file_name.endswith(MSR_FILE_EXTENSIONS)]
+    for file_path in sorted(file_paths):
+        yield os.path.relpath(file_path, directory), lambda file_path=file_path: read_file(file_path)
+
+def read_file(file_path):
+    with open(file_path, "rb") as f:
+        return f.read()
+
+def iter_tarball(tarball_path):
+    # Streamed, a compressed tarball is only decompressed once
+    with tarfile.open(tarball_path, "r|*") as tarball:
+        for member in tarball:
+            if member.isfile() and member.name.endswith(MSR_FILE_EXTENSIONS):
+                yield member.name, lambda member=member: tarball.extractfile(member).read()
+
+def iter_msr_files(source):
+    # Yields the name of every file together with a function reading it, files which were completed
+    # before a resume are never read
+    if os.path.isdir(source):
+        return iter_directory(source)
+    if os.path.isfile(source) and tarfile.is_tarfile(source):
+        return iter_tarball(source)
+    sys.exit(f"Expected a directory or tarball of MSR files but got '{source}'...")
+
+def load_checkpoint(checkpoint_file_path, source):
+    if not os.path.isfile(checkpoint_file_path):
+        return None
+    with open(checkpoint_file_path, "r") as f:
+        checkpoint = json.load(f)
+    if checkpoint["source"] != source:
+        sys.exit(f"Checkpoint '{checkpoint_file_path}' belongs to '{checkpoint['source']}', pass --restart to start over...")
+    return checkpoint
+
+def save_checkpoint(checkpoint_file_path, checkpoint):
+    temporary_file_path = f"{checkpoint_file_path}.tmp"
+    with open(temporary_file_path, "w") as f:
+        json.dump(checkpoint, f, indent=4)
+    os.replace(temporary_file_path, checkpoint_file_path)
+
+# State of a worker process, see init_worker
+WORKER = {}
+
+def init_worker(schema):
+    compiled_mst, _ = mst_snapshot.load_compiled_mst(MST_SNAPSHOT_FILE_PATH, MST_FILE_PATH)
+    WORKER["detectorIdToCanton"] = compiled_mst["detectorIdToCanton"]
+    WORKER["detectorIdToStationId"] = compiled_mst["detectorIdToStationId"]
+    WORKER["tagSets"] = line_protocol.create_tag_sets(schema, compiled_mst["mst"])
+
+def convert_file(name, content):
+    # Runs on the process pool. Returns the line protocol of the file (joined, which is much cheaper to
+    # send back than a list), its number of points and skipped measurements and the range of its points.
+    if name.endswith(".gz"):
+        content = gzip.decompress(content)
+    msr = datex2.parse_msr(content, WORKER["detectorIdToCanton"], WORKER["detectorIdToStationId"])
+    detector_measurements = [detector_measurement for detector_measurement in msr["detector_measurements"] if detector_measurement.get("time") is not None]
+    number_of_skipped = len(msr["detector_measurements"]) - len(detector_measurements)
+    lines = line_protocol.detector_measurements_to_lines(detector_measurements, WORKER["tagSets"])
+    timestamps = [line_protocol.parse_timestamp(time_str) for time_str in set([detector_measurement["time"] for detector_measurement in detector_measurements])]
+    if len(timestamps) == 0:
+        return "", 0, number_of_skipped, None, None
+    return "\n".join(lines), len(lines), number_of_skipped, min(timestamps), max(timestamps)
+
+def extend_range(checkpoint, start, stop):
+    if start is None:
+        return
+    checkpoint["start"] = start if checkpoint["start"] is None else min(checkpoint["start"], start)
+    checkpoint["stop"] = stop if checkpoint["stop"] is None else max(checkpoint["stop"], stop)
+
+def backfill(source, workers, batch_size, max_pending_files, checkpoint_file_path, checkpoint_every, restart, dry_run, build_rollups):
+    source = os.path.abspath(source)
+    secrets = load_secrets()
+    bucket = secrets["DOCKER_INFLUXDB_INIT_BUCKET"]
+    schema = storage_schema.ensure_schema(secrets.get("INFLUXDB_STORAGE_SCHEMA") or storage_schema.LEGACY)
+
+    checkpoint = None if restart else load_checkpoint(checkpoint_file_path, source)
+    if checkpoint is None:
+        checkpoint = {"source": source, "completedFiles": 0, "lastFile": None, "numberOfPoints": 0, "start": None, "stop": None}
+    elif checkpoint["completedFiles"] > 0:
+        print(f"Resuming after {checkpoint['completedFiles']} files (last one '{checkpoint['lastFile']}')...")
+
+    db_client = None
+    write_api = None
+    if not dry_run:
+        db_client = InfluxDBClient(url=secrets["INFLUXDB_URL"], token=secrets["DOCKER_INFLUXDB_INIT_ADMIN_TOKEN"],
+                                   org=secrets["DOCKER_INFLUXDB_INIT_ORG"], enable_gzip=True, timeout=60_000)
+        write_api = db_client.write_api(write_options=SYNCHRONOUS)
+
+    # Lines of completely parsed files which are not written yet
+    pending_lines = []
+    number_of_pending_points = 0
+
+    def write_pending():
+        nonlocal pending_lines, number_of_pending_points
+        if len(pending_lines) > 0 and not dry_run:
+            write_api.write(bucket=bucket, org=db_client.org, record=pending_lines, write_precision=WritePrecision.NS)
+        pending_lines = []
+        number_of_pending_points = 0
+
+    print(f"Backfilling '{source}' into bucket '{bucket}' ({schema} schema) with {workers} workers...")
+    backfill_start = time.perf_counter()
+    number_of_points = 0
+    number_of_files = 0
+    number_of_skipped = 0
+    last_file = checkpoint["lastFile"]
+
+    def report():
+        duration = time.perf_counter() - backfill_start
+        print(f"{checkpoint['completedFiles']} files, {checkpoint['numberOfPoints']} points "
+              f"({number_of_files / duration:.1f} files/s, {number_of_points / duration:.0f} points/s), last '{last_file}'")
+
+    def complete(name, future):
+        nonlocal number_of_pending_points, number_of_points, number_of_files, number_of_skipped, last_file
+        lines, points, skipped, start, stop = future.result()
+        if points > 0:
+            pending_lines.append(lines)
+            number_of_pending_points += points
+        if number_of_pending_points >= batch_size:
+            write_pending()
+        number_of_points += points
+        number_of_files += 1
+        number_of_skipped += skipped
+        last_file = name
+        checkpoint["numberOfPoints"] += points
+        extend_range(checkpoint, start, stop)
+        if number_of_files % checkpoint_every == 0:
+            # Everything up to this file has to be written before it counts as completed
+            write_pending()
+            checkpoint["completedFiles"] += checkpoint_every
+            checkpoint["lastFile"] = name
+            if not dry_run:
+                save_checkpoint(checkpoint_file_path, checkpoint)
+            report()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(schema,)) as pool:
+            pending_files = deque()
+            for position, (name, read) in enumerate(iter_msr_files(source)):
+                if position < checkpoint["completedFiles"]:
+                    if position == checkpoint["completedFiles"] - 1 and name != checkpoint["lastFile"]:
+                        sys.exit(f"Expected file '{checkpoint['lastFile']}' at position {position} but found '{name}', "
+                                 "the source changed since the checkpoint was written. Pass --restart to start over...")
+                    continue
+                pending_files.append((name, pool.submit(convert_file, name, read())))
+                # The files are completed in order, at most max_pending_files are parsed ahead
+                while len(pending_files) >= max_pending_files:
+                    complete(*pending_files.popleft())
+            while len(pending_files) > 0:
+                complete(*pending_files.popleft())
+        write_pending()
+        if number_of_files % checkpoint_every != 0:
+            checkpoint["completedFiles"] += number_of_files % checkpoint_every
+            checkpoint["lastFile"] = last_file
+            if not dry_run:
+                save_checkpoint(checkpoint_file_path, checkpoint)
+            report()
+        if number_of_skipped > 0:
+            print(f"Skipped {number_of_skipped} measurements without a measurement time...")
+
+        if build_rollups and not dry_run and checkpoint["start"] is not None:
+            # The rollup tasks only look at the last minutes, the backfilled range has to be built once
+            error_filter = storage_schema.ERROR_FILTERS[schema]
+            rollup_bucket = secrets.get("INFLUXDB_ROLLUP_BUCKET") or f"{bucket}_rollups"
+            rollups.ensure_rollup_tasks(db_client, bucket, rollup_bucket, error_filter)
+            rollups.backfill_rollups(db_client, bucket, rollup_bucket, error_filter, checkpoint["start"], checkpoint["stop"] + 1)
+    finally:
+        if write_api is not None:
+            write_api.close()
+            db_client.close()
+    print(f"Done, {'parsed' if dry_run else 'wrote'} {checkpoint['numberOfPoints']} points of {checkpoint['completedFiles']} files.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill InfluxDB from archived MSR pull responses")
+    parser.add_argument("source", help="directory or tarball of MSR XML files (optionally gzipped)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of parsing processes")
+    parser.add_argument("--batch-size", type=int, default=50_000, help="points written at once")
+    parser.add_argument("--max-pending-files", type=int, default=None, help="files parsed ahead of the writes, defaults to twice the workers")
+    parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT_FILE_PATH)
+    parser.add_argument("--checkpoint-every", type=int, default=20, help="files between two checkpoints")
+    parser.add_argument("--restart", action="store_true", help="ignore an existing checkpoint")
+    parser.add_argument("--dry-run", action="store_true", help="only parse, do not write anything")
+    parser.add_argument("--rollups", action="store_true", help="build the error rollups of the backfilled range afterwards")
+    arguments = parser.parse_args()
+    backfill(arguments.source, max(arguments.workers, 1), arguments.batch_size, arguments.max_pending_files or 2 * max(arguments.workers, 1),
+             arguments.checkpoint, max(arguments.checkpoint_every, 1), arguments.restart, arguments.dry_run, arguments.rollups)
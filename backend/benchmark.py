@@ -0,0 +1,821 @@
+# etree for fast xml parsing
+from lxml import etree as etree_lxml
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import asyncio
+import platform
+import statistics
+import shutil
+import subprocess
+import tempfile
+import tracemalloc
+import multiprocessing
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from random import Random
+from influxdb_client import Point
+import datex2
+import line_protocol
+import mst_snapshot
+import storage_schema
+import synthetic_datex2
+from stub_influxdb_server import StubInfluxDB
+from write_spool import WriteSpool
+from datex2 import detector_id_to_station_id
+from hot_window import to_datetime
+
+MST_FILE_PATH = "./data/mst.json"
+MSR_SAMPLE_FILE_PATH = "./data/msr_sample.xml"
+
+# The synthetic documents are built from the real topology scaled by the command line options (see
+# synthetic_datex2.py), the parsers are additionally measured with ten times the stations
+SYNTHETIC_SCALES = [1, 10]
+SYNTHETIC_MEASUREMENT_TIME = line_protocol.parse_timestamp("2023-11-27T15:36:00Z")
+# Set from the command line, None keeps the real number of stations, detectors or indices
+TOPOLOGY_OPTIONS = {"stations": None, "detectors": None, "indices": None, "errorRate": synthetic_datex2.DEFAULT_ERROR_RATE}
+NUMBER_OF_RUNS = 5
+
+# Results are stored per commit so two commits can be compared with --compare
+BENCHMARK_RESULTS_DIRECTORY = "./data/benchmark_results"
+# Metrics where a smaller value is better, respectively a larger one. Every other value is informational.
+LOWER_IS_BETTER_SUFFIXES = ("illiseconds", "Bytes")
+HIGHER_IS_BETTER_SUFFIXES = ("PerSecond",)
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+
+# The app benchmarks import the backend in process. It ingests this many minutes of synthetic pulls
+# into the stub InfluxDB (or with --influxdb a temporary bucket of the configured one), then every
+# endpoint is asked for a range answered by the hot window and one answered by InfluxDB.
+APP_NUMBER_OF_CYCLES = 60
+APP_BENCHMARK_BUCKET = "benchmark_app"
+HOT_WINDOW_TIME_RANGE = "-30m"
+INFLUXDB_TIME_RANGE = "-2h"
+NUMBER_OF_DETECTORS_PER_REQUEST = 10
+
+ENV_FILE_PATH = "./.env-local"
+# One hour of national pulls where every sensor reports an error in about 2% of the pulls
+SCHEMA_NUMBER_OF_CYCLES = 60
+SCHEMA_ERROR_PROBABILITY = 0.02
+SCHEMA_BENCHMARK_BUCKET = "benchmark_storage_schema"
+SCHEMA_CARDINALITY_QUERY = """
+    import "influxdata/influxdb"
+    influxdb.cardinality(bucket: "%bucket%", start: -1d, predicate: (r) => r["_measurement"] == "%measurement%")
+"""
+SCHEMA_ERROR_QUERY = """
+    from(bucket: "%bucket%")
+        |> range(start: -1d)
+        %error_filter%
+        |> group(columns: ["canton"])
+        |> count()
+"""
+
+def ensure_file(file_path):
+    if not os.path.isfile(file_path):
+        sys.exit(f"Expected file '{file_path}' but was not found...")
+
+def load_mst():
+    ensure_file(MST_FILE_PATH)
+    with open(MST_FILE_PATH, "r") as f:
+        return json.load(f)
+
+def create_topology(scale=1):
+    # Synthetic topology of the command line options with scale times the stations
+    mst = load_mst()
+    number_of_stations = TOPOLOGY_OPTIONS["stations"] or len(mst)
+    return synthetic_datex2.create_topology(mst, number_of_stations * scale, TOPOLOGY_OPTIONS["detectors"], TOPOLOGY_OPTIONS["indices"])
+
+def create_detector_id_to_canton_mapping(topology):
+    return {detector["id"]: station["canton"] for station in topology for detector in station["detectors"]}
+
+def create_synthetic_msr(topology, measurement_time=SYNTHETIC_MEASUREMENT_TIME):
+    # Seeded, the same options always produce the same document
+    return synthetic_datex2.create_msr_xml(topology, measurement_time, TOPOLOGY_OPTIONS["errorRate"], Random(synthetic_datex2.DEFAULT_SEED))
+
+def parse_msr_xpath(xml_content, detector_id_to_canton_mapping):
+    # Previous implementation which builds the whole tree and runs one XPath query per field.
+    # Kept here as the reference for both correctness and speed.
+    tree = etree_lxml.fromstring(xml_content)
+    ns = {
+        "dx223": "http://datex2.eu/schema/2/2_0",
+        "xsi": "http://www.w3.org/2001/XMLSchema-instance"
+    }
+
+    site_measurement_nodes = tree.xpath(
+        './/dx223:siteMeasurements',
+        namespaces=ns)
+
+    result = dict()
+    detector_measurements = []
+    for node in site_measurement_nodes:
+        current_detector_measurement = {}
+        current_sensor_measurements = []
+
+        id_node = node.xpath(
+            './/dx223:measurementSiteReference[@id]', namespaces=ns)[0]
+
+        time_node = node.xpath(
+            './/dx223:measurementTimeDefault', namespaces=ns)[0]
+
+        measured_value_nodes = node.xpath(
+            './/dx223:measuredValue[@index]', namespaces=ns)
+
+        for measured_value_node in measured_value_nodes:
+            index = int(measured_value_node.attrib["index"])
+            current_sensor_measurement = {}
+            measurement_kind = measured_value_node.xpath(
+                './/dx223:basicData/@xsi:type', namespaces=ns)[0]
+
+            has_data_error_nodes = measured_value_node.xpath(
+                './/dx223:basicData//dx223:dataError', namespaces=ns)
+
+            measured_value = 0
+            error_reason = None
+            kind = None
+            has_data_error = len(has_data_error_nodes) > 0
+            if has_data_error:
+                error_reason_node = measured_value_node.xpath(
+                    './/dx223:basicData//dx223:reasonForDataError//dx223:value', namespaces=ns)[0]
+                error_reason = error_reason_node.text
+            else:
+                if measurement_kind == "dx223:TrafficFlow":
+                    kind = "trafficFlow"
+                    value_node = measured_value_node.xpath(
+                        './/dx223:basicData//dx223:vehicleFlowRate', namespaces=ns)[0]
+                    measured_value = float(value_node.text)
+                elif measurement_kind == "dx223:TrafficSpeed":
+                    kind = "trafficSpeed"
+                    number_of_input_values_node = measured_value_node.xpath(
+                        './/dx223:basicData//dx223:averageVehicleSpeed[@numberOfInputValuesUsed]', namespaces=ns)[0]
+
+                    number_of_input_values_used = number_of_input_values_node.attrib[
+                        "numberOfInputValuesUsed"]
+                    value_node = measured_value_node.xpath(
+                        './/dx223:basicData//dx223:speed', namespaces=ns)[0]
+                    measured_value = float(value_node.text)
+                    current_sensor_measurement["numberOfInputValuesUsed"] = int(
+                        number_of_input_values_used)
+
+            current_sensor_measurement["value"] = measured_value
+            current_sensor_measurement["hasError"] = has_data_error
+            current_sensor_measurement["errorReason"] = error_reason
+            current_sensor_measurement["index"] = index
+            current_sensor_measurement["kind"] = kind
+
+            current_sensor_measurements.append(current_sensor_measurement)
+
+        detector_id = id_node.attrib["id"]
+        current_detector_measurement["id"] = detector_id
+        current_detector_measurement["time"] = time_node.text
+        current_detector_measurement["sensorMeasurements"] = current_sensor_measurements
+        current_detector_measurement["canton"] = detector_id_to_canton_mapping.get(detector_id, None)
+        current_detector_measurement["stationId"] = detector_id_to_station_id(detector_id)
+
+        detector_measurements.append(current_detector_measurement)
+
+    result["detector_measurements"] = detector_measurements
+    return result
+
+def _measure_peak_memory(parser, xml_content, detector_id_to_canton_mapping, queue):
+    # Runs in a fresh process so the result is not influenced by earlier runs.
+    # tracemalloc only sees Python allocations, libxml2 allocates its tree natively,
+    # therefore the resident set size high water mark is reported as well.
+    rss_before = _read_proc_status("VmRSS")
+    _reset_peak_rss()
+    tracemalloc.start()
+    parser(xml_content, detector_id_to_canton_mapping)
+    _, peak_python = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    peak_rss = _read_proc_status("VmHWM")
+    queue.put((peak_python, None if rss_before is None or peak_rss is None else peak_rss - rss_before))
+
+def _read_proc_status(key):
+    # Returns the value in bytes or None if not available (e.g not running on Linux)
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(key + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def _reset_peak_rss():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def measure_peak_memory(parser, xml_content, detector_id_to_canton_mapping):
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure_peak_memory, args=(parser, xml_content, detector_id_to_canton_mapping, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+def measure_throughput(parser, xml_content, detector_id_to_canton_mapping):
+    durations = []
+    for _ in range(NUMBER_OF_RUNS):
+        start = time.perf_counter()
+        result = parser(xml_content, detector_id_to_canton_mapping)
+        durations.append(time.perf_counter() - start)
+    best = min(durations)
+    number_of_sites = len(result["detector_measurements"])
+    number_of_values = sum(len(d["sensorMeasurements"]) for d in result["detector_measurements"])
+    return {
+        "seconds": best,
+        "sitesPerSecond": number_of_sites / best,
+        "valuesPerSecond": number_of_values / best,
+        "megabytesPerSecond": len(xml_content) / best / 1e6,
+    }
+
+def detector_measurements_to_dicts(msr, timestamp):
+    # Previous way of writing, one dictionary per point which the InfluxDB client serializes
+    detector_measurements = []
+    for detector_measurement in msr["detector_measurements"]:
+        for sensor_measurement in detector_measurement["sensorMeasurements"]:
+            data = {
+                "measurement": "detector_measurement",
+                "tags": {
+                    "id": detector_measurement["id"],
+                    "index": int(sensor_measurement["index"]),
+                    "hasError": bool(sensor_measurement["hasError"]),
+                    "canton": detector_measurement.get("canton", "none"),
+                    "stationId": detector_measurement.get("stationId", "none"),
+                    "kind": "none" if sensor_measurement["kind"] == None else sensor_measurement["kind"]
+                },
+                "fields": {
+                    "value": float(sensor_measurement["value"]),
+                    "numberOfInputValuesUsed": int(sensor_measurement.get("numberOfInputValuesUsed", 0)),
+                    "errorReason": "none" if sensor_measurement["errorReason"] == None else sensor_measurement["errorReason"]
+                },
+                "time": timestamp
+            }
+            detector_measurements.append(data)
+    return detector_measurements
+
+def serialize_dicts(msr, timestamp):
+    # This is what the client does with dictionaries before sending them
+    return [Point.from_dict(data).to_line_protocol() for data in detector_measurements_to_dicts(msr, timestamp)]
+
+def format_bytes(number_of_bytes):
+    if number_of_bytes is None:
+        return "n/a"
+    return f"{number_of_bytes / 1e6:.1f} MB"
+
+def benchmark_parse_msr():
+    parsers = [("xpath", parse_msr_xpath), ("iterparse", datex2.parse_msr)]
+
+    ensure_file(MSR_SAMPLE_FILE_PATH)
+    with open(MSR_SAMPLE_FILE_PATH, "rb") as f:
+        inputs = [("msr_sample.xml", f.read(), create_detector_id_to_canton_mapping(load_mst()))]
+    for scale in SYNTHETIC_SCALES:
+        topology = create_topology(scale)
+        inputs.append((f"synthetic x{scale}", create_synthetic_msr(topology), create_detector_id_to_canton_mapping(topology)))
+
+    rows = []
+    print(f"{'input':<20}{'parser':<12}{'size':>10}{'ms':>10}{'sites/s':>12}{'MB/s':>8}{'peak py':>12}{'peak rss':>12}")
+    for input_name, xml_content, detector_id_to_canton_mapping in inputs:
+        expected = parse_msr_xpath(xml_content, detector_id_to_canton_mapping)
+        for parser_name, parser in parsers:
+            if parser(xml_content, detector_id_to_canton_mapping) != expected:
+                sys.exit(f"Parser '{parser_name}' does not produce the same result as the reference for {input_name}")
+            throughput = measure_throughput(parser, xml_content, detector_id_to_canton_mapping)
+            peak_python, peak_rss = measure_peak_memory(parser, xml_content, detector_id_to_canton_mapping)
+            print(f"{input_name:<20}{parser_name:<12}{format_bytes(len(xml_content)):>10}{throughput['seconds'] * 1000:>10.2f}"
+                  f"{throughput['sitesPerSecond']:>12.0f}{throughput['megabytesPerSecond']:>8.1f}"
+                  f"{format_bytes(peak_python):>12}{format_bytes(peak_rss):>12}")
+            rows.append({
+                "name": f"{input_name} {parser_name}",
+                "documentSize": len(xml_content),
+                "milliseconds": throughput["seconds"] * 1000,
+                "sitesPerSecond": throughput["sitesPerSecond"],
+                "valuesPerSecond": throughput["valuesPerSecond"],
+                "megabytesPerSecond": throughput["megabytesPerSecond"],
+                "peakPythonBytes": peak_python,
+                "peakRssBytes": peak_rss
+            })
+    return rows
+
+def benchmark_parse_mst():
+    # Full parse of a synthetic MST and the incremental refresh of an unchanged one (see preprocessing.py)
+    import preprocessing
+    rows = []
+    print(f"{'input':<20}{'parser':<12}{'size':>10}{'records':>10}{'ms':>10}{'records/s':>12}")
+    for scale in SYNTHETIC_SCALES:
+        topology = create_topology(scale)
+        # Copied stations are not part of mst_locations.csv, they are enriched with the location of their original
+        preprocessing.MST_LOCATION_INFORMATION.update(synthetic_datex2.create_location_information(topology))
+        xml_content = synthetic_datex2.create_mst_xml(topology, SYNTHETIC_MEASUREMENT_TIME)
+        number_of_records = sum([len(station["detectors"]) for station in topology])
+        # The parser reports every record without a direction or location, which the real MST has too
+        with redirect_stdout(io.StringIO()):
+            stations, record_hashes, _ = preprocessing.refresh_mst(xml_content, None)
+        if [station["id"] for station in stations] != [station["id"] for station in topology] \
+                or sum([len(station["detectors"]) for station in stations]) != number_of_records:
+            sys.exit(f"Parsing the synthetic MST x{scale} does not produce its topology")
+        previous_compiled_mst = mst_snapshot.compile_mst(stations, record_hashes)
+        # Every 50th record counts as changed and is parsed again
+        partly_changed_compiled_mst = {**previous_compiled_mst, "recordHashes": {
+            detector_id: "changed" if position % 50 == 0 else record_hash
+            for position, (detector_id, record_hash) in enumerate(record_hashes.items())
+        }}
+        parsers = [
+            ("full", lambda: preprocessing.parse_mst(xml_content)),
+            ("unchanged", lambda: preprocessing.refresh_mst(xml_content, previous_compiled_mst)),
+            ("2% changed", lambda: preprocessing.refresh_mst(xml_content, partly_changed_compiled_mst)),
+        ]
+        for parser_name, parser in parsers:
+            durations = []
+            with redirect_stdout(io.StringIO()):
+                for _ in range(NUMBER_OF_RUNS):
+                    start = time.perf_counter()
+                    parser()
+                    durations.append(time.perf_counter() - start)
+            best = min(durations)
+            print(f"{'synthetic x' + str(scale):<20}{parser_name:<12}{format_bytes(len(xml_content)):>10}{number_of_records:>10}"
+                  f"{best * 1000:>10.1f}{number_of_records / best:>12.0f}")
+            rows.append({
+                "name": f"synthetic x{scale} {parser_name}",
+                "documentSize": len(xml_content),
+                "records": number_of_records,
+                "milliseconds": best * 1000,
+                "recordsPerSecond": number_of_records / best
+            })
+    return rows
+
+def create_national_msr(mst):
+    # Every detector of the MST reports, so the tag sets built from the MST are actually hit
+    return datex2.parse_msr(create_synthetic_msr(mst), create_detector_id_to_canton_mapping(mst))
+
+def benchmark_write_detector_measurements():
+    with open(MST_FILE_PATH, "r") as f:
+        mst = json.load(f)
+    msr = create_national_msr(mst)
+    # The synthetic feed uses a single measurement time for all sites
+    timestamp = line_protocol.parse_timestamp(msr["detector_measurements"][0]["time"])
+    rows = []
+
+    tag_sets = line_protocol.DetectorMeasurementTagSets(mst)
+    writers = [
+        ("dict + Point", lambda: serialize_dicts(msr, timestamp)),
+        ("line protocol", lambda: line_protocol.detector_measurements_to_lines(msr["detector_measurements"], tag_sets)),
+    ]
+    expected = serialize_dicts(msr, timestamp)
+    print(f"{'writer':<20}{'points':>10}{'ms':>10}{'points/s':>14}")
+    for writer_name, writer in writers:
+        lines = writer()
+        if lines != expected:
+            sys.exit(f"Writer '{writer_name}' does not produce the same line protocol as the InfluxDB client")
+        durations = []
+        for _ in range(NUMBER_OF_RUNS):
+            start = time.perf_counter()
+            writer()
+            durations.append(time.perf_counter() - start)
+        best = min(durations)
+        print(f"{writer_name:<20}{len(lines):>10}{best * 1000:>10.2f}{len(lines) / best:>14.0f}")
+        rows.append({"name": writer_name, "points": len(lines), "milliseconds": best * 1000, "pointsPerSecond": len(lines) / best})
+    return rows
+
+def create_schema_cycles(mst, schema, number_of_cycles, stop):
+    # Line protocol of one national pull per minute, each sensor reports an error now and then
+    # (which also drops its kind, like the real feed does)
+    random = Random(42)
+    msr = create_national_msr(mst)
+    tag_sets = line_protocol.create_tag_sets(schema, mst)
+    cycles = []
+    for cycle in range(number_of_cycles):
+        timestamp = to_datetime(stop - (number_of_cycles - cycle) * 60 * 1_000_000_000)
+        detector_measurements = []
+        for detector_measurement in msr["detector_measurements"]:
+            sensor_measurements = []
+            for sensor_measurement in detector_measurement["sensorMeasurements"]:
+                has_error = random.random() < SCHEMA_ERROR_PROBABILITY
+                sensor_measurements.append({
+                    **sensor_measurement,
+                    "hasError": has_error,
+                    "errorReason": "VD_OFFLINE" if has_error else None,
+                    "kind": None if has_error else sensor_measurement["kind"]
+                })
+            detector_measurements.append({**detector_measurement, "time": timestamp.isoformat(), "sensorMeasurements": sensor_measurements})
+        cycles.append(line_protocol.detector_measurements_to_lines(detector_measurements, tag_sets))
+    return cycles
+
+def count_series(lines):
+    # A series is a measurement and tag set together with one field key
+    series = set()
+    for line in lines:
+        tag_set, fields, _ = line.rsplit(" ", 2)
+        for field in fields.split(","):
+            series.add((tag_set, field.split("=", 1)[0]))
+    return len(series)
+
+def benchmark_storage_schema():
+    with open(MST_FILE_PATH, "r") as f:
+        mst = json.load(f)
+    stop = time.time_ns()
+    rows = []
+    print(f"{'schema':<12}{'cycles':>8}{'points':>10}{'series':>10}{'bytes/point':>14}")
+    for schema in storage_schema.SCHEMAS:
+        cycles = create_schema_cycles(mst, schema, SCHEMA_NUMBER_OF_CYCLES, stop)
+        lines = [line for cycle in cycles for line in cycle]
+        bytes_per_point = sum(len(line) + 1 for line in lines) / len(lines)
+        number_of_series = count_series(lines)
+        print(f"{schema:<12}{len(cycles):>8}{len(lines):>10}{number_of_series:>10}{bytes_per_point:>14.1f}")
+        rows.append({"name": schema, "points": len(lines), "series": number_of_series, "pointBytes": bytes_per_point})
+    return rows
+
+def benchmark_storage_schema_query():
+    # Needs a running InfluxDB (configured in '.env-local'). Both schemas are written into a temporary
+    # bucket, then the series cardinality and the time of the error count query are compared.
+    from influxdb_client import InfluxDBClient, WritePrecision
+    from influxdb_client.client.write_api import SYNCHRONOUS
+    from dotenv import dotenv_values
+    ensure_file(ENV_FILE_PATH)
+    secrets = dotenv_values(ENV_FILE_PATH)
+    with open(MST_FILE_PATH, "r") as f:
+        mst = json.load(f)
+    db_client = InfluxDBClient(url=secrets["INFLUXDB_URL"], token=secrets["DOCKER_INFLUXDB_INIT_ADMIN_TOKEN"],
+                               org=secrets["DOCKER_INFLUXDB_INIT_ORG"], enable_gzip=True, timeout=120_000)
+    buckets_api = db_client.buckets_api()
+    bucket = buckets_api.find_bucket_by_name(SCHEMA_BENCHMARK_BUCKET)
+    if bucket is not None:
+        buckets_api.delete_bucket(bucket)
+    bucket = buckets_api.create_bucket(bucket_name=SCHEMA_BENCHMARK_BUCKET, org=db_client.org)
+    try:
+        write_api = db_client.write_api(write_options=SYNCHRONOUS)
+        stop = time.time_ns()
+        for schema in storage_schema.SCHEMAS:
+            for cycle in create_schema_cycles(mst, schema, SCHEMA_NUMBER_OF_CYCLES, stop):
+                write_api.write(bucket=SCHEMA_BENCHMARK_BUCKET, org=db_client.org, record=cycle, write_precision=WritePrecision.NS)
+        write_api.close()
+
+        query_api = db_client.query_api()
+        rows = []
+        print(f"{'schema':<12}{'series':>10}{'errors':>10}{'query ms':>10}")
+        for schema in storage_schema.SCHEMAS:
+            cardinality_query = SCHEMA_CARDINALITY_QUERY.replace("%bucket%", SCHEMA_BENCHMARK_BUCKET) \
+                .replace("%measurement%", storage_schema.MEASUREMENTS[schema])
+            number_of_series = query_api.query(cardinality_query)[0].records[0].get_value()
+            error_query = SCHEMA_ERROR_QUERY.replace("%bucket%", SCHEMA_BENCHMARK_BUCKET) \
+                .replace("%error_filter%", storage_schema.ERROR_FILTERS[schema])
+            durations = []
+            for _ in range(NUMBER_OF_RUNS):
+                start = time.perf_counter()
+                number_of_errors = sum(record.get_value() for record in query_api.query_stream(error_query))
+                durations.append(time.perf_counter() - start)
+            print(f"{schema:<12}{number_of_series:>10}{number_of_errors:>10}{min(durations) * 1000:>10.1f}")
+            rows.append({"name": schema, "series": number_of_series, "errors": number_of_errors, "milliseconds": min(durations) * 1000})
+        return rows
+    finally:
+        buckets_api.delete_bucket(bucket)
+        db_client.close()
+
+def benchmark_mst_load():
+    # Everything the app derives from the MST on startup, compiled from the JSON or read from the snapshot
+    snapshot_file_path = "./data/mst.benchmark.snapshot"
+    mst_snapshot.write_snapshot(snapshot_file_path, MST_FILE_PATH)
+    try:
+        def load_json():
+            with open(MST_FILE_PATH, "r") as f:
+                return mst_snapshot.compile_mst(json.load(f))
+        loaders = [
+            ("json", load_json),
+            ("snapshot", lambda: mst_snapshot.read_snapshot(snapshot_file_path, MST_FILE_PATH)),
+        ]
+        expected = load_json()
+        rows = []
+        print(f"{'source':<12}{'ms':>10}")
+        for loader_name, loader in loaders:
+            if loader() != expected:
+                sys.exit(f"Loading the MST from {loader_name} does not produce the same result")
+            durations = []
+            for _ in range(NUMBER_OF_RUNS):
+                start = time.perf_counter()
+                loader()
+                durations.append(time.perf_counter() - start)
+            print(f"{loader_name:<12}{min(durations) * 1000:>10.1f}")
+            rows.append({"name": loader_name, "milliseconds": min(durations) * 1000})
+        return rows
+    finally:
+        os.remove(snapshot_file_path)
+
+# Backend imported in process together with the stub or bucket it writes to, see start_app
+APP = {}
+
+def start_app(use_influxdb):
+    # Imports the backend, points it at the stub InfluxDB (or a temporary bucket of the configured one)
+    # and swaps in the synthetic topology. The scheduler is not started, ingest cycles are run directly.
+    import app as backend
+    from influxdb_client import InfluxDBClient
+    from station_index import StationIndex
+    from spatial_index import SpatialIndex
+    from hot_window import HotWindow
+    # The rollup tasks would not have run yet on the freshly written points
+    backend.ROLLUPS_ENABLED = False
+    backend.write_api.close()
+    backend.spool_write_api.close()
+    backend.db_client.close()
+    org = backend.SECRETS["DOCKER_INFLUXDB_INIT_ORG"]
+    if use_influxdb:
+        backend.db_client = InfluxDBClient(url=backend.SECRETS["INFLUXDB_URL"], token=backend.SECRETS["DOCKER_INFLUXDB_INIT_ADMIN_TOKEN"],
+                                           org=org, enable_gzip=True, timeout=120_000)
+        buckets_api = backend.db_client.buckets_api()
+        bucket = buckets_api.find_bucket_by_name(APP_BENCHMARK_BUCKET)
+        if bucket is not None:
+            buckets_api.delete_bucket(bucket)
+        APP["bucket"] = buckets_api.create_bucket(bucket_name=APP_BENCHMARK_BUCKET, org=org)
+        backend.BUCKET = APP_BENCHMARK_BUCKET
+    else:
+        APP["stub"] = StubInfluxDB()
+        backend.db_client = InfluxDBClient(url=APP["stub"].start(), token="benchmark", org=org, enable_gzip=True)
+    backend.write_api = backend.create_write_api()
+    backend.spool_write_api = backend.create_spool_write_api()
+    if backend.WRITE_SPOOL_ENABLED:
+        # A spool of its own, the one of a running backend is left alone
+        APP["spoolDirectory"] = tempfile.mkdtemp(prefix="benchmark_spool_")
+        backend.WRITE_SPOOL = WriteSpool(APP["spoolDirectory"])
+        backend.SPOOL_DRAINER = backend.create_spool_drainer(backend.WRITE_SPOOL)
+        backend.SPOOL_DRAINER.start()
+
+    topology = create_topology()
+    compiled_mst = mst_snapshot.compile_mst(topology)
+    backend.swap_mst(None, compiled_mst, StationIndex(compiled_mst["mst"], compiled_mst["stationFragments"]), SpatialIndex(compiled_mst["mst"]))
+    backend.LAST_SEEN_INDEX = line_protocol.LastSeenIndex()
+    if backend.HOT_WINDOW is not None:
+        backend.HOT_WINDOW = HotWindow(backend.HOT_WINDOW_HOURS)
+    APP["backend"] = backend
+    APP["topology"] = topology
+    APP["ingestRows"] = ingest(backend, topology)
+    return APP
+
+def stop_app():
+    if len(APP) == 0:
+        return
+    backend = APP["backend"]
+    backend.write_api.close()
+    if backend.SPOOL_DRAINER is not None:
+        backend.SPOOL_DRAINER.stop()
+        backend.WRITE_SPOOL.close()
+    backend.spool_write_api.close()
+    if "spoolDirectory" in APP:
+        shutil.rmtree(APP["spoolDirectory"], ignore_errors=True)
+    if "bucket" in APP:
+        backend.db_client.buckets_api().delete_bucket(APP["bucket"])
+    backend.db_client.close()
+    backend.QUERY_EXECUTOR.shutdown()
+    if "stub" in APP:
+        APP["stub"].stop()
+    APP.clear()
+
+def get_app(use_influxdb):
+    return APP if len(APP) > 0 else start_app(use_influxdb)
+
+def ingest(backend, topology):
+    # What the stages of the ingest pipeline do with every pull, one after the other, for one pull per
+    # minute up to now. The spool is drained in the background while the next pulls are processed.
+    random = Random(synthetic_datex2.DEFAULT_SEED)
+    measurement_times = synthetic_datex2.get_measurement_times(APP_NUMBER_OF_CYCLES)
+    documents = [synthetic_datex2.create_msr_xml(topology, measurement_time, TOPOLOGY_OPTIONS["errorRate"], random) for measurement_time in measurement_times]
+    stages = {"parse_msr": [], "hot_window": [], "write": [], "push_delta": []}
+    number_of_points = 0
+    ingest_start = time.perf_counter()
+    # The backend reports every queued batch
+    with redirect_stdout(io.StringIO()):
+        for xml_content in documents:
+            start = time.perf_counter()
+            msr = backend.parse_msr(xml_content, backend.DETECTOR_ID_TO_CANTON_MAPPING, backend.DETECTOR_ID_TO_STATION_ID_MAPPING)
+            stages["parse_msr"].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            if backend.HOT_WINDOW is not None:
+                backend.HOT_WINDOW.append_msr(msr)
+            stages["hot_window"].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            backend.write_detector_measurements_from_msr(msr)
+            stages["write"].append(time.perf_counter() - start)
+            start = time.perf_counter()
+            backend.PUSH_HUB.create_delta(msr)
+            stages["push_delta"].append(time.perf_counter() - start)
+            number_of_points += sum([len(detector_measurement["sensorMeasurements"]) for detector_measurement in msr["detector_measurements"]])
+        start = time.perf_counter()
+        # Closing waits for every pending batch, which are only written if the spool is disabled
+        backend.write_api.close()
+        if backend.SPOOL_DRAINER is not None:
+            backend.SPOOL_DRAINER.wait_until_drained()
+        flush_duration = time.perf_counter() - start
+    ingest_duration = time.perf_counter() - ingest_start
+    backend.write_api = backend.create_write_api()
+    if "stub" in APP and APP["stub"].get_stats()["points"] != number_of_points:
+        sys.exit(f"Expected {number_of_points} points to be written but the stub received {APP['stub'].get_stats()['points']}")
+
+    rows = []
+    print(f"{'stage':<20}{'ms/cycle':>10}")
+    for stage, durations in stages.items():
+        print(f"{stage:<20}{statistics.median(durations) * 1000:>10.2f}")
+        rows.append({"name": stage, "milliseconds": statistics.median(durations) * 1000})
+    print(f"{'flush':<20}{flush_duration * 1000:>10.2f}")
+    print(f"{len(documents)} cycles with {number_of_points} points in {ingest_duration:.2f} s ({number_of_points / ingest_duration:.0f} points/s)")
+    rows.append({"name": "flush", "milliseconds": flush_duration * 1000})
+    rows.append({"name": "total", "cycles": len(documents), "points": number_of_points, "milliseconds": ingest_duration * 1000,
+                 "pointsPerSecond": number_of_points / ingest_duration})
+    return rows
+
+def benchmark_ingest(use_influxdb=False):
+    return get_app(use_influxdb)["ingestRows"]
+
+def create_endpoint_requests(topology):
+    # Name, method, path, body and headers of every request, the stats endpoints are cheap and only
+    # checked once. /events is left out, its response never ends.
+    detector_measurements = [{"id": detector["id"], "index": characteristic["index"], "name": station["name"]}
+                             for station in topology for detector in station["detectors"]
+                             for characteristic in detector["characteristics"]][:NUMBER_OF_DETECTORS_PER_REQUEST]
+    canton = topology[0]["canton"]
+    # Whole of Switzerland and a city
+    country = {"west": 5.9, "south": 45.8, "east": 10.5, "north": 47.9, "zoom": 8}
+    city = {"west": 8.45, "south": 47.32, "east": 8.62, "north": 47.43, "zoom": 13}
+    requests = [("GET /cantons", "GET", "/cantons", None, {})]
+    for source, time_str in [("hot window", HOT_WINDOW_TIME_RANGE), ("influxdb", INFLUXDB_TIME_RANGE)]:
+        requests += [
+            (f"POST /stations all ({source})", "POST", "/stations", {"canton": "all", "time": time_str}, {}),
+            (f"POST /stations canton ({source})", "POST", "/stations", {"canton": canton, "time": time_str}, {}),
+            (f"POST /stations/viewport country ({source})", "POST", "/stations/viewport", {**country, "time": time_str}, {}),
+            (f"POST /stations/viewport city ({source})", "POST", "/stations/viewport", {**city, "time": time_str}, {}),
+            (f"POST /detector_measurements ({source})", "POST", "/detector_measurements",
+             {"detectorMeasurements": detector_measurements, "time": time_str}, {}),
+            (f"POST /detector_measurements columnar ({source})", "POST", "/detector_measurements",
+             {"detectorMeasurements": detector_measurements, "time": time_str}, {"Accept": "application/vnd.astra.columnar+json"}),
+            (f"POST /detector_measurements ndjson ({source})", "POST", "/detector_measurements",
+             {"detectorMeasurements": detector_measurements, "time": time_str}, {"Accept": "application/x-ndjson"}),
+            (f"POST /detector_measurements maxPoints ({source})", "POST", "/detector_measurements",
+             {"detectorMeasurements": detector_measurements, "time": time_str, "maxPoints": 20}, {}),
+            (f"POST /cantons/total_number_of_errors ({source})", "POST", "/cantons/total_number_of_errors", {"canton": "all", "time": time_str}, {}),
+            (f"POST /cantons/number_of_errors ({source})", "POST", "/cantons/number_of_errors", {"canton": "all", "time": time_str, "binSize": "10m"}, {}),
+        ]
+    return requests
+
+STATS_PATHS = ["/ingest/stats", "/cache/stats", "/query/stats", "/events/stats", "/hot_window/stats"]
+
+async def run_endpoint_requests(backend, requests):
+    import httpx
+    rows = []
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=backend.app), base_url="http://benchmark") as client:
+        for path in STATS_PATHS:
+            response = await client.get(path)
+            if response.status_code != 200:
+                sys.exit(f"GET {path} failed with status {response.status_code}")
+        for name, method, path, body, headers in requests:
+            durations = []
+            # The first request is a warm up
+            for run in range(NUMBER_OF_RUNS + 1):
+                # Otherwise every but the first request would be answered by the response cache
+                backend.RESPONSE_CACHE.invalidate()
+                start = time.perf_counter()
+                response = await client.request(method, path, json=body, headers=headers)
+                duration = time.perf_counter() - start
+                # The endpoints answer failed queries with an empty result
+                if response.status_code != 200 or response.content.strip() in (b"", b"[]"):
+                    sys.exit(f"{name} failed with status {response.status_code} and '{response.text[:200]}'")
+                if run > 0:
+                    durations.append(duration)
+            rows.append({
+                "name": name,
+                "milliseconds": statistics.median(durations) * 1000,
+                "minMilliseconds": min(durations) * 1000,
+                "responseBytes": len(response.content)
+            })
+    return rows
+
+def benchmark_endpoints(use_influxdb=False):
+    environment = get_app(use_influxdb)
+    backend = environment["backend"]
+    requests = create_endpoint_requests(environment["topology"])
+    # The backend logs every query it sends
+    with redirect_stdout(io.StringIO()):
+        rows = asyncio.run(run_endpoint_requests(backend, requests))
+    print(f"{'request':<60}{'ms':>10}{'min ms':>10}{'size':>10}")
+    for row in rows:
+        print(f"{row['name']:<60}{row['milliseconds']:>10.2f}{row['minMilliseconds']:>10.2f}{format_bytes(row['responseBytes']):>10}")
+    return rows
+
+BENCHMARKS = {
+    "parse_msr": benchmark_parse_msr,
+    "parse_mst": benchmark_parse_mst,
+    "write": benchmark_write_detector_measurements,
+    "schema": benchmark_storage_schema,
+    "mst_load": benchmark_mst_load,
+    "ingest": benchmark_ingest,
+    "endpoints": benchmark_endpoints,
+    # Not run by default because it needs a running InfluxDB
+    "schema_query": benchmark_storage_schema_query,
+}
+DEFAULT_BENCHMARKS = ["parse_msr", "parse_mst", "write", "schema", "mst_load", "ingest", "endpoints"]
+# Run against the stub InfluxDB unless --influxdb is given
+APP_BENCHMARKS = ["ingest", "endpoints"]
+
+def run_git(*arguments):
+    try:
+        return subprocess.run(["git", *arguments], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def create_results(names, benchmark_results):
+    return {
+        "commit": run_git("rev-parse", "HEAD"),
+        # Uncommitted changes, the results do not belong to the commit alone
+        "dirty": run_git("status", "--porcelain", "--untracked-files=no") not in (None, ""),
+        "createdAt": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "options": {**TOPOLOGY_OPTIONS, "scales": SYNTHETIC_SCALES, "appCycles": APP_NUMBER_OF_CYCLES, "runs": NUMBER_OF_RUNS},
+        "benchmarks": {name: benchmark_results[name] for name in names}
+    }
+
+def get_results_file_path(results):
+    commit = (results["commit"] or "unknown")[:12]
+    return os.path.join(BENCHMARK_RESULTS_DIRECTORY, f"{commit}{'-dirty' if results['dirty'] else ''}.json")
+
+def compare_results(baseline, results, threshold):
+    # Prints every metric which got worse or better by more than threshold, returns the number of regressions
+    number_of_regressions = 0
+    print(f"Comparing with {baseline['commit'] or 'unknown'} from {baseline['createdAt']}")
+    if baseline["options"] != results["options"]:
+        print(f"Warning: the options differ ({baseline['options']} vs {results['options']})")
+    print(f"{'benchmark':<12}{'name':<52}{'metric':<20}{'baseline':>12}{'current':>12}{'change':>9}")
+    for name, rows in results["benchmarks"].items():
+        baseline_rows = {row["name"]: row for row in baseline["benchmarks"].get(name, [])}
+        for row in rows:
+            baseline_row = baseline_rows.get(row["name"])
+            if baseline_row is None:
+                continue
+            for metric, value in row.items():
+                baseline_value = baseline_row.get(metric)
+                if not isinstance(value, (int, float)) or not isinstance(baseline_value, (int, float)) or baseline_value == 0:
+                    continue
+                change = (value - baseline_value) / baseline_value
+                if metric.endswith(LOWER_IS_BETTER_SUFFIXES):
+                    is_regression = change > threshold
+                elif metric.endswith(HIGHER_IS_BETTER_SUFFIXES):
+                    is_regression = change < -threshold
+                else:
+                    continue
+                if abs(change) <= threshold:
+                    continue
+                number_of_regressions += 1 if is_regression else 0
+                print(f"{name:<12}{row['name']:<52}{metric:<20}{baseline_value:>12.2f}{value:>12.2f}{change:>+9.1%}"
+                      f"{'  regression' if is_regression else ''}")
+    print(f"{number_of_regressions} regressions beyond {threshold:.0%}")
+    return number_of_regressions
+
+if __name__ == "__main__":
+    # Run all benchmarks or only the ones given on the command line, e.g 'python benchmark.py write'
+    parser = argparse.ArgumentParser(description="Benchmarks of the ingest and query paths")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run, available are {', '.join(BENCHMARKS.keys())}")
+    parser.add_argument("--stations", type=int, default=None, help="stations of the synthetic topology, defaults to the real ones")
+    parser.add_argument("--detectors", type=int, default=None, help="detectors per station, defaults to the real ones")
+    parser.add_argument("--indices", type=int, default=None, help="indices per detector, defaults to the real ones")
+    parser.add_argument("--error-rate", type=float, default=synthetic_datex2.DEFAULT_ERROR_RATE)
+    parser.add_argument("--cycles", type=int, default=APP_NUMBER_OF_CYCLES, help="minutes ingested by the app benchmarks")
+    parser.add_argument("--influxdb", action="store_true", help="run the app benchmarks against the configured InfluxDB instead of the stub")
+    parser.add_argument("--output", default=None, help=f"results file, defaults to {BENCHMARK_RESULTS_DIRECTORY}/<commit>.json")
+    parser.add_argument("--compare", default=None, help="results file of an earlier run, exits with 1 if anything regressed")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_REGRESSION_THRESHOLD, help="relative change counted as a regression")
+    arguments = parser.parse_args()
+    names = arguments.names or DEFAULT_BENCHMARKS
+    for name in names:
+        if name not in BENCHMARKS:
+            sys.exit(f"Unknown benchmark '{name}', available are {', '.join(BENCHMARKS.keys())}")
+    if arguments.influxdb and "schema_query" not in names:
+        ensure_file(ENV_FILE_PATH)
+    TOPOLOGY_OPTIONS.update({"stations": arguments.stations, "detectors": arguments.detectors, "indices": arguments.indices, "errorRate": arguments.error_rate})
+    # The hot window range has to be covered by the ingested minutes
+    APP_NUMBER_OF_CYCLES = max(arguments.cycles, 31)
+
+    benchmark_results = {}
+    try:
+        for name in names:
+            print(f"== {name}")
+            if name in APP_BENCHMARKS:
+                benchmark_results[name] = BENCHMARKS[name](arguments.influxdb)
+            else:
+                benchmark_results[name] = BENCHMARKS[name]()
+    finally:
+        stop_app()
+
+    results = create_results(names, benchmark_results)
+    output_file_path = arguments.output or get_results_file_path(results)
+    os.makedirs(os.path.dirname(os.path.abspath(output_file_path)), exist_ok=True)
+    with open(output_file_path, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Wrote results to '{output_file_path}'")
+    if arguments.compare is not None:
+        ensure_file(arguments.compare)
+        with open(arguments.compare, "r") as f:
+            baseline = json.load(f)
+        if compare_results(baseline, results, arguments.threshold) > 0:
+            sys.exit(1)
@@ -0,0 +1,121 @@
+import json
+from datetime import datetime, timezone, timedelta
+
+# Arrow is optional, without pyarrow installed only the columnar JSON is offered
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+# Columnar representation of the time series endpoints, requested via the Accept header. Instead of one
+# dict per point every series carries parallel arrays, times are milliseconds since epoch and error
+# reasons are indices into a shared list, e.g
+#
+#   {
+#     "errorReasons": [null, "VD_OFFLINE"],
+#     "series": [{"id": "CH:0002.01", "index": 11, "name": "...", "time": [1701099360000, ...],
+#                 "value": [12.0, ...], "numberOfInputValuesUsed": [3, ...], "hasError": [false, ...], "errorReason": [0, ...]}]
+#   }
+#
+# The Arrow IPC stream contains the same data as one long table (one row per point).
+JSON = "json"
+COLUMNAR_JSON = "columnar"
+ARROW = "arrow"
+COLUMNAR_JSON_MEDIA_TYPE = "application/vnd.astra.columnar+json"
+ARROW_STREAM_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+MEDIA_TYPES = {
+    COLUMNAR_JSON: COLUMNAR_JSON_MEDIA_TYPE,
+    ARROW: ARROW_STREAM_MEDIA_TYPE,
+}
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def negotiate(accept):
+    # Picks the representation for the Accept header, plain JSON unless a columnar one was asked for
+    accept = accept or ""
+    if ARROW_STREAM_MEDIA_TYPE in accept and pyarrow is not None:
+        return ARROW
+    if COLUMNAR_JSON_MEDIA_TYPE in accept:
+        return COLUMNAR_JSON
+    return JSON
+
+def to_epoch_milliseconds(time):
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return (time - EPOCH) // timedelta(milliseconds=1)
+
+def encode_json(content):
+    return json.dumps(content, separators=(",", ":")).encode("utf-8")
+
+def detector_measurements_to_columnar(detector_measurements, results):
+    # detector_measurements are the requested detectors, results the measurements in the regular shape
+    error_reasons = [None]
+    error_reason_codes = {None: 0}
+    series = []
+    for detector_measurement, result in zip(detector_measurements, results):
+        measurements = result["measurements"]
+        error_reason_column = []
+        for measurement in measurements:
+            error_reason = measurement["errorReason"]
+            code = error_reason_codes.get(error_reason)
+            if code is None:
+                code = len(error_reasons)
+                error_reasons.append(error_reason)
+                error_reason_codes[error_reason] = code
+            error_reason_column.append(code)
+        series.append({
+            "id": detector_measurement.id,
+            "index": detector_measurement.index,
+            "name": detector_measurement.name,
+            "time": [to_epoch_milliseconds(measurement["time"]) for measurement in measurements],
+            "value": [measurement["value"] for measurement in measurements],
+            "numberOfInputValuesUsed": [measurement["numberOfInputValuesUsed"] for measurement in measurements],
+            "hasError": [measurement["hasError"] for measurement in measurements],
+            "errorReason": error_reason_column
+        })
+    return {"errorReasons": error_reasons, "series": series}
+
+def cantons_number_of_errors_to_columnar(results):
+    return {"series": [{
+        "name": result["name"],
+        "time": [to_epoch_milliseconds(measurement["time"]) for measurement in result["measurements"]],
+        "numberOfErrors": [measurement["numberOfErrors"] for measurement in result["measurements"]]
+    } for result in results]}
+
+def encode_arrow(columns):
+    table = pyarrow.table(columns)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def _repeat(values, counts):
+    return [value for value, count in zip(values, counts) for _ in range(count)]
+
+def detector_measurements_to_arrow(detector_measurements, results):
+    columnar = detector_measurements_to_columnar(detector_measurements, results)
+    series = columnar["series"]
+    counts = [len(serie["time"]) for serie in series]
+    timestamp = pyarrow.timestamp("ms", tz="UTC")
+    return encode_arrow({
+        "id": pyarrow.array(_repeat([serie["id"] for serie in series], counts)).dictionary_encode(),
+        "index": pyarrow.array(_repeat([serie["index"] for serie in series], counts), type=pyarrow.int32()),
+        "time": pyarrow.array([time for serie in series for time in serie["time"]], type=timestamp),
+        "value": pyarrow.array([value for serie in series for value in serie["value"]], type=pyarrow.float64()),
+        "numberOfInputValuesUsed": pyarrow.array([number for serie in series for number in serie["numberOfInputValuesUsed"]], type=pyarrow.int32()),
+        "hasError": pyarrow.array([has_error for serie in series for has_error in serie["hasError"]], type=pyarrow.bool_()),
+        # Points without an error reason are null instead of pointing at a null entry of the dictionary
+        "errorReason": pyarrow.DictionaryArray.from_arrays(
+            pyarrow.array([None if code == 0 else code - 1 for serie in series for code in serie["errorReason"]], type=pyarrow.int32()),
+            pyarrow.array(columnar["errorReasons"][1:], type=pyarrow.string())
+        ),
+    })
+
+def cantons_number_of_errors_to_arrow(results):
+    series = cantons_number_of_errors_to_columnar(results)["series"]
+    counts = [len(serie["time"]) for serie in series]
+    return encode_arrow({
+        "name": pyarrow.array(_repeat([serie["name"] for serie in series], counts), type=pyarrow.string()).dictionary_encode(),
+        "time": pyarrow.array([time for serie in series for time in serie["time"]], type=pyarrow.timestamp("ms", tz="UTC")),
+        "numberOfErrors": pyarrow.array([number for serie in series for number in serie["numberOfErrors"]], type=pyarrow.int64()),
+    })
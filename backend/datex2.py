@@ -0,0 +1,147 @@
+from io import BytesIO
+# etree for fast xml parsing
+from lxml import etree as etree_lxml
+
+DX223_NAMESPACE = "http://datex2.eu/schema/2/2_0"
+XSI_NAMESPACE = "http://www.w3.org/2001/XMLSchema-instance"
+
+# Fully qualified tag names as lxml reports them while streaming ("{namespace}localName")
+SITE_MEASUREMENTS_TAG = f"{{{DX223_NAMESPACE}}}siteMeasurements"
+MEASUREMENT_SITE_REFERENCE_TAG = f"{{{DX223_NAMESPACE}}}measurementSiteReference"
+MEASUREMENT_TIME_DEFAULT_TAG = f"{{{DX223_NAMESPACE}}}measurementTimeDefault"
+MEASURED_VALUE_TAG = f"{{{DX223_NAMESPACE}}}measuredValue"
+BASIC_DATA_TAG = f"{{{DX223_NAMESPACE}}}basicData"
+DATA_ERROR_TAG = f"{{{DX223_NAMESPACE}}}dataError"
+REASON_FOR_DATA_ERROR_TAG = f"{{{DX223_NAMESPACE}}}reasonForDataError"
+VALUE_TAG = f"{{{DX223_NAMESPACE}}}value"
+VEHICLE_FLOW_RATE_TAG = f"{{{DX223_NAMESPACE}}}vehicleFlowRate"
+AVERAGE_VEHICLE_SPEED_TAG = f"{{{DX223_NAMESPACE}}}averageVehicleSpeed"
+SPEED_TAG = f"{{{DX223_NAMESPACE}}}speed"
+XSI_TYPE_ATTRIBUTE = f"{{{XSI_NAMESPACE}}}type"
+
+def detector_id_to_station_id(detector_id):
+    # Dectector Id: CH:0002.01
+    # Station Id: CH:0002
+    return detector_id.split(".")[0]
+
+def _xsi_type_name(element):
+    # xsi:type values are prefixed with whatever prefix the document uses, e.g "dx223:TrafficFlow"
+    xsi_type = element.get(XSI_TYPE_ATTRIBUTE)
+    if xsi_type is None:
+        return None
+    return xsi_type.rsplit(":", 1)[-1]
+
+def _create_sensor_measurement(index, basic_data_type, has_data_error, error_reason, flow_rate, speed, number_of_input_values_used):
+    sensor_measurement = {}
+    measured_value = 0
+    kind = None
+    if not has_data_error:
+        if basic_data_type == "TrafficFlow" and flow_rate is not None:
+            kind = "trafficFlow"
+            measured_value = float(flow_rate)
+        elif basic_data_type == "TrafficSpeed" and speed is not None:
+            kind = "trafficSpeed"
+            measured_value = float(speed)
+            sensor_measurement["numberOfInputValuesUsed"] = int(number_of_input_values_used or 0)
+
+    sensor_measurement["value"] = measured_value
+    sensor_measurement["hasError"] = has_data_error
+    sensor_measurement["errorReason"] = error_reason
+    sensor_measurement["index"] = index
+    sensor_measurement["kind"] = kind
+    return sensor_measurement
+
+def _parse_site_measurements(node, detector_id_to_canton_mapping, detector_id_to_station_id_mapping=None):
+    detector_id = None
+    time = None
+    sensor_measurements = []
+
+    # State of the measured value we are currently walking through. It is only turned into a
+    # sensor measurement once we know all of its children (the error flag may follow the value).
+    index = None
+    basic_data_type = None
+    has_data_error = False
+    in_reason_for_data_error = False
+    error_reason = None
+    flow_rate = None
+    speed = None
+    number_of_input_values_used = None
+
+    # Walk the subtree exactly once in document order instead of running one XPath query per field
+    for element in node.iter():
+        tag = element.tag
+        if tag == MEASURED_VALUE_TAG:
+            element_index = element.get("index")
+            if element_index is None:
+                # The inner measuredValue element does not carry any information we need
+                continue
+            if index is not None:
+                sensor_measurements.append(_create_sensor_measurement(
+                    index, basic_data_type, has_data_error, error_reason, flow_rate, speed, number_of_input_values_used))
+            index = int(element_index)
+            basic_data_type = None
+            has_data_error = False
+            in_reason_for_data_error = False
+            error_reason = None
+            flow_rate = None
+            speed = None
+            number_of_input_values_used = None
+        elif tag == BASIC_DATA_TAG:
+            if basic_data_type is None:
+                basic_data_type = _xsi_type_name(element)
+        elif tag == DATA_ERROR_TAG:
+            has_data_error = True
+        elif tag == REASON_FOR_DATA_ERROR_TAG:
+            in_reason_for_data_error = True
+        elif tag == VALUE_TAG:
+            if in_reason_for_data_error and error_reason is None:
+                error_reason = element.text
+        elif tag == VEHICLE_FLOW_RATE_TAG:
+            if flow_rate is None:
+                flow_rate = element.text
+        elif tag == AVERAGE_VEHICLE_SPEED_TAG:
+            if number_of_input_values_used is None:
+                number_of_input_values_used = element.get("numberOfInputValuesUsed")
+        elif tag == SPEED_TAG:
+            if speed is None:
+                speed = element.text
+        elif tag == MEASUREMENT_SITE_REFERENCE_TAG:
+            if detector_id is None:
+                detector_id = element.get("id")
+        elif tag == MEASUREMENT_TIME_DEFAULT_TAG:
+            if time is None:
+                time = element.text
+
+    if index is not None:
+        sensor_measurements.append(_create_sensor_measurement(
+            index, basic_data_type, has_data_error, error_reason, flow_rate, speed, number_of_input_values_used))
+
+    detector_measurement = {}
+    detector_measurement["id"] = detector_id
+    detector_measurement["time"] = time
+    detector_measurement["sensorMeasurements"] = sensor_measurements
+    detector_measurement["canton"] = detector_id_to_canton_mapping.get(detector_id, None)
+    station_id = None if detector_id_to_station_id_mapping is None else detector_id_to_station_id_mapping.get(detector_id)
+    detector_measurement["stationId"] = detector_id_to_station_id(detector_id) if station_id is None else station_id
+    return detector_measurement
+
+def iter_detector_measurements(source, detector_id_to_canton_mapping, detector_id_to_station_id_mapping=None):
+    # Accept raw bytes (e.g a response body) as well as file paths and file like objects
+    if isinstance(source, (bytes, bytearray)):
+        source = BytesIO(source)
+
+    # Only the current siteMeasurements subtree is ever kept in memory. Once it has been
+    # converted it is cleared and detached from its parent so the tree does not grow.
+    context = etree_lxml.iterparse(source, events=("end",), tag=SITE_MEASUREMENTS_TAG)
+    for _, node in context:
+        yield _parse_site_measurements(node, detector_id_to_canton_mapping, detector_id_to_station_id_mapping)
+        node.clear(keep_tail=True)
+        parent = node.getparent()
+        while node.getprevious() is not None:
+            del parent[0]
+    del context
+
+def parse_msr(source, detector_id_to_canton_mapping, detector_id_to_station_id_mapping=None):
+    result = dict()
+    result["detector_measurements"] = list(iter_detector_measurements(source, detector_id_to_canton_mapping, detector_id_to_station_id_mapping))
+    return result
@@ -0,0 +1,116 @@
+import math
+from datetime import datetime, timezone, timedelta
+from hot_window import parse_relative_start, to_datetime
+from line_protocol import parse_timestamp
+
+# Long time ranges of a detector contain far more points than a chart can show (30 days are about
+# 43k points per series). With maxPoints a series is reduced to at most that many points, either by
+# aggregating the points of equally sized windows (mean, min or max of the value, computed by InfluxDB)
+# or with the Largest Triangle Three Buckets algorithm which keeps the points shaping the series.
+MEAN = "mean"
+MIN = "min"
+MAX = "max"
+LTTB = "lttb"
+AGGREGATIONS = [MEAN, MIN, MAX, LTTB]
+DEFAULT_AGGREGATION = MEAN
+# The feed delivers one point per minute, windows are never smaller than that
+MEASUREMENT_PERIOD = 60 * 1_000_000_000
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def parse_start(time_str, now):
+    # Start of a relative (-30d) or absolute (2023-11-27T00:00:00Z) range in nanoseconds, None otherwise
+    start = parse_relative_start(time_str, now)
+    if start is not None:
+        return start
+    try:
+        return parse_timestamp(time_str.strip())
+    except (AttributeError, ValueError):
+        return None
+
+def get_window(start, stop, max_points):
+    # Size of the windows in nanoseconds (whole seconds) so the range has at most max_points of them,
+    # None if the range has less points anyway. Windows are aligned to the epoch like the ones of
+    # aggregateWindow, so the first and last one may be partial.
+    if start is None or (stop - start) // MEASUREMENT_PERIOD <= max_points:
+        return None
+    window = math.ceil((stop - start) / max(max_points - 1, 1) / 1_000_000_000) * 1_000_000_000
+    return max(window, MEASUREMENT_PERIOD)
+
+def to_flux_duration(window):
+    return f"{window // 1_000_000_000}s"
+
+def to_nanoseconds(time):
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+    return (time - EPOCH) // timedelta(microseconds=1) * 1000
+
+def aggregate(measurements, window, aggregation):
+    # Same result as the aggregateWindow query for measurements which are already in memory. The error
+    # reason can not be aggregated, a window has an error if any of its points had one.
+    function = {MEAN: lambda values: sum(values) / len(values), MIN: min, MAX: max}[aggregation]
+    windows = {}
+    for measurement in measurements:
+        window_start = to_nanoseconds(measurement["time"]) // window * window
+        windows.setdefault(window_start, []).append(measurement)
+    return [{
+        "value": function([measurement["value"] for measurement in points]),
+        "time": to_datetime(window_start),
+        "numberOfInputValuesUsed": sum([measurement["numberOfInputValuesUsed"] for measurement in points]),
+        "errorReason": None,
+        "hasError": any([measurement["hasError"] for measurement in points])
+    } for window_start, points in sorted(windows.items())]
+
+def lttb(measurements, max_points):
+    # Largest Triangle Three Buckets (Steinarsson 2013): keeps the first and the last point and from
+    # every bucket in between the point forming the largest triangle with the previously kept point
+    # and the average of the next bucket. The kept points are unchanged measurements.
+    if max_points >= len(measurements):
+        return measurements
+    if max_points < 3:
+        return [measurements[0], measurements[-1]][:max_points]
+    times = [to_nanoseconds(measurement["time"]) / 1_000_000_000 for measurement in measurements]
+    values = [measurement["value"] for measurement in measurements]
+    bucket_size = (len(measurements) - 2) / (max_points - 2)
+    kept = [measurements[0]]
+    previous = 0
+    for bucket in range(max_points - 2):
+        start = int(bucket * bucket_size) + 1
+        stop = int((bucket + 1) * bucket_size) + 1
+        next_start = stop
+        next_stop = min(int((bucket + 2) * bucket_size) + 1, len(measurements))
+        if next_start >= next_stop:
+            # The last bucket looks at the last point
+            next_start, next_stop = len(measurements) - 1, len(measurements)
+        average_time = sum(times[next_start:next_stop]) / (next_stop - next_start)
+        average_value = sum(values[next_start:next_stop]) / (next_stop - next_start)
+        largest_area = -1
+        largest_index = start
+        for index in range(start, stop):
+            area = abs((times[previous] - average_time) * (values[index] - values[previous])
+                       - (times[previous] - times[index]) * (average_value - values[previous]))
+            if area > largest_area:
+                largest_area = area
+                largest_index = index
+        kept.append(measurements[largest_index])
+        previous = largest_index
+    kept.append(measurements[-1])
+    return kept
+
+def downsample(measurements, max_points, aggregation, window):
+    # Reduces the measurements of one series to at most max_points
+    if len(measurements) <= max_points:
+        return measurements
+    measurements = sorted(measurements, key=lambda measurement: measurement["time"])
+    if aggregation == LTTB or window is None:
+        return lttb(measurements, max_points)
+    return aggregate(measurements, window, aggregation)
+
+def record_to_measurement(record):
+    # Converts a row of the aggregateWindow query, see create_downsampled_detector_measurements_query
+    return {
+        "value": record["value"],
+        "time": record["_time"],
+        "numberOfInputValuesUsed": record["numberOfInputValuesUsed"],
+        "errorReason": None,
+        "hasError": record["hasError"] == 1
+    }
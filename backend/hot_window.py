@@ -0,0 +1,268 @@
+import re
+import threading
+import time
+from datetime import datetime, timezone
+import numpy as np
+from line_protocol import parse_timestamp
+
+NANOSECONDS = {
+    "ns": 1,
+    "us": 1_000,
+    "ms": 1_000_000,
+    "s": 1_000_000_000,
+    "m": 60 * 1_000_000_000,
+    "h": 60 * 60 * 1_000_000_000,
+    "d": 24 * 60 * 60 * 1_000_000_000,
+    "w": 7 * 24 * 60 * 60 * 1_000_000_000,
+}
+DURATION_PART_PATTERN = re.compile(r"(\d+)(ns|us|ms|s|m|h|d|w)")
+EMPTY_TIME = np.iinfo(np.int64).min
+NO_ERROR_REASON = 0
+
+def parse_flux_duration(duration):
+    # Converts a Flux duration like 4h, 30m or 1h30m into nanoseconds. Returns None for everything
+    # we can not handle in memory (e.g calendar units like mo/y or absolute timestamps).
+    if duration is None:
+        return None
+    duration = duration.strip()
+    position = 0
+    nanoseconds = 0
+    for match in DURATION_PART_PATTERN.finditer(duration):
+        if match.start() != position:
+            return None
+        nanoseconds += int(match.group(1)) * NANOSECONDS[match.group(2)]
+        position = match.end()
+    if position == 0 or position != len(duration):
+        return None
+    return nanoseconds
+
+def parse_relative_start(time_str, now):
+    # Only relative ranges like -4h are served from memory
+    if time_str is None or not time_str.strip().startswith("-"):
+        return None
+    duration = parse_flux_duration(time_str.strip()[1:])
+    if duration is None:
+        return None
+    return now - duration
+
+def to_datetime(timestamp):
+    seconds, nanoseconds = divmod(int(timestamp), 1_000_000_000)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).replace(microsecond=nanoseconds // 1000)
+
+class HotWindow:
+    # Keeps the last hours of ingested measurements in memory so queries for recent time ranges do
+    # not need to go to InfluxDB. Every (detector id, index) series owns one row of fixed size ring
+    # buffers, stored column wise (time, value, error flag, error reason, number of input values).
+    def __init__(self, hours, period_seconds=60, initial_number_of_series=1024):
+        # A few extra slots so a range of exactly 'hours' is still fully covered
+        self.capacity = int(hours * 3600 // period_seconds) + 5
+        self.hours = hours
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.row_cantons = []
+        self.row_station_ids = []
+        self.error_reasons = [None]
+        self.error_reason_codes = {None: NO_ERROR_REASON}
+        self.first_timestamp = None
+        self.evicted_until = EMPTY_TIME
+        self._allocate(initial_number_of_series)
+
+    def _allocate(self, number_of_series):
+        shape = (number_of_series, self.capacity)
+        times = np.full(shape, EMPTY_TIME, dtype=np.int64)
+        values = np.zeros(shape, dtype=np.float64)
+        has_errors = np.zeros(shape, dtype=np.bool_)
+        error_reasons = np.zeros(shape, dtype=np.uint8)
+        number_of_input_values = np.zeros(shape, dtype=np.int32)
+        heads = np.zeros(number_of_series, dtype=np.int64)
+        # Like storage_schema.ERROR_FILTERS, errors of series without a canton or station are not counted
+        is_tagged = np.zeros(number_of_series, dtype=np.bool_)
+        if hasattr(self, "times"):
+            # Grow by copying the existing rows over
+            used = self.times.shape[0]
+            times[:used] = self.times
+            values[:used] = self.values
+            has_errors[:used] = self.has_errors
+            error_reasons[:used] = self.error_reason_column
+            number_of_input_values[:used] = self.number_of_input_values
+            heads[:used] = self.heads
+            is_tagged[:used] = self.is_tagged
+        self.times = times
+        self.values = values
+        self.has_errors = has_errors
+        self.error_reason_column = error_reasons
+        self.number_of_input_values = number_of_input_values
+        self.heads = heads
+        self.is_tagged = is_tagged
+
+    def _get_row(self, detector_id, index, canton, station_id):
+        key = (detector_id, index)
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.rows)
+            if row >= self.times.shape[0]:
+                self._allocate(self.times.shape[0] * 2)
+            self.rows[key] = row
+            self.row_cantons.append(canton)
+            self.row_station_ids.append(station_id)
+            self.is_tagged[row] = canton is not None and station_id is not None
+        return row
+
+    def _get_error_reason_code(self, error_reason):
+        code = self.error_reason_codes.get(error_reason)
+        if code is None:
+            code = len(self.error_reasons)
+            if code > np.iinfo(np.uint8).max:
+                # Should never happen, the feed only knows a handful of reasons
+                code = NO_ERROR_REASON
+            else:
+                self.error_reasons.append(error_reason)
+                self.error_reason_codes[error_reason] = code
+        return code
+
+    def append_msr(self, msr):
+        with self.lock:
+            # Collect the new points per row first so the ring buffers can be updated in one go
+            points = {}
+            timestamps = {}
+            for detector_measurement in msr["detector_measurements"]:
+                time_str = detector_measurement["time"]
+                timestamp = timestamps.get(time_str)
+                if timestamp is None:
+                    # Sites without a measurement time are stamped with the time of the append, like
+                    # their points are when written (see line_protocol.detector_measurements_to_lines)
+                    timestamp = time.time_ns() if time_str is None else parse_timestamp(time_str)
+                    timestamps[time_str] = timestamp
+                for sensor_measurement in detector_measurement["sensorMeasurements"]:
+                    row = self._get_row(detector_measurement["id"], int(sensor_measurement["index"]),
+                                        detector_measurement.get("canton"), detector_measurement.get("stationId"))
+                    points[row] = (
+                        timestamp,
+                        float(sensor_measurement["value"]),
+                        bool(sensor_measurement["hasError"]),
+                        self._get_error_reason_code(sensor_measurement["errorReason"]),
+                        int(sensor_measurement.get("numberOfInputValuesUsed", 0))
+                    )
+            if len(points) == 0:
+                return 0
+
+            rows = np.fromiter(points.keys(), dtype=np.int64, count=len(points))
+            columns = list(zip(*points.values()))
+            new_times = np.array(columns[0], dtype=np.int64)
+            # Only append points which are newer than the newest point of their row
+            newest_times = self.times[rows, (self.heads[rows] - 1) % self.capacity]
+            is_new = new_times > newest_times
+            rows = rows[is_new]
+            if len(rows) == 0:
+                return 0
+            slots = self.heads[rows]
+            evicted_times = self.times[rows, slots]
+            if len(evicted_times) > 0:
+                self.evicted_until = max(self.evicted_until, int(evicted_times.max()))
+            self.times[rows, slots] = new_times[is_new]
+            self.values[rows, slots] = np.array(columns[1], dtype=np.float64)[is_new]
+            self.has_errors[rows, slots] = np.array(columns[2], dtype=np.bool_)[is_new]
+            self.error_reason_column[rows, slots] = np.array(columns[3], dtype=np.uint8)[is_new]
+            self.number_of_input_values[rows, slots] = np.array(columns[4], dtype=np.int32)[is_new]
+            self.heads[rows] = (slots + 1) % self.capacity
+            if self.first_timestamp is None:
+                # The first pull holds the latest minute of every site but not what came before it,
+                # a stale site must not make the window claim the history up to its timestamp
+                self.first_timestamp = int(new_times[is_new].max())
+            return len(rows)
+
+    def _covers(self, start, now):
+        # Everything from start on must be in memory: ingested by this process, not yet evicted and
+        # within the hours the window keeps
+        return start is not None and self.first_timestamp is not None and start >= self.first_timestamp \
+            and start > self.evicted_until and start >= now - int(self.hours * NANOSECONDS["h"])
+
+    def get_start(self, time_str):
+        # Returns the start of the range in nanoseconds if it can be answered from memory, None otherwise
+        now = time.time_ns()
+        start = parse_relative_start(time_str, now)
+        with self.lock:
+            if self._covers(start, now):
+                return start
+        return None
+
+    def get_measurements(self, detector_id, index, start):
+        with self.lock:
+            row = self.rows.get((detector_id, int(index)))
+            if row is None:
+                return []
+            # Oldest to newest slot of the ring buffer
+            slots = (self.heads[row] + np.arange(self.capacity)) % self.capacity
+            times = self.times[row, slots]
+            slots = slots[times >= start]
+            times = self.times[row, slots].tolist()
+            values = self.values[row, slots].tolist()
+            has_errors = self.has_errors[row, slots].tolist()
+            error_reasons = self.error_reason_column[row, slots].tolist()
+            number_of_input_values = self.number_of_input_values[row, slots].tolist()
+        measurements = []
+        for timestamp, value, has_error, error_reason, number_of_input_values_used in zip(times, values, has_errors, error_reasons, number_of_input_values):
+            measurement = {
+                "value": value,
+                "time": to_datetime(timestamp),
+                "numberOfInputValuesUsed": number_of_input_values_used,
+                "errorReason": self.error_reasons[error_reason],
+                "hasError": has_error
+            }
+            measurements.append(measurement)
+        return measurements
+
+    def _count_errors_per_row(self, start):
+        used = len(self.rows)
+        is_counted = (self.times[:used] >= start) & self.has_errors[:used] & self.is_tagged[:used, np.newaxis]
+        return is_counted.sum(axis=1)
+
+    def get_number_of_errors_per_station(self, start):
+        with self.lock:
+            counts = self._count_errors_per_row(start).tolist()
+            station_ids = list(self.row_station_ids)
+        number_of_errors = {}
+        for station_id, count in zip(station_ids, counts):
+            if count > 0:
+                number_of_errors[station_id] = number_of_errors.get(station_id, 0) + count
+        return number_of_errors
+
+    def get_number_of_errors_per_canton(self, start):
+        with self.lock:
+            counts = self._count_errors_per_row(start).tolist()
+            cantons = list(self.row_cantons)
+        number_of_errors = {}
+        for canton, count in zip(cantons, counts):
+            if count > 0:
+                number_of_errors[canton] = number_of_errors.get(canton, 0) + count
+        return number_of_errors
+
+    def get_windowed_number_of_errors_per_canton(self, start, bin_size, stop):
+        # Same windows as aggregateWindow: aligned to the epoch and stamped with their (range limited) stop
+        with self.lock:
+            used = len(self.rows)
+            times = self.times[:used]
+            rows, slots = np.nonzero((times >= start) & self.has_errors[:used] & self.is_tagged[:used, np.newaxis])
+            error_times = times[rows, slots]
+            cantons = list(self.row_cantons)
+        window_stops = np.minimum((error_times // bin_size + 1) * bin_size, stop)
+        number_of_errors = {}
+        for row, window_stop in zip(rows.tolist(), window_stops.tolist()):
+            key = (cantons[row], window_stop)
+            number_of_errors[key] = number_of_errors.get(key, 0) + 1
+        return number_of_errors
+
+    def get_stats(self):
+        with self.lock:
+            number_of_series = len(self.rows)
+            allocated_bytes = sum(column.nbytes for column in [self.times, self.values, self.has_errors, self.error_reason_column, self.number_of_input_values, self.heads, self.is_tagged])
+            bytes_per_slot = sum(column.itemsize for column in [self.times, self.values, self.has_errors, self.error_reason_column, self.number_of_input_values])
+            slots_per_hour = self.capacity / self.hours
+        return {
+            "hours": self.hours,
+            "series": number_of_series,
+            "slotsPerSeries": self.capacity,
+            "allocatedBytes": allocated_bytes,
+            "bytesPerHour": int(bytes_per_slot * slots_per_hour * number_of_series),
+            "coveredFrom": None if self.first_timestamp is None else to_datetime(max(self.first_timestamp, self.evicted_until + 1))
+        }
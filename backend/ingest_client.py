@@ -0,0 +1,67 @@
+import asyncio
+import random
+import httpx
+
+DATEX2_PULL_URL = "https://api.opentransportdata.swiss/TDP/Soap_Datex2/Pull"
+PULL_MEASURED_DATA_SOAP_ACTION = "http://opentransportdata.swiss/TDP/Soap_Datex2/Pull/v1/pullMeasuredData"
+
+# Status codes for which it makes sense to try again, everything else is reported right away
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+class MsrClient:
+    # Async client for the Datex2 pull endpoint. The underlying connection pool is kept
+    # alive between pulls so we do not pay for a new TLS handshake every minute.
+    def __init__(self, payload, token, url=DATEX2_PULL_URL, timeout_seconds=30.0, connect_timeout_seconds=10.0,
+                 max_retries=3, backoff_seconds=1.0, max_backoff_seconds=30.0, keepalive_seconds=120.0):
+        self.payload = payload
+        self.url = url
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.headers = {
+            "Content-Type": "text/xml; charset=utf-8",
+            "Authorization": token,
+            "SOAPAction": PULL_MEASURED_DATA_SOAP_ACTION,
+            "Accept-Encoding": "gzip"
+        }
+        self.timeout = httpx.Timeout(timeout_seconds, connect=connect_timeout_seconds)
+        # The pull happens once a minute, therefore idle connections have to outlive the interval
+        self.limits = httpx.Limits(max_connections=4, max_keepalive_connections=2, keepalive_expiry=keepalive_seconds)
+        self.client = None
+
+    def _get_client(self):
+        # Created lazily so the client is bound to the event loop it is actually used from
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=self.timeout, limits=self.limits)
+        return self.client
+
+    def _get_backoff(self, attempt):
+        backoff = min(self.backoff_seconds * (2 ** attempt), self.max_backoff_seconds)
+        # Add some jitter so several instances do not retry in lockstep
+        return backoff * random.uniform(0.5, 1.0)
+
+    async def fetch(self):
+        # Returns the (already decompressed) response body of a MSR pull
+        client = self._get_client()
+        attempt = 0
+        while True:
+            try:
+                response = await client.post(self.url, headers=self.headers, content=self.payload)
+                if response.status_code not in RETRY_STATUS_CODES:
+                    response.raise_for_status()
+                    return response.content
+                error = f"status code {response.status_code}"
+            except httpx.TransportError as transport_error:
+                error = f"{type(transport_error).__name__} {transport_error}"
+
+            if attempt >= self.max_retries:
+                raise RuntimeError(f"Failed to pull MSR data after {attempt + 1} attempts, last error: {error}")
+            backoff = self._get_backoff(attempt)
+            print(f"Pulling MSR data failed ({error}), retrying in {backoff:.1f} seconds...")
+            await asyncio.sleep(backoff)
+            attempt += 1
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
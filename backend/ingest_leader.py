@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Several API workers (e.g uvicorn --workers 4) each import the app, but only one of them may pull,
+# spool and write the MSR. The worker which holds an exclusive lock on a file runs the ingest, the
+# others only answer requests. The operating system releases the lock when its process exits, so a
+# follower which keeps trying takes over after the leader died.
+
+LEADER = "leader"
+FOLLOWER = "follower"
+
+class IngestLeaderLock:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.attempts = 0
+        self.acquired_at = None
+
+    def try_acquire(self):
+        # Never blocks, returns whether this process is the leader
+        if self.file is not None:
+            return True
+        self.attempts += 1
+        directory = os.path.dirname(self.path)
+        if directory != "":
+            os.makedirs(directory, exist_ok=True)
+        file = open(self.path, "a+")
+        if fcntl is not None:
+            try:
+                fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                file.close()
+                return False
+        # Without fcntl (e.g on Windows) there is a single worker which always leads
+        file.seek(0)
+        file.truncate()
+        file.write(f"{os.getpid()}\n")
+        file.flush()
+        self.file = file
+        self.acquired_at = time.time()
+        return True
+
+    def release(self):
+        if self.file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
+
+    def get_leader_pid(self):
+        # As written by the current (or last) leader
+        try:
+            with open(self.path, "r") as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            return None
+
+    def get_role(self):
+        return LEADER if self.file is not None else FOLLOWER
+
+    def get_stats(self):
+        return {
+            "role": self.get_role(),
+            "pid": os.getpid(),
+            "leaderPid": self.get_leader_pid(),
+            "attempts": self.attempts,
+            "acquiredAt": self.acquired_at
+        }
+
+# Written by the leader, followed by the other workers
+LATEST_PULL_FILE_NAME = "latest_pull.xml"
+WRITTEN_FILE_NAME = "written"
+
+class SharedIngestState:
+    # What the followers need to know about the ingest, shared through files next to each other:
+    #
+    #   latest_pull.xml  the last pulled MSR document, followers parse it into their own hot window
+    #                    and push its changes to their own subscribers
+    #   written          changes whenever the leader wrote measurements into InfluxDB, followers
+    #                    drop their cached responses
+    #
+    # Both are replaced atomically, a follower reads either the old or the new content. Sharing is best
+    # effort, a follower which misses an update still serves everything from InfluxDB and its cached
+    # responses expire after their maximum age. A pull older than max_pull_age_seconds (e.g left over
+    # from an earlier run) is never followed.
+    def __init__(self, directory, max_pull_age_seconds=60.0):
+        self.directory = directory
+        self.max_pull_age_seconds = max_pull_age_seconds
+        os.makedirs(directory, exist_ok=True)
+        self.latest_pull_path = os.path.join(directory, LATEST_PULL_FILE_NAME)
+        self.written_path = os.path.join(directory, WRITTEN_FILE_NAME)
+        self.latest_pull_version = None
+        self.written_version = None
+        self.stats = {"publishedPulls": 0, "publishedWrites": 0, "followedPulls": 0, "skippedPulls": 0, "followedWrites": 0, "failures": 0}
+
+    def _replace(self, path, content):
+        # Unique per thread, the write callbacks run on threads of their own
+        temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temporary_path, "wb") as f:
+                f.write(content)
+            os.replace(temporary_path, path)
+            return True
+        except OSError as error:
+            self.stats["failures"] += 1
+            print(f"Failed to share {os.path.basename(path)} with the other workers because {error}")
+            return False
+
+    def publish_pull(self, content):
+        if isinstance(content, str):
+            content = content.encode("utf-8")
+        if self._replace(self.latest_pull_path, content):
+            self.stats["publishedPulls"] += 1
+
+    def publish_written(self):
+        # A timestamp instead of a counter so a restarted leader never repeats a version
+        if self._replace(self.written_path, str(time.time_ns()).encode("utf-8")):
+            self.stats["publishedWrites"] += 1
+
+    def _get_latest_pull_version(self):
+        try:
+            stat = os.stat(self.latest_pull_path)
+        except FileNotFoundError:
+            return None
+        # Replacing the file gives it a new inode
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def _is_outdated(self, version):
+        return time.time_ns() - version[1] > self.max_pull_age_seconds * 1e9
+
+    def _read_written_version(self):
+        try:
+            with open(self.written_path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def poll(self):
+        # Returns the latest pull if it changed since the last poll (otherwise None) and whether new
+        # measurements were written in the meantime
+        content = None
+        version = self._get_latest_pull_version()
+        if version is not None and version != self.latest_pull_version:
+            self.latest_pull_version = version
+            if self._is_outdated(version):
+                self.stats["skippedPulls"] += 1
+            else:
+                try:
+                    with open(self.latest_pull_path, "rb") as f:
+                        content = f.read()
+                    self.stats["followedPulls"] += 1
+                except FileNotFoundError:
+                    content = None
+        written_version = self._read_written_version()
+        written = written_version is not None and written_version != self.written_version
+        if written:
+            self.written_version = written_version
+            self.stats["followedWrites"] += 1
+        return content, written
+
+    def get_stats(self):
+        return {"directory": self.directory, **self.stats}
@@ -0,0 +1,162 @@
+import asyncio
+import math
+import time
+
+# What happens with a tick which is due while the previous pull is still being fetched
+SKIP = "skip"
+COALESCE = "coalesce"
+CATCH_UP = "catch_up"
+MISSED_TICK_POLICIES = [SKIP, COALESCE, CATCH_UP]
+
+def ensure_missed_tick_policy(policy):
+    if policy not in MISSED_TICK_POLICIES:
+        raise ValueError(f"Unknown missed tick policy '{policy}', available are {', '.join(MISSED_TICK_POLICIES)}")
+    return policy
+
+def get_next_tick(now, interval_seconds, offset_seconds):
+    # Ticks lie on a fixed grid (e.g every minute at offset seconds past it) instead of being counted
+    # from the end of the previous pull, so slow pulls never make the schedule drift
+    return (math.floor((now - offset_seconds) / interval_seconds) + 1) * interval_seconds + offset_seconds
+
+class IngestPipeline:
+    # Pulls, parses and writes the MSR as three stages connected by bounded queues, so the next pull is
+    # fetched while the previous one is still parsed or written:
+    #
+    #   ticker -> ticks -> fetch -> fetched -> parse -> parsed -> write -> complete
+    #
+    # fetch is a coroutine, parse and write run on threads and complete runs on the event loop with
+    # the result of write. A slow stage fills the queue in front of it, which eventually blocks the
+    # fetch stage. Ticks which are due in the meantime are handled by the missed tick policy:
+    #
+    #   skip      a tick is dropped unless the fetch stage is idle
+    #   coalesce  at most one tick waits, all further ones are merged into it
+    #   catch_up  up to max_pending_ticks wait and are pulled one after the other
+    #
+    # The lag is the time from a tick being due until its pull was written.
+    def __init__(self, fetch, parse, write, complete, interval_seconds=60.0, offset_seconds=0.0, missed_tick_policy=COALESCE,
+                 max_pending_ticks=5, queue_size=2, lag=None, ticks=None, cycles=None):
+        self.fetch = fetch
+        self.parse = parse
+        self.write = write
+        self.complete = complete
+        self.interval_seconds = interval_seconds
+        self.offset_seconds = offset_seconds % interval_seconds
+        self.missed_tick_policy = ensure_missed_tick_policy(missed_tick_policy)
+        self.max_pending_ticks = max_pending_ticks if missed_tick_policy == CATCH_UP else 1
+        self.queue_size = queue_size
+        # Optional metrics, see metrics.py
+        self.lag = lag
+        self.ticks = ticks
+        self.cycles = cycles
+        self.queues = None
+        self.tasks = []
+        self.fetching = False
+        self.next_tick = None
+        self.stats = {"scheduled": 0, "skipped": 0, "coalesced": 0, "dropped": 0, "completed": 0, "failed": 0}
+        self.last_lag_seconds = None
+
+    def start(self):
+        # Must be called on the running event loop
+        self.queues = {
+            "ticks": asyncio.Queue(self.max_pending_ticks),
+            "fetched": asyncio.Queue(self.queue_size),
+            "parsed": asyncio.Queue(self.queue_size)
+        }
+        loop = asyncio.get_running_loop()
+        self.tasks = [loop.create_task(worker()) for worker in [self._run_ticker, self._run_fetch, self._run_parse, self._run_write]]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def _count_tick(self, outcome):
+        self.stats[outcome] += 1
+        if self.ticks is not None:
+            self.ticks.inc(outcome=outcome)
+
+    def _schedule(self, tick):
+        ticks = self.queues["ticks"]
+        busy = self.fetching or not ticks.empty()
+        if self.missed_tick_policy == SKIP and busy:
+            self._count_tick("skipped")
+        elif self.missed_tick_policy == COALESCE and ticks.full():
+            self._count_tick("coalesced")
+        elif ticks.full():
+            self._count_tick("dropped")
+        else:
+            ticks.put_nowait(tick)
+            self._count_tick("scheduled")
+
+    async def _run_ticker(self):
+        self.next_tick = get_next_tick(time.time(), self.interval_seconds, self.offset_seconds)
+        while True:
+            await asyncio.sleep(max(self.next_tick - time.time(), 0.0))
+            # Every tick which passed while the loop was blocked (or the machine suspended) counts
+            now = time.time()
+            while self.next_tick <= now:
+                self._schedule(self.next_tick)
+                self.next_tick += self.interval_seconds
+
+    def _fail(self, stage, error):
+        self.stats["failed"] += 1
+        if self.cycles is not None:
+            self.cycles.inc(result="failure")
+        print(f"Failed to {stage} the latest msr data because of {error}")
+
+    async def _run_fetch(self):
+        while True:
+            tick = await self.queues["ticks"].get()
+            self.fetching = True
+            try:
+                content = await self.fetch()
+                # Blocks while the parse stage is behind, the fetch stage stays busy until then
+                await self.queues["fetched"].put((tick, content))
+            except Exception as error:
+                self._fail("fetch", error)
+            finally:
+                self.fetching = False
+
+    async def _run_parse(self):
+        while True:
+            tick, content = await self.queues["fetched"].get()
+            try:
+                msr = await asyncio.to_thread(self.parse, content)
+            except Exception as error:
+                self._fail("parse", error)
+                continue
+            await self.queues["parsed"].put((tick, msr))
+
+    async def _run_write(self):
+        while True:
+            tick, msr = await self.queues["parsed"].get()
+            try:
+                result = await asyncio.to_thread(self.write, msr)
+                self.complete(result)
+            except Exception as error:
+                self._fail("write", error)
+                continue
+            self.last_lag_seconds = time.time() - tick
+            self.stats["completed"] += 1
+            if self.lag is not None:
+                self.lag.observe(self.last_lag_seconds)
+            if self.cycles is not None:
+                self.cycles.inc(result="success")
+
+    def get_queue_sizes(self):
+        if self.queues is None:
+            return {}
+        return {name: queue.qsize() for name, queue in self.queues.items()}
+
+    def get_stats(self):
+        return {
+            "missedTickPolicy": self.missed_tick_policy,
+            "intervalSeconds": self.interval_seconds,
+            "offsetSeconds": self.offset_seconds,
+            "nextTick": self.next_tick,
+            "fetching": self.fetching,
+            "queues": self.get_queue_sizes(),
+            "lastLagSeconds": self.last_lag_seconds,
+            **self.stats
+        }
@@ -0,0 +1,182 @@
+import math
+import time
+from datetime import datetime, timezone, timedelta
+import storage_schema
+
+DETECTOR_MEASUREMENT = storage_schema.MEASUREMENTS[storage_schema.LEGACY]
+COMPACT_DETECTOR_MEASUREMENT = storage_schema.MEASUREMENTS[storage_schema.COMPACT]
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# Same escaping rules the InfluxDB client applies to keys and tag values
+TAG_ESCAPE_TABLE = str.maketrans({
+    "\\": "\\\\",
+    ",": "\\,",
+    " ": "\\ ",
+    "=": "\\=",
+    "\n": "\\n",
+    "\r": "\\r",
+    "\t": "\\t",
+})
+STRING_FIELD_ESCAPE_TABLE = str.maketrans({
+    "\\": "\\\\",
+    "\"": "\\\"",
+})
+
+def escape_tag_value(value):
+    escaped = str(value).translate(TAG_ESCAPE_TABLE)
+    if escaped.endswith("\\"):
+        escaped += " "
+    return escaped
+
+def format_float(value):
+    # Whole numbers do not need the trailing ".0" in line protocol
+    formatted = str(float(value))
+    if formatted.endswith(".0"):
+        return formatted[:-2]
+    return formatted
+
+def format_string_field(value):
+    return f'"{str(value).translate(STRING_FIELD_ESCAPE_TABLE)}"'
+
+def parse_timestamp(time_str):
+    # Converts a Datex2 timestamp like 2023-11-27T15:36:00.000000Z into nanoseconds since epoch
+    if time_str.endswith("Z"):
+        time_str = time_str[:-1] + "+00:00"
+    measurement_time = datetime.fromisoformat(time_str)
+    if measurement_time.tzinfo is None:
+        measurement_time = measurement_time.replace(tzinfo=timezone.utc)
+    return (measurement_time - EPOCH) // timedelta(microseconds=1) * 1000
+
+class LastSeenIndex:
+    # Remembers the newest timestamp written for each detector and index. Measurements which are
+    # not newer (e.g because the upstream feed did not advance) are dropped before they reach InfluxDB.
+    def __init__(self):
+        self.timestamps = {}
+        self.number_of_written_points = 0
+        self.number_of_skipped_points = 0
+
+    def is_new(self, detector_id, index, timestamp):
+        key = (detector_id, index)
+        last_timestamp = self.timestamps.get(key)
+        if last_timestamp is not None and timestamp <= last_timestamp:
+            self.number_of_skipped_points += 1
+            return False
+        self.timestamps[key] = timestamp
+        self.number_of_written_points += 1
+        return True
+
+    def get_stats(self):
+        return {
+            "writtenPoints": self.number_of_written_points,
+            "skippedPoints": self.number_of_skipped_points,
+            "trackedSeries": len(self.timestamps)
+        }
+
+class DetectorMeasurementTagSets:
+    # Caches the serialized measurement name and tag set for each detector and index. The parts
+    # which never change (canton, id, index, station id) are escaped once from the MST, the full
+    # tag set including error state and kind is built on first use and then reused every cycle.
+    def __init__(self, mst=None):
+        self.static_tags = {}
+        self.tag_sets = {}
+        for station in mst or []:
+            for detector in station["detectors"]:
+                for characteristic in detector["characteristics"]:
+                    self._create_static_tags(detector["id"], characteristic["index"], station["canton"], station["id"])
+
+    def _create_static_tags(self, detector_id, index, canton, station_id):
+        # Tags are emitted in sorted key order (canton, hasError, id, index, kind, stationId)
+        # which is the order InfluxDB stores them in anyway
+        canton_tag = "" if canton is None else f",canton={escape_tag_value(canton)}"
+        static_tags = (
+            f"{DETECTOR_MEASUREMENT}{canton_tag}",
+            f",id={escape_tag_value(detector_id)},index={int(index)}",
+            f",stationId={escape_tag_value(station_id)}"
+        )
+        self.static_tags[(detector_id, int(index))] = static_tags
+        return static_tags
+
+    def get(self, detector_id, index, has_error, kind, canton, station_id):
+        key = (detector_id, index, has_error, kind)
+        tag_set = self.tag_sets.get(key)
+        if tag_set is None:
+            static_tags = self.static_tags.get((detector_id, index))
+            if static_tags is None:
+                # Detector which is not (yet) part of the MST
+                static_tags = self._create_static_tags(detector_id, index, canton, station_id)
+            measurement_and_canton, id_and_index, station = static_tags
+            kind_tag = "none" if kind is None else escape_tag_value(kind)
+            tag_set = f"{measurement_and_canton},hasError={bool(has_error)}{id_and_index},kind={kind_tag}{station}"
+            self.tag_sets[key] = tag_set
+        return tag_set
+
+    def format_line(self, detector_id, index, canton, station_id, sensor_measurement, value, timestamp):
+        tag_set = self.get(detector_id, index, sensor_measurement["hasError"], sensor_measurement["kind"], canton, station_id)
+        error_reason = sensor_measurement["errorReason"]
+        error_reason = "\"none\"" if error_reason is None else format_string_field(error_reason)
+        number_of_input_values_used = int(sensor_measurement.get("numberOfInputValuesUsed", 0))
+        return f"{tag_set} errorReason={error_reason},numberOfInputValuesUsed={number_of_input_values_used}i,value={format_float(value)} {timestamp}"
+
+class CompactDetectorMeasurementTagSets:
+    # Tag sets of the compact schema (see storage_schema.py) only depend on the detector and index,
+    # the error state and reason are integer fields.
+    def __init__(self, mst=None):
+        self.tag_sets = {}
+        for station in mst or []:
+            for detector in station["detectors"]:
+                for characteristic in detector["characteristics"]:
+                    self._create_tag_set(detector["id"], int(characteristic["index"]), station["canton"], station["id"])
+
+    def _create_tag_set(self, detector_id, index, canton, station_id):
+        canton_tag = "" if canton is None else f",canton={escape_tag_value(canton)}"
+        tag_set = f"{COMPACT_DETECTOR_MEASUREMENT}{canton_tag},id={escape_tag_value(detector_id)},index={index},stationId={escape_tag_value(station_id)}"
+        self.tag_sets[(detector_id, index)] = tag_set
+        return tag_set
+
+    def get(self, detector_id, index, canton, station_id):
+        tag_set = self.tag_sets.get((detector_id, index))
+        if tag_set is None:
+            # Detector which is not (yet) part of the MST
+            tag_set = self._create_tag_set(detector_id, index, canton, station_id)
+        return tag_set
+
+    def format_line(self, detector_id, index, canton, station_id, sensor_measurement, value, timestamp):
+        tag_set = self.get(detector_id, index, canton, station_id)
+        error_reason = sensor_measurement["errorReason"]
+        error_code = storage_schema.get_error_code(error_reason)
+        # The text is only stored for reasons without a code
+        error_reason = f"errorReason={format_string_field(error_reason)}," if error_code == storage_schema.UNKNOWN_ERROR_CODE else ""
+        has_error = 1 if sensor_measurement["hasError"] else 0
+        number_of_input_values_used = int(sensor_measurement.get("numberOfInputValuesUsed", 0))
+        return f"{tag_set} errorCode={error_code}i,{error_reason}hasError={has_error}i,numberOfInputValuesUsed={number_of_input_values_used}i,value={format_float(value)} {timestamp}"
+
+def create_tag_sets(schema, mst=None):
+    if storage_schema.ensure_schema(schema) == storage_schema.COMPACT:
+        return CompactDetectorMeasurementTagSets(mst)
+    return DetectorMeasurementTagSets(mst)
+
+def detector_measurements_to_lines(detector_measurements, tag_sets, last_seen_index=None):
+    # Converts parsed MSR detector measurements into InfluxDB line protocol of the schema the tag sets
+    # belong to (see create_tag_sets). Each point is stamped with the measurement time of its site,
+    # the time of the write is only used if that is missing.
+    lines = []
+    timestamps = {}
+    for detector_measurement in detector_measurements:
+        detector_id = detector_measurement["id"]
+        canton = detector_measurement.get("canton")
+        station_id = detector_measurement.get("stationId")
+        time_str = detector_measurement.get("time")
+        # Usually all sites of a pull share the same few measurement times, parse each of them once
+        timestamp = timestamps.get(time_str)
+        if timestamp is None:
+            timestamp = time.time_ns() if time_str is None else parse_timestamp(time_str)
+            timestamps[time_str] = timestamp
+        for sensor_measurement in detector_measurement["sensorMeasurements"]:
+            value = float(sensor_measurement["value"])
+            if not math.isfinite(value):
+                continue
+            index = int(sensor_measurement["index"])
+            if last_seen_index is not None and not last_seen_index.is_new(detector_id, index, timestamp):
+                continue
+            lines.append(tag_sets.format_line(detector_id, index, canton, station_id, sensor_measurement, value, timestamp))
+    return lines
@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import sys
+import time
+import httpx
+
+# Sends requests to a running backend with an increasing number of concurrent clients and reports
+# the throughput and latency for each level, e.g
+#
+#   python load_test.py --url http://127.0.0.1:6969 --endpoint stations --concurrency 1,2,4,8,16
+#
+# With --distinct every request asks for a slightly different time range so the response cache can
+# not answer it and each request really reaches InfluxDB.
+
+ENDPOINTS = {
+    "stations": ("/stations", lambda time_str: {"canton": "all", "time": time_str}),
+    "cantons_total_number_of_errors": ("/cantons/total_number_of_errors", lambda time_str: {"canton": "all", "time": time_str}),
+    "cantons_number_of_errors": ("/cantons/number_of_errors", lambda time_str: {"canton": "all", "time": time_str, "binSize": "1h"}),
+    "detector_measurements": ("/detector_measurements", lambda time_str: {
+        "time": time_str,
+        "detectorMeasurements": [{"id": "CH:0002.01", "index": 11, "name": "CHALET-A-GOBET"}]
+    }),
+}
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+async def run_client(client, path, create_body, time_range, distinct, stop_at, latencies, errors, counter):
+    while time.perf_counter() < stop_at:
+        time_str = time_range
+        if distinct:
+            # e.g -24h becomes -86401s, -86402s, ...
+            counter[0] += 1
+            time_str = f"-{int(counter[0] + 86400)}s"
+        start = time.perf_counter()
+        try:
+            response = await client.post(path, json=create_body(time_str))
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except Exception as error:
+            errors.append(error)
+
+async def run_level(url, endpoint, concurrency, duration_seconds, time_range, distinct, counter):
+    path, create_body = ENDPOINTS[endpoint]
+    latencies = []
+    errors = []
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=url, limits=limits, timeout=120) as client:
+        start = time.perf_counter()
+        stop_at = start + duration_seconds
+        await asyncio.gather(*[
+            run_client(client, path, create_body, time_range, distinct, stop_at, latencies, errors, counter)
+            for _ in range(concurrency)
+        ])
+        duration = time.perf_counter() - start
+    if len(latencies) == 0:
+        print(f"{concurrency:>12}{0:>10}{0:>10.1f}{'-':>10}{'-':>10}{len(errors):>8}")
+        if len(errors) > 0:
+            print(f"First error: {errors[0]}")
+        return
+    print(f"{concurrency:>12}{len(latencies):>10}{len(latencies) / duration:>10.1f}"
+          f"{percentile(latencies, 0.5) * 1000:>10.0f}{percentile(latencies, 0.95) * 1000:>10.0f}{len(errors):>8}")
+
+async def run_load_test(url, endpoint, concurrency_levels, duration_seconds, time_range, distinct):
+    print(f"Load testing {url}{ENDPOINTS[endpoint][0]} for {duration_seconds}s per level...")
+    print(f"{'concurrency':>12}{'requests':>10}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'errors':>8}")
+    counter = [0]
+    for concurrency in concurrency_levels:
+        await run_level(url, endpoint, concurrency, duration_seconds, time_range, distinct, counter)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test the backend with an increasing number of concurrent clients")
+    parser.add_argument("--url", default="http://127.0.0.1:6969")
+    parser.add_argument("--endpoint", default="stations", choices=list(ENDPOINTS.keys()))
+    parser.add_argument("--concurrency", default="1,2,4,8,16", help="comma separated number of concurrent clients")
+    parser.add_argument("--duration", type=float, default=10, help="seconds per concurrency level")
+    parser.add_argument("--time", default="-24h", help="time range of the requests")
+    parser.add_argument("--distinct", action="store_true", help="vary the time range so the response cache is bypassed")
+    arguments = parser.parse_args()
+    try:
+        concurrency_levels = [int(level) for level in arguments.concurrency.split(",")]
+    except ValueError:
+        sys.exit(f"Invalid concurrency levels '{arguments.concurrency}', expected e.g 1,2,4,8")
+    asyncio.run(run_load_test(arguments.url, arguments.endpoint, concurrency_levels, arguments.duration, arguments.time, arguments.distinct))
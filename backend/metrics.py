@@ -0,0 +1,207 @@
+import bisect
+import contextvars
+import functools
+import math
+import threading
+import time
+from contextlib import contextmanager
+from fastapi.routing import APIRoute
+
+# Minimal Prometheus metrics, rendered in the text exposition format by /metrics, e.g
+#
+#   # HELP astra_ingest_stage_duration_seconds Duration of the stages of an ingest cycle
+#   # TYPE astra_ingest_stage_duration_seconds histogram
+#   astra_ingest_stage_duration_seconds_bucket{stage="parse",le="0.1"} 58
+#   ...
+#   astra_ingest_stage_duration_seconds_sum{stage="parse"} 5.43
+#   astra_ingest_stage_duration_seconds_count{stage="parse"} 60
+#
+# Metrics are updated from the event loop as well as from worker threads (e.g the write callbacks).
+
+# The charset is added by the response
+TEXT_MEDIA_TYPE = "text/plain; version=0.0.4"
+# Upper bounds in seconds, the same as the Prometheus client libraries use
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0, 2.5, 5.0, 7.5, 10.0]
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(label_names, label_values, extra=""):
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values)]
+    if extra != "":
+        labels.append(extra)
+    return "{" + ",".join(labels) + "}" if len(labels) > 0 else ""
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+class Metric:
+    def __init__(self, name, help, label_names=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def _get_label_values(self, labels):
+        return tuple(labels.get(name, "") for name in self.label_names)
+
+    def _render_header(self, metric_type):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {metric_type}"]
+
+class Counter(Metric):
+    def inc(self, amount=1, **labels):
+        label_values = self._get_label_values(labels)
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self.lock:
+            values = list(self.values.items())
+        lines = self._render_header("counter")
+        lines += [f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}" for label_values, value in values]
+        return lines
+
+class Gauge(Metric):
+    # Read when rendered, function returns a number or (with labels) a list of (label values, number)
+    def __init__(self, name, help, function, label_names=()):
+        super().__init__(name, help, label_names)
+        self.function = function
+
+    def render(self):
+        values = self.function()
+        if not isinstance(values, list):
+            values = [((), values)]
+        lines = self._render_header("gauge")
+        lines += [f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}" for label_values, value in values]
+        return lines
+
+class Histogram(Metric):
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, label_names)
+        self.buckets = list(buckets)
+
+    def observe(self, value, **labels):
+        label_values = self._get_label_values(labels)
+        # The last count is the +Inf bucket
+        position = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(label_values)
+            if series is None:
+                series = self.values[label_values] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0}
+            series["counts"][position] += 1
+            series["sum"] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        with self.lock:
+            values = [(label_values, list(series["counts"]), series["sum"]) for label_values, series in self.values.items()]
+        lines = self._render_header("histogram")
+        for label_values, counts, total in values:
+            cumulative_count = 0
+            for upper_bound, count in zip(self.buckets + [math.inf], counts):
+                cumulative_count += count
+                le = f'le="{format_value(float(upper_bound))}"'
+                lines.append(f"{self.name}_bucket{format_labels(self.label_names, label_values, le)} {cumulative_count}")
+            lines.append(f"{self.name}_sum{format_labels(self.label_names, label_values)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.label_names, label_values)} {cumulative_count}")
+        return lines
+
+class MetricsRegistry:
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self._add(Counter(self.prefix + name, help, label_names))
+
+    def gauge(self, name, help, function, label_names=()):
+        return self._add(Gauge(self.prefix + name, help, function, label_names))
+
+    def histogram(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(self.prefix + name, help, label_names, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+# Timings of the request currently handled, see MetricsMiddleware
+REQUEST_TIMINGS = contextvars.ContextVar("request_timings", default=None)
+
+def add_query_seconds(seconds):
+    # Counts towards the query phase of the current request (if any)
+    timings = REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings["querySeconds"] += seconds
+
+class TimedRoute(APIRoute):
+    # Tells the middleware which route a request belongs to and when the endpoint function returned,
+    # what happens from there until the response starts is FastAPI encoding the result (or nothing if
+    # the endpoint encoded it already)
+    def __init__(self, path, endpoint, **kwargs):
+        @functools.wraps(endpoint)
+        async def timed_endpoint(*endpoint_args, **endpoint_kwargs):
+            timings = REQUEST_TIMINGS.get()
+            if timings is not None:
+                timings["route"] = path
+            try:
+                return await endpoint(*endpoint_args, **endpoint_kwargs)
+            finally:
+                if timings is not None:
+                    timings["endpointReturnedAt"] = time.perf_counter()
+        super().__init__(path, timed_endpoint, **kwargs)
+
+class MetricsMiddleware:
+    # Plain ASGI middleware so streamed responses are timed until their last chunk was sent. Requests
+    # which never reached an endpoint (unknown paths, invalid bodies) are counted as "other" so the
+    # number of label values stays bounded, excluded paths are not timed at all.
+    def __init__(self, app, request_duration, request_phase_duration, excluded_paths=()):
+        self.app = app
+        self.request_duration = request_duration
+        self.request_phase_duration = request_phase_duration
+        self.excluded_paths = set(excluded_paths)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.excluded_paths:
+            await self.app(scope, receive, send)
+            return
+        timings = {"route": "other", "querySeconds": 0.0, "endpointReturnedAt": None, "responseStartedAt": None, "status": 500}
+        token = REQUEST_TIMINGS.set(timings)
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                timings["responseStartedAt"] = time.perf_counter()
+                timings["status"] = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            REQUEST_TIMINGS.reset(token)
+            duration = time.perf_counter() - start
+            endpoint = timings["route"]
+            self.request_duration.observe(duration, method=scope["method"], endpoint=endpoint, status=timings["status"])
+            if timings["endpointReturnedAt"] is not None:
+                # Streamed responses query while they are sent, their query time is complete only now
+                self.request_phase_duration.observe(timings["querySeconds"], endpoint=endpoint, phase="query")
+                if timings["responseStartedAt"] is not None:
+                    serialization_seconds = max(timings["responseStartedAt"] - timings["endpointReturnedAt"], 0.0)
+                    self.request_phase_duration.observe(serialization_seconds, endpoint=endpoint, phase="serialization")
@@ -0,0 +1,123 @@
+from influxdb_client import InfluxDBClient, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
+from dotenv import dotenv_values
+import argparse
+import json
+import os
+import sys
+import time
+import line_protocol
+import storage_schema
+from hot_window import parse_relative_start, parse_flux_duration
+from rollups import format_time
+
+# One shot migration of the detector measurements from the legacy into the compact storage schema
+# (see storage_schema.py), e.g
+#
+#   python migrate_schema.py --start -30d
+#
+# The legacy points are read chunk by chunk and written into the target bucket (the same bucket by
+# default). Afterwards set INFLUXDB_STORAGE_SCHEMA=compact in the '.env-local' file. Writing the same
+# chunk twice overwrites the points, an interrupted migration can therefore simply be started again.
+
+ENV_FILE_PATH = "./.env-local"
+MST_FILE_PATH = "./data/mst.json"
+WRITE_BATCH_SIZE = 5000
+
+LEGACY_CHUNK_QUERY = """
+    from(bucket: "%bucket%")
+        |> range(start: %start%, stop: %stop%)
+        |> filter(fn: (r) => r["_measurement"] == "detector_measurement")
+        |> pivot(rowKey:["_time"], columnKey: ["_field"], valueColumn: "_value")
+"""
+
+def ensure_file(file_path):
+    if not os.path.isfile(file_path):
+        sys.exit(f"Expected file '{file_path}' but was not found...")
+
+def load_secrets():
+    ensure_file(ENV_FILE_PATH)
+    return dotenv_values(ENV_FILE_PATH)
+
+def read_mst_from_file():
+    ensure_file(MST_FILE_PATH)
+    with open(MST_FILE_PATH, "r") as f:
+        return json.load(f)
+
+def parse_time(time_str, now):
+    # Relative (-30d) or absolute (2023-11-27T00:00:00Z) time
+    if time_str == "now()":
+        return now
+    start = parse_relative_start(time_str, now)
+    if start is not None:
+        return start
+    return line_protocol.parse_timestamp(time_str)
+
+def record_to_line(tag_sets, record):
+    sensor_measurement = {
+        "hasError": record["hasError"] == "True",
+        "errorReason": None if record["errorReason"] == "none" else record["errorReason"],
+        "numberOfInputValuesUsed": record["numberOfInputValuesUsed"],
+    }
+    timestamp = line_protocol.parse_timestamp(record["_time"].isoformat())
+    return tag_sets.format_line(record["id"], int(record["index"]), record.values.get("canton"),
+                                record.values.get("stationId"), sensor_measurement, record["value"], timestamp)
+
+def migrate_chunk(db_client, write_api, tag_sets, bucket, target_bucket, start, stop, delete_source):
+    query = LEGACY_CHUNK_QUERY.replace("%bucket%", bucket).replace("%start%", format_time(start)).replace("%stop%", format_time(stop))
+    lines = []
+    number_of_points = 0
+    for record in db_client.query_api().query_stream(query):
+        lines.append(record_to_line(tag_sets, record))
+        if len(lines) >= WRITE_BATCH_SIZE:
+            write_api.write(bucket=target_bucket, org=db_client.org, record=lines, write_precision=WritePrecision.NS)
+            number_of_points += len(lines)
+            lines = []
+    if len(lines) > 0:
+        write_api.write(bucket=target_bucket, org=db_client.org, record=lines, write_precision=WritePrecision.NS)
+        number_of_points += len(lines)
+    if delete_source and number_of_points > 0:
+        # Only delete once the chunk was written completely
+        db_client.delete_api().delete(start=format_time(start), stop=format_time(stop - 1),
+                                      predicate='_measurement="detector_measurement"', bucket=bucket, org=db_client.org)
+    return number_of_points
+
+def migrate(start_str, stop_str, chunk_str, target_bucket, delete_source):
+    secrets = load_secrets()
+    bucket = secrets["DOCKER_INFLUXDB_INIT_BUCKET"]
+    target_bucket = target_bucket or bucket
+    now = time.time_ns()
+    start = parse_time(start_str, now)
+    stop = parse_time(stop_str, now)
+    chunk = parse_flux_duration(chunk_str)
+    if chunk is None:
+        sys.exit(f"Invalid chunk size '{chunk_str}', expected a duration like 1h")
+
+    tag_sets = line_protocol.CompactDetectorMeasurementTagSets(read_mst_from_file())
+    db_client = InfluxDBClient(url=secrets["INFLUXDB_URL"], token=secrets["DOCKER_INFLUXDB_INIT_ADMIN_TOKEN"],
+                               org=secrets["DOCKER_INFLUXDB_INIT_ORG"], enable_gzip=True, timeout=60_000)
+    write_api = db_client.write_api(write_options=SYNCHRONOUS)
+    print(f"Migrating detector measurements of bucket '{bucket}' into '{target_bucket}' from {format_time(start)} to {format_time(stop)}...")
+    total_number_of_points = 0
+    migration_start = time.perf_counter()
+    try:
+        for chunk_start in range(start, stop, chunk):
+            chunk_stop = min(chunk_start + chunk, stop)
+            total_number_of_points += migrate_chunk(db_client, write_api, tag_sets, bucket, target_bucket, chunk_start, chunk_stop, delete_source)
+            duration = time.perf_counter() - migration_start
+            progress = (chunk_stop - start) / max(stop - start, 1)
+            print(f"{format_time(chunk_stop)}: {total_number_of_points} points migrated ({progress * 100:.1f}%, {total_number_of_points / duration:.0f} points/s)")
+    finally:
+        write_api.close()
+        db_client.close()
+    print(f"Done, migrated {total_number_of_points} points. Set INFLUXDB_STORAGE_SCHEMA={storage_schema.COMPACT} to use them.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migrate detector measurements from the legacy into the compact storage schema")
+    parser.add_argument("--start", default="-30d", help="relative (-30d) or absolute (2023-11-27T00:00:00Z) start")
+    parser.add_argument("--stop", default="now()")
+    parser.add_argument("--chunk", default="1h", help="time range read and written at once")
+    parser.add_argument("--target-bucket", default=None, help="defaults to the bucket of the '.env-local' file")
+    parser.add_argument("--delete-source", action="store_true", help="delete the legacy points of each migrated chunk")
+    arguments = parser.parse_args()
+    migrate(arguments.start, arguments.stop, arguments.chunk, arguments.target_bucket, arguments.delete_source)
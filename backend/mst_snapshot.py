@@ -0,0 +1,94 @@
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
+from datex2 import detector_id_to_station_id
+from station_index import encode_station
+
+# Compiled form of the MST written by preprocessing.py next to the JSON. It contains the stations
+# together with everything the app derives from them on startup, so a worker does not need to parse
+# and walk the JSON again. Layout:
+#
+#   magic (8 bytes) | version (uint32) | sha256 of the JSON it was compiled from (32 bytes) | pickle
+#
+# A snapshot with another version or compiled from another JSON is ignored. Besides the compiled MST it
+# holds the content hash of every measurement site record, so the next refresh only has to parse the
+# records which changed (see preprocessing.py), and what the refresh changed.
+SNAPSHOT_MAGIC = b"ASTRAMST"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_HEADER = struct.Struct("<8sI32s")
+
+def hash_file(file_path):
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+def compile_mst(mst, record_hashes=None, changes=None, previous_compiled_mst=None):
+    # Stations which did not change keep the JSON fragment of the previous compiled MST
+    previous_fragments = {}
+    if previous_compiled_mst is not None:
+        for station, fragment in zip(previous_compiled_mst["mst"], previous_compiled_mst["stationFragments"]):
+            previous_fragments[station["id"]] = (station, fragment)
+    station_fragments = []
+    for station in mst:
+        previous = previous_fragments.get(station["id"])
+        if previous is not None and previous[0] == station:
+            station_fragments.append(previous[1])
+        else:
+            station_fragments.append(encode_station(station))
+    detector_id_to_canton_mapping = {}
+    detector_id_to_station_id_mapping = {}
+    for station in mst:
+        for detector in station["detectors"]:
+            detector_id_to_canton_mapping[detector["id"]] = station["canton"]
+            detector_id_to_station_id_mapping[detector["id"]] = detector_id_to_station_id(detector["id"])
+    return {
+        "mst": mst,
+        "detectorIdToCanton": detector_id_to_canton_mapping,
+        "detectorIdToStationId": detector_id_to_station_id_mapping,
+        "cantonNames": sorted(set([station["canton"] for station in mst])),
+        "stationFragments": station_fragments,
+        # Detector id to the sha256 of its measurement site record
+        "recordHashes": record_hashes or {},
+        # Station ids the refresh which wrote the snapshot added, removed and changed
+        "changes": changes or {"added": [], "removed": [], "changed": []},
+    }
+
+def write_snapshot(snapshot_file_path, mst_file_path, record_hashes=None, changes=None, previous_compiled_mst=None):
+    with open(mst_file_path, "r") as f:
+        mst = json.load(f)
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, hash_file(mst_file_path))
+    compiled_mst = compile_mst(mst, record_hashes, changes, previous_compiled_mst)
+    # Write next to the target first so a running app never sees a half written snapshot
+    temporary_file_path = f"{snapshot_file_path}.tmp"
+    with open(temporary_file_path, "wb") as f:
+        f.write(header)
+        pickle.dump(compiled_mst, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temporary_file_path, snapshot_file_path)
+
+def read_snapshot(snapshot_file_path, mst_file_path):
+    # Returns the compiled MST or None if there is no usable snapshot
+    if not os.path.isfile(snapshot_file_path) or os.path.getsize(snapshot_file_path) <= SNAPSHOT_HEADER.size:
+        return None
+    with open(snapshot_file_path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            magic, version, mst_hash = SNAPSHOT_HEADER.unpack_from(mapped)
+            if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                print(f"Ignoring snapshot '{snapshot_file_path}' with unsupported version...")
+                return None
+            if os.path.isfile(mst_file_path) and mst_hash != hash_file(mst_file_path):
+                print(f"Ignoring snapshot '{snapshot_file_path}' because '{mst_file_path}' changed since it was compiled...")
+                return None
+            # Unpickle straight from the mapped pages, the views have to be released before the map is closed
+            with memoryview(mapped) as view:
+                with view[SNAPSHOT_HEADER.size:] as payload:
+                    return pickle.loads(payload)
+
+def load_compiled_mst(snapshot_file_path, mst_file_path):
+    # Prefers the snapshot and falls back to compiling the JSON
+    compiled_mst = read_snapshot(snapshot_file_path, mst_file_path)
+    if compiled_mst is not None:
+        return compiled_mst, "snapshot"
+    with open(mst_file_path, "r") as f:
+        return compile_mst(json.load(f)), "json"
@@ -1,17 +1,26 @@
 from lxml import etree as etree_lxml
+from io import BytesIO
 import os
 import json
+import hashlib
+import re
+import time
+import numpy as np
 import requests
 from dotenv import dotenv_values
 import csv
 import sys
 from pyproj import Transformer
+import datex2
+import mst_snapshot
+from datex2 import detector_id_to_station_id
 
 def ensure_file(file_path):
     if not os.path.isfile(file_path):
         sys.exit(f"Expected file '{file_path}' but was not found...")
 
 def convert_east_north_to_long_lat(east_lv95, north_lv95):
+    # Works for single values as well as for whole numpy arrays
     lat, lon = TRANSFORMER.transform(east_lv95, north_lv95)
     return (lon, lat)
 
@@ -27,6 +36,22 @@ def load_detector_names():
             detector_names[lcd] = name
     return detector_names
 
+def load_mst_location_information():
+    ensure_file(MST_LOCATIONS_FILE_PATH)
+    # Build up a lookup table where information about a station can easily be retrieved by id
+    mst_location_information = {}
+    with open(MST_LOCATIONS_FILE_PATH, "r") as f:
+        reader = csv.DictReader(f)
+        for row in reader:
+            id = int(row["id"])
+            mst_location_information[id] = {
+                "name": row["description"],
+                "canton": row["canton"],
+                "eastLv95": int(row["east_lv95"]),
+                "northLv95": int(row["north_lv95"])
+            }
+    return mst_location_information
+
 def load_detector_id_to_canton_mapping():
     ensure_file(MST_FILE_PATH)
     detector_id_canton_mapping = {}
@@ -42,6 +67,7 @@ def load_detector_id_to_canton_mapping():
 
 MST_LOCATIONS_FILE_PATH = "./data/mst_locations.csv"
 MST_FILE_PATH = "./data/mst.json"
+MST_SNAPSHOT_FILE_PATH = "./data/mst.snapshot"
 MSR_FILE_PATH = "./data/msr.json"
 PAYLOAD_MST_FILE_PATH = "./data/payload_pull_mst.xml"
 PAYLOAD_MSR_FILE_PATH = "./data/payload_pull_msr.xml"
@@ -54,13 +80,30 @@ DETECTOR_NAMES = load_detector_names()
 # Load the mapping so we know which detector id is mapped to which canton
 DETECTOR_ID_TO_CANTON_MAPPING = load_detector_id_to_canton_mapping()
 
+# Load the location information (name, canton and LV95 coordinates) of each station once
+MST_LOCATION_INFORMATION = load_mst_location_information()
+
 # Needed to convert from Swiss LV95 coordinate system to WGS84 (Longitude, Latitude)
 TRANSFORMER = Transformer.from_crs("EPSG:2056", "EPSG:4326")
 
-def detector_id_to_station_id(detector_id):
-    # Dectector Id: CH:0002.01
-    # Station Id: CH:0002
-    return detector_id.split(".")[0]
+# XPath expressions used while parsing the MST, compiled once instead of on every lookup
+MST_NAMESPACES = {
+    "dx223": datex2.DX223_NAMESPACE,
+}
+MEASUREMENT_SITE_RECORD_TAG = f"{{{datex2.DX223_NAMESPACE}}}measurementSiteRecord"
+# Measurement site records found in the raw document without parsing it, whatever prefix the namespace got
+RECORD_START_PATTERN = re.compile(rb"<(?:[\w.-]+:)?measurementSiteRecord[\s>]")
+RECORD_END_PATTERN = re.compile(rb"</(?:[\w.-]+:)?measurementSiteRecord\s*>")
+RECORD_ID_PATTERN = re.compile(rb'\sid="([^"]*)"')
+NAMESPACE_DECLARATION_PATTERN = re.compile(rb'\sxmlns(?::[\w.-]+)?="[^"]*"')
+LATITUDE_XPATH = etree_lxml.XPath(".//dx223:pointCoordinates//dx223:latitude", namespaces=MST_NAMESPACES)
+LONGITUDE_XPATH = etree_lxml.XPath(".//dx223:pointCoordinates//dx223:longitude", namespaces=MST_NAMESPACES)
+CHARACTERISTIC_XPATH = etree_lxml.XPath(".//dx223:measurementSpecificCharacteristics[@index]", namespaces=MST_NAMESPACES)
+PERIOD_XPATH = etree_lxml.XPath(".//dx223:period", namespaces=MST_NAMESPACES)
+SPECIFIC_MEASUREMENT_VALUE_TYPE_XPATH = etree_lxml.XPath(".//dx223:specificMeasurementValueType", namespaces=MST_NAMESPACES)
+VEHICLE_TYPE_XPATH = etree_lxml.XPath(".//dx223:vehicleType", namespaces=MST_NAMESPACES)
+DIRECTION_XPATH = etree_lxml.XPath(".//dx223:alertCDirectionCoded", namespaces=MST_NAMESPACES)
+SPECIFIC_LOCATION_XPATH = etree_lxml.XPath(".//dx223:specificLocation", namespaces=MST_NAMESPACES)
 
 
 def station_id_to_number_id(station_id):
@@ -68,57 +111,119 @@ def station_id_to_number_id(station_id):
     # Number Id: 2
     return int(station_id.split(":")[1])
 
-def enrich_stations(stations):
-    ensure_file(MST_LOCATIONS_FILE_PATH)
-    # Build up a lookup table where information about a station can easily be retrieved by id
-    mst_location_information = {}
-    with open(MST_LOCATIONS_FILE_PATH, "r") as f:
-        reader = csv.DictReader(f)
-        for row in reader:
-            id = int(row["id"])
-            mst_location_information[id] = {
-                "name": row["description"],
-                "canton": row["canton"],
-                "eastLv95": int(row["east_lv95"]),
-                "northLv95": int(row["north_lv95"])
-            }
+def record_timing(timings, stage, start):
+    # Timings are only collected when the caller passes a dictionary
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+
+def print_timings(timings):
+    total = sum(timings.values())
+    for stage, seconds in timings.items():
+        print(f"{stage:<30} {seconds * 1000:>10.2f} ms")
+    print(f"{'total':<30} {total * 1000:>10.2f} ms")
+
+def enrich_stations(stations, timings=None):
+    start = time.perf_counter()
+    mst_location_information_for_stations = [MST_LOCATION_INFORMATION[station["numberId"]] for station in stations]
+    east_lv95 = np.array([information["eastLv95"] for information in mst_location_information_for_stations], dtype=np.float64)
+    north_lv95 = np.array([information["northLv95"] for information in mst_location_information_for_stations], dtype=np.float64)
+    record_timing(timings, "enrich: lookup locations", start)
+
+    # Convert all coordinates at once instead of calling the transformer for every single station
+    start = time.perf_counter()
+    longitudes, latitudes = convert_east_north_to_long_lat(east_lv95, north_lv95)
+    longitudes = longitudes.tolist()
+    latitudes = latitudes.tolist()
+    record_timing(timings, "enrich: transform coordinates", start)
 
     # Enrich station with human readable names, location information and which canton they belong to
-    for station in stations:
-        station_id = station["numberId"]
-        mst_location_information_for_station = mst_location_information[station_id]
-        eastLv95 = mst_location_information_for_station["eastLv95"]
-        northLv95 = mst_location_information_for_station["northLv95"]
-        longitude, latitude = convert_east_north_to_long_lat(eastLv95, northLv95)
+    start = time.perf_counter()
+    for station, mst_location_information_for_station, longitude, latitude in zip(stations, mst_location_information_for_stations, longitudes, latitudes):
         station["name"] = mst_location_information_for_station["name"]
         station["canton"] = mst_location_information_for_station["canton"]
-        station["eastLv95"] = eastLv95
-        station["northLv95"] = northLv95
+        station["eastLv95"] = mst_location_information_for_station["eastLv95"]
+        station["northLv95"] = mst_location_information_for_station["northLv95"]
         station["longitude"] = longitude
         station["latitude"] = latitude
+    record_timing(timings, "enrich: update stations", start)
 
     return stations
 
-def parse_mst(xml_content):
-    # Load the xml content into a etree structure which
-    # can be queried with XPath expressions
-    tree = etree_lxml.fromstring(xml_content)
-    ns = {
-        "dx223": "http://datex2.eu/schema/2/2_0",
+def first_text(xpath, node):
+    nodes = xpath(node)
+    if len(nodes) > 0:
+        return nodes[0].text
+    return None
+
+def parse_characteristic(characteristic_node, detector_id):
+    characteristic = {}
+    index = characteristic_node.attrib["index"]
+    period = first_text(PERIOD_XPATH, characteristic_node)
+    if period is not None:
+        characteristic["period"] = int(period)
+    else:
+        print(
+            f"Could not find a period for characteristic with index {index} for detector {detector_id}")
+        characteristic["period"] = -1
+    characteristic["measurement"] = first_text(SPECIFIC_MEASUREMENT_VALUE_TYPE_XPATH, characteristic_node)
+    if characteristic["measurement"] is None:
+        print(
+            f"Could not find a measurement for characteristic with index {index} detector {detector_id}")
+    characteristic["vehicleType"] = first_text(VEHICLE_TYPE_XPATH, characteristic_node)
+    if characteristic["vehicleType"] is None:
+        print(
+            f"Could not find a vehicle type characteristic with index {index} for detector {detector_id}")
+    characteristic["index"] = int(index)
+    return characteristic
+
+def parse_detector(node):
+    detector = {
+        "id": node.attrib["id"],
+        "characteristics": [],
+        "latitude": float(LATITUDE_XPATH(node)[0].text),
+        "longitude": float(LONGITUDE_XPATH(node)[0].text)
     }
 
-    # Only select Records from ASTRA (CH)
-    detector_id_nodes = tree.xpath(
-        './/dx223:measurementSiteRecord[starts-with(@id, "CH")]',
-        namespaces=ns)
-
-    stations = list(dict())
-    current_station_id = ""
-    last_station_id = ""
+    # Each detector can have multiple characteristics identified by their index
+    characteristics = [parse_characteristic(characteristic_node, detector["id"]) for characteristic_node in CHARACTERISTIC_XPATH(node)]
+
+    detector["direction"] = first_text(DIRECTION_XPATH, node)
+    if detector["direction"] is None:
+        print(
+            f"Could not find a direction for detector {detector['id']}")
+
+    location_id = first_text(SPECIFIC_LOCATION_XPATH, node)
+    if location_id is not None:
+        detector["locationId"] = int(location_id)
+        detector["name"] = DETECTOR_NAMES.get(location_id, None)
+    else:
+        print(
+            f"Could not find a location id for detector {detector['id']}")
+        detector["locationId"] = -1
+
+    detector["characteristics"] = characteristics
+    return detector
+
+def iter_measurement_site_records(xml_content):
+    # Stream over the records so only one of them is kept in memory at a time
+    context = etree_lxml.iterparse(BytesIO(xml_content), events=("end",), tag=MEASUREMENT_SITE_RECORD_TAG)
+    for _, node in context:
+        # Only select Records from ASTRA (CH)
+        if node.get("id", "").startswith("CH"):
+            yield node
+        node.clear(keep_tail=True)
+        parent = node.getparent()
+        while node.getprevious() is not None:
+            del parent[0]
+    del context
+
+def parse_mst(xml_content, timings=None):
+    stations = []
     current_station = {}
-    for node in detector_id_nodes:
+    last_station_id = ""
+    start = time.perf_counter()
+    for node in iter_measurement_site_records(xml_content):
         current_station_id = detector_id_to_station_id(node.attrib["id"])
-        number_id = station_id_to_number_id(current_station_id)
         if current_station_id != last_station_id:
             if current_station:
                 stations.append(current_station)
@@ -126,178 +231,164 @@ def parse_mst(xml_content):
             last_station_id = current_station_id
 
             # Create a new station as we have a new id
-            current_station = {"id": current_station_id,
-                               "name": "",
-                               "canton": "",
-                               "numberId": number_id,
-                               "eastLv95": None,
-                               "northLv95": None,
-                               "longitude": None,
-                               "latitude": None,
-                               "detectors": []
-                               }
+            current_station = create_station(current_station_id)
 
         # We are on the same station, looping over the detectors.
         # Each station can have up to 9 different detectors each with
         # individual characteristics.
-
-        latitude_node = node.xpath(
-            ".//dx223:pointCoordinates//dx223:latitude", namespaces=ns)[0]
-        longitude_node = node.xpath(
-            ".//dx223:pointCoordinates//dx223:longitude", namespaces=ns)[0]
-
-        detector = {
-            "id": node.attrib["id"],
-            "characteristics": [],
-            "latitude": float(latitude_node.text),
-            "longitude": float(longitude_node.text)
-        }
-
-        characteristics = []
-
-        # Select all characteristics with an index attribute available
-        characteristic_nodes = node.xpath(
-            ".//dx223:measurementSpecificCharacteristics[@index]", namespaces=ns)
-        for characteristic_node in characteristic_nodes:
-            characteristic = {}
-            index = characteristic_node.attrib["index"]
-            period_nodes = characteristic_node.xpath(
-                ".//dx223:period", namespaces=ns)
-            if len(period_nodes) > 0:
-                characteristic["period"] = int(period_nodes[0].text)
-            else:
-                print(
-                    f"Could not find a period for characteristic with index {index} for detector {detector['id']}")
-                characteristic["period"] = -1
-            measurement_nodes = characteristic_node.xpath(
-                ".//dx223:specificMeasurementValueType", namespaces=ns)
-            if len(measurement_nodes) > 0:
-                characteristic["measurement"] = measurement_nodes[0].text
-            else:
-                print(
-                    f"Could not find a measurement for characteristic with index {index} detector {detector['id']}")
-                characteristic["measurement"] = None
-            vehicle_type_nodes = characteristic_node.xpath(
-                ".//dx223:vehicleType", namespaces=ns)
-            if len(vehicle_type_nodes) > 0:
-                characteristic["vehicleType"] = vehicle_type_nodes[0].text
-            else:
-                print(
-                    f"Could not find a vehicle type characteristic with index {index} for detector {detector['id']}")
-                characteristic["vehicleType"] = None
-
-            characteristic["index"] = int(index)
-            characteristics.append(characteristic)
-
-        direction_nodes = node.xpath(
-            ".//dx223:alertCDirectionCoded", namespaces=ns)
-        if len(direction_nodes) > 0:
-            detector["direction"] = direction_nodes[0].text
-        else:
-            print(
-                f"Could not find a direction for detector {detector['id']}")
-            detector["direction"] = None
-
-        specific_location_id_nodes = node.xpath(
-            ".//dx223:specificLocation", namespaces=ns)
-
-        if len(specific_location_id_nodes) > 0:
-            location_id = specific_location_id_nodes[0].text
-            detector["locationId"] = int(location_id)
-            detector["name"] = DETECTOR_NAMES.get(location_id, None)
-        else:
-            print(
-                f"Could not find a location id for detector {detector['id']}")
-            detector["locationId"] = -1
-
-        detector["characteristics"] = characteristics
-        current_station["detectors"].append(detector)
+        current_station["detectors"].append(parse_detector(node))
 
     stations.append(current_station)
+    record_timing(timings, "parse: measurement site records", start)
+
+    return enrich_stations(stations, timings)
+
+def iter_raw_measurement_site_records(xml_content):
+    # Yields the id and the raw bytes of every record from ASTRA (CH) without building a tree, which
+    # costs as much as parsing the records
+    position = 0
+    while True:
+        start_match = RECORD_START_PATTERN.search(xml_content, position)
+        if start_match is None:
+            return
+        end_match = RECORD_END_PATTERN.search(xml_content, start_match.end())
+        if end_match is None:
+            raise ValueError(f"Measurement site record at byte {start_match.start()} is not closed")
+        position = end_match.end()
+        id_match = RECORD_ID_PATTERN.search(xml_content, start_match.start(), xml_content.find(b">", start_match.start()))
+        if id_match is None:
+            continue
+        detector_id = id_match.group(1).decode("utf-8")
+        if detector_id.startswith("CH"):
+            yield detector_id, xml_content[start_match.start():position]
+
+def hash_measurement_site_record(raw_record):
+    # The raw bytes, a document which was only formatted differently is parsed completely once
+    return hashlib.sha256(raw_record).hexdigest()
+
+def parse_raw_measurement_site_records(xml_content, raw_records):
+    # The namespaces of the records are declared on their ancestors, the records are parsed in one go
+    # wrapped into an element which repeats every declaration found before the first record
+    if len(raw_records) == 0:
+        return []
+    first_record = RECORD_START_PATTERN.search(xml_content)
+    declarations = {}
+    for declaration in NAMESPACE_DECLARATION_PATTERN.findall(xml_content, 0, first_record.start()):
+        declarations[declaration.split(b"=", 1)[0].strip()] = declaration
+    wrapper = b"<records" + b"".join(declarations.values()) + b">" + b"".join(raw_records) + b"</records>"
+    return [parse_detector(node) for node in etree_lxml.fromstring(wrapper)]
+
+def create_station(station_id):
+    return {"id": station_id,
+            "name": "",
+            "canton": "",
+            "numberId": station_id_to_number_id(station_id),
+            "eastLv95": None,
+            "northLv95": None,
+            "longitude": None,
+            "latitude": None,
+            "detectors": []
+            }
 
-    return enrich_stations(stations)
-
-def parse_msr(xml_content):
-    tree = etree_lxml.fromstring(xml_content)
-    ns = {
-        "dx223": "http://datex2.eu/schema/2/2_0",
-        "xsi": "http://www.w3.org/2001/XMLSchema-instance"
+def refresh_mst(xml_content, previous_compiled_mst, timings=None):
+    # Incremental version of parse_mst. The raw bytes of every measurement site record are hashed, only
+    # the records whose hash differs from the previous refresh are parsed and only stations with a new
+    # or changed record are enriched. Returns the stations, the record hashes and the ids of the added,
+    # removed and changed stations.
+    previous_record_hashes = {}
+    previous_detectors = {}
+    previous_stations = {}
+    if previous_compiled_mst is not None:
+        previous_record_hashes = previous_compiled_mst.get("recordHashes", {})
+        for station in previous_compiled_mst["mst"]:
+            previous_stations[station["id"]] = station
+            for detector in station["detectors"]:
+                previous_detectors[detector["id"]] = detector
+
+    start = time.perf_counter()
+    record_hashes = {}
+    # Station id, its detectors (None until parsed) and whether any of them is parsed again
+    parsed_stations = []
+    changed_records = []
+    for detector_id, raw_record in iter_raw_measurement_site_records(xml_content):
+        station_id = detector_id_to_station_id(detector_id)
+        if len(parsed_stations) == 0 or parsed_stations[-1][0] != station_id:
+            parsed_stations.append((station_id, [], [False]))
+        record_hash = hash_measurement_site_record(raw_record)
+        record_hashes[detector_id] = record_hash
+        detector = previous_detectors.get(detector_id)
+        if detector is None or previous_record_hashes.get(detector_id) != record_hash:
+            detector = None
+            changed_records.append(raw_record)
+            parsed_stations[-1][2][0] = True
+        parsed_stations[-1][1].append(detector)
+    record_timing(timings, "hash: measurement site records", start)
+
+    start = time.perf_counter()
+    number_of_parsed_records = len(changed_records)
+    parsed_detectors = iter(parse_raw_measurement_site_records(xml_content, changed_records))
+    for _, detectors, has_parsed_detectors in parsed_stations:
+        if has_parsed_detectors[0]:
+            detectors[:] = [next(parsed_detectors) if detector is None else detector for detector in detectors]
+    record_timing(timings, "parse: changed measurement site records", start)
+
+    stations = []
+    stations_to_enrich = []
+    for station_id, detectors, has_parsed_detectors in parsed_stations:
+        previous_station = previous_stations.get(station_id)
+        if previous_station is not None and not has_parsed_detectors[0] \
+                and [detector["id"] for detector in previous_station["detectors"]] == [detector["id"] for detector in detectors]:
+            stations.append(previous_station)
+            continue
+        station = create_station(station_id)
+        station["detectors"] = detectors
+        stations.append(station)
+        stations_to_enrich.append(station)
+    if len(stations_to_enrich) > 0:
+        enrich_stations(stations_to_enrich, timings)
+
+    station_ids = set([station["id"] for station in stations])
+    changes = {
+        "added": sorted(station_ids - previous_stations.keys()),
+        "removed": sorted(previous_stations.keys() - station_ids),
+        "changed": sorted([
+            station["id"] for station in stations_to_enrich
+            if station["id"] in previous_stations and previous_stations[station["id"]] != station
+        ])
     }
+    print(f"Parsed {number_of_parsed_records} of {len(record_hashes)} measurement site records, "
+          f"{len(changes['added'])} stations added, {len(changes['removed'])} removed and {len(changes['changed'])} changed...")
+    return stations, record_hashes, changes
+
+def write_refreshed_mst(xml_content, timings=None, full=False):
+    # Writes the MST json and snapshot if anything changed since the last refresh. With full every
+    # record is parsed again (e.g after the detector names or station locations were updated).
+    previous_compiled_mst = None
+    if not full:
+        previous_compiled_mst = mst_snapshot.read_snapshot(MST_SNAPSHOT_FILE_PATH, MST_FILE_PATH)
+    result, record_hashes, changes = refresh_mst(xml_content, previous_compiled_mst, timings)
+    if previous_compiled_mst is not None and record_hashes == previous_compiled_mst["recordHashes"] \
+            and not any(changes.values()):
+        print("MST did not change, keeping the existing files...")
+        return
 
-    site_measurement_nodes = tree.xpath(
-        './/dx223:siteMeasurements',
-        namespaces=ns)
-
-    result = dict()
-    detector_measurements = []
-    for node in site_measurement_nodes:
-        current_detector_measurement = {}
-        current_sensor_measurements = []
-
-        id_node = node.xpath(
-            './/dx223:measurementSiteReference[@id]', namespaces=ns)[0]
-
-        time_node = node.xpath(
-            './/dx223:measurementTimeDefault', namespaces=ns)[0]
-
-        measured_value_nodes = node.xpath(
-            './/dx223:measuredValue[@index]', namespaces=ns)
-
-        for measured_value_node in measured_value_nodes:
-            index = int(measured_value_node.attrib["index"])
-            current_sensor_measurement = {}
-            measurement_kind = measured_value_node.xpath(
-                './/dx223:basicData/@xsi:type', namespaces=ns)[0]
-
-            has_data_error_nodes = measured_value_node.xpath(
-                './/dx223:basicData//dx223:dataError', namespaces=ns)
-
-            measured_value = 0
-            error_reason = None
-            kind = None
-            has_data_error = len(has_data_error_nodes) > 0
-            if has_data_error:
-                error_reason_node = measured_value_node.xpath(
-                    './/dx223:basicData//dx223:reasonForDataError//dx223:value', namespaces=ns)[0]
-                error_reason = error_reason_node.text
-            else:
-                if measurement_kind == "dx223:TrafficFlow":
-                    kind = "trafficFlow"
-                    value_node = measured_value_node.xpath(
-                        './/dx223:basicData//dx223:vehicleFlowRate', namespaces=ns)[0]
-                    measured_value = float(value_node.text)
-                elif measurement_kind == "dx223:TrafficSpeed":
-                    kind = "trafficSpeed"
-                    number_of_input_values_node = measured_value_node.xpath(
-                        './/dx223:basicData//dx223:averageVehicleSpeed[@numberOfInputValuesUsed]', namespaces=ns)[0]
-
-                    number_of_input_values_used = number_of_input_values_node.attrib[
-                        "numberOfInputValuesUsed"]
-                    value_node = measured_value_node.xpath(
-                        './/dx223:basicData//dx223:speed', namespaces=ns)[0]
-                    measured_value = float(value_node.text)
-                    current_sensor_measurement["numberOfInputValuesUsed"] = int(
-                        number_of_input_values_used)
-
-            current_sensor_measurement["value"] = measured_value
-            current_sensor_measurement["hasError"] = has_data_error
-            current_sensor_measurement["errorReason"] = error_reason
-            current_sensor_measurement["index"] = index
-            current_sensor_measurement["kind"] = kind
-
-            current_sensor_measurements.append(current_sensor_measurement)
-
-        detector_id = id_node.attrib["id"]
-        current_detector_measurement["id"] = detector_id
-        current_detector_measurement["time"] = time_node.text
-        current_detector_measurement["sensorMeasurements"] = current_sensor_measurements
-        current_detector_measurement["canton"] = DETECTOR_ID_TO_CANTON_MAPPING.get(detector_id, None)
-        current_detector_measurement["stationId"] = detector_id_to_station_id(detector_id)
-
-        detector_measurements.append(current_detector_measurement)
-
-    result["detector_measurements"] = detector_measurements
-    return result
+    start = time.perf_counter()
+    # Replaced in one step so an app starting meanwhile never reads a half written file
+    temporary_file_path = f"{MST_FILE_PATH}.tmp"
+    with open(temporary_file_path, "w") as f:
+        json.dump(result, f, indent=4)
+    os.replace(temporary_file_path, MST_FILE_PATH)
+    record_timing(timings, "write json", start)
+
+    start = time.perf_counter()
+    # Running apps pick up the new snapshot and swap it in (see app.py)
+    mst_snapshot.write_snapshot(MST_SNAPSHOT_FILE_PATH, MST_FILE_PATH, record_hashes, changes, previous_compiled_mst)
+    print(f"Wrote MST snapshot to '{MST_SNAPSHOT_FILE_PATH}'...")
+    record_timing(timings, "write snapshot", start)
+
+def parse_msr(xml_content):
+    # Single pass streaming parser, see datex2.py
+    return datex2.parse_msr(xml_content, DETECTOR_ID_TO_CANTON_MAPPING)
 
 
 def parse_msr_from_request():
@@ -323,7 +414,12 @@ def parse_msr_from_request():
     with open(MSR_FILE_PATH, "w") as f:
         json.dump(result, f, indent=4)
 
-def parse_mst_from_request():
+def write_mst_snapshot():
+    # Compiled form of the MST which the app loads on startup, see mst_snapshot.py
+    mst_snapshot.write_snapshot(MST_SNAPSHOT_FILE_PATH, MST_FILE_PATH)
+    print(f"Wrote MST snapshot to '{MST_SNAPSHOT_FILE_PATH}'...")
+
+def parse_mst_from_request(timings=None, full=False):
     token = SECRETS.get("OPEN_TRANSPORT_DATA_AUTH_TOKEN", "")
     if token == "":
         print("No token found, are you sure you created a '.env' file and specified a value for 'OPEN_TRANSPORT_DATA_AUTH_TOKEN'?")
@@ -341,11 +437,12 @@ def parse_mst_from_request():
         "Authorization": token,
         "SOAPAction": "http://opentransportdata.swiss/TDP/Soap_Datex2/Pull/v1/pullMeasurementSiteTable"
     }
+    start = time.perf_counter()
     response = requests.request("POST", url, headers=headers, data=payload)
-    result = parse_mst(response.text.encode())
+    xml_content = response.text.encode()
+    record_timing(timings, "fetch", start)
 
-    with open(MST_FILE_PATH, "w") as f:
-        json.dump(result, f, indent=4)
+    write_refreshed_mst(xml_content, timings, full)
 
 def parse_msr_from_file():
     file_path = "./data/msr_sample.xml"
@@ -359,23 +456,35 @@ def parse_msr_from_file():
     with open(MSR_FILE_PATH, "w") as f:
         json.dump(result, f, indent=4)
 
-def parse_mst_from_file():
+def parse_mst_from_file(timings=None, full=False):
     file_path = "./data/mst_sample.xml"
     ensure_file(file_path)
 
+    start = time.perf_counter()
     with open(file_path, "rb") as f:
         xml_content = f.read()
+    record_timing(timings, "read file", start)
 
-    result = parse_mst(xml_content)
-
-    with open(MST_FILE_PATH, "w") as f:
-        json.dump(result, f, indent=4)
+    write_refreshed_mst(xml_content, timings, full)
 
 
 
 if __name__ == "__main__":
-    # parse_mst_from_file()
-    parse_mst_from_request()
+    # Pass --snapshot to only compile the snapshot from the existing MST json
+    if "--snapshot" in sys.argv:
+        ensure_file(MST_FILE_PATH)
+        write_mst_snapshot()
+        sys.exit(0)
+
+    # Pass --timing to print how long each stage of the MST refresh took
+    timings = {} if "--timing" in sys.argv else None
+    # Pass --full to parse every measurement site record again instead of only the changed ones
+    full = "--full" in sys.argv
+
+    # parse_mst_from_file(timings, full)
+    parse_mst_from_request(timings, full)
+    if timings is not None:
+        print_timings(timings)
 
     # parse_msr_from_file()
     parse_msr_from_request()
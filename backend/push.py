@@ -0,0 +1,151 @@
+import asyncio
+import json
+import time
+
+# Sent instead of the pending events to a subscriber which did not keep up, it should re-fetch
+RESYNC_EVENT = b"event: resync\ndata: {}\n\n"
+# Comment line keeping idle connections (and proxies in between) open
+KEEPALIVE_EVENT = b": keepalive\n\n"
+
+def encode_json(content):
+    return json.dumps(content, separators=(",", ":"))
+
+class Subscription:
+    def __init__(self, detector_keys, max_pending_events):
+        # Set of (detector id, index) the subscriber wants the newest points of
+        self.detector_keys = detector_keys
+        self.events = asyncio.Queue(max_pending_events)
+
+class PushHub:
+    # Pushes what an ingest cycle brought to subscribed dashboards as server sent events, e.g
+    #
+    #   event: delta
+    #   data: {"time": "...", "stations": {"CH:0002": 3, ...}, "cantons": {"VD": 5, ...},
+    #          "detectorMeasurements": [{"id": "CH:0002.01", "index": 11, "value": 12.0, ...}]}
+    #
+    # stations and cantons contain the number of errors the cycle added (only non zero counts), so a
+    # client adds them to what it fetched before. detectorMeasurements only contains the subscribed
+    # detectors. The part every subscriber receives is encoded once per cycle and the points once per
+    # detector, a subscriber only costs a small queue so many idle connections are cheap.
+    def __init__(self, max_pending_events=16, keepalive_seconds=15.0):
+        self.max_pending_events = max_pending_events
+        self.keepalive_seconds = keepalive_seconds
+        self.subscriptions = set()
+        # Time of the newest measurement per detector, the feed repeats measurements between updates
+        self.last_times = {}
+        self.published = 0
+        self.resyncs = 0
+        self.last_publish_seconds = 0.0
+
+    def subscribe(self, detector_keys):
+        subscription = Subscription(frozenset(detector_keys), self.max_pending_events)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+
+    def create_delta(self, msr):
+        # CPU bound for a national MSR, meant to run on a thread. Returns None if nothing was new.
+        number_of_errors_per_station = {}
+        number_of_errors_per_canton = {}
+        points = {}
+        newest_time = None
+        for detector_measurement in msr["detector_measurements"]:
+            detector_id = detector_measurement["id"]
+            time_str = detector_measurement["time"]
+            # Without a measurement time the dashboards could not place the points
+            if time_str is None or self.last_times.get(detector_id) == time_str:
+                continue
+            self.last_times[detector_id] = time_str
+            if newest_time is None or time_str > newest_time:
+                newest_time = time_str
+            station_id = detector_measurement.get("stationId")
+            canton = detector_measurement.get("canton")
+            for sensor_measurement in detector_measurement["sensorMeasurements"]:
+                # Like storage_schema.ERROR_FILTERS, errors of sites without a canton or station are not counted
+                if sensor_measurement["hasError"] and station_id is not None and canton is not None:
+                    number_of_errors_per_station[station_id] = number_of_errors_per_station.get(station_id, 0) + 1
+                    number_of_errors_per_canton[canton] = number_of_errors_per_canton.get(canton, 0) + 1
+                points[(detector_id, int(sensor_measurement["index"]))] = (time_str, sensor_measurement)
+        if newest_time is None:
+            return None
+        return {
+            "time": newest_time,
+            "stations": number_of_errors_per_station,
+            "cantons": number_of_errors_per_canton,
+            "points": points
+        }
+
+    def _encode_point(self, key, point):
+        detector_id, index = key
+        time_str, sensor_measurement = point
+        return encode_json({
+            "id": detector_id,
+            "index": index,
+            "value": sensor_measurement["value"],
+            "time": time_str,
+            "numberOfInputValuesUsed": sensor_measurement.get("numberOfInputValuesUsed", 0),
+            "errorReason": sensor_measurement["errorReason"],
+            "hasError": sensor_measurement["hasError"]
+        })
+
+    def _put(self, subscription, event):
+        try:
+            subscription.events.put_nowait(event)
+        except asyncio.QueueFull:
+            # The subscriber fell behind, replace everything pending with a single resync
+            while not subscription.events.empty():
+                subscription.events.get_nowait()
+            subscription.events.put_nowait(RESYNC_EVENT)
+            self.resyncs += 1
+
+    def publish(self, delta):
+        # Must be called on the event loop
+        if delta is None or len(self.subscriptions) == 0:
+            return
+        start = time.perf_counter()
+        shared = encode_json({"time": delta["time"], "stations": delta["stations"], "cantons": delta["cantons"]})
+        # Without the closing brace so the points of a subscriber can be appended
+        prefix = f"event: delta\ndata: {shared[:-1]},\"detectorMeasurements\":["
+        shared_event = (prefix + "]}\n\n").encode("utf-8")
+        points = delta["points"]
+        encoded_points = {}
+        for subscription in self.subscriptions:
+            fragments = []
+            for key in subscription.detector_keys:
+                point = points.get(key)
+                if point is None:
+                    continue
+                fragment = encoded_points.get(key)
+                if fragment is None:
+                    fragment = self._encode_point(key, point)
+                    encoded_points[key] = fragment
+                fragments.append(fragment)
+            if len(fragments) == 0:
+                self._put(subscription, shared_event)
+            else:
+                self._put(subscription, (prefix + ",".join(fragments) + "]}\n\n").encode("utf-8"))
+        self.published += 1
+        self.last_publish_seconds = time.perf_counter() - start
+
+    async def events(self, detector_keys):
+        # Async generator over the server sent events of a new subscription, ends when the client went away
+        subscription = self.subscribe(detector_keys)
+        try:
+            yield b"event: subscribed\ndata: {}\n\n"
+            while True:
+                try:
+                    yield await asyncio.wait_for(subscription.events.get(), self.keepalive_seconds)
+                except asyncio.TimeoutError:
+                    yield KEEPALIVE_EVENT
+        finally:
+            self.unsubscribe(subscription)
+
+    def get_stats(self):
+        return {
+            "subscribers": len(self.subscriptions),
+            "published": self.published,
+            "resyncs": self.resyncs,
+            "lastPublishSeconds": self.last_publish_seconds
+        }
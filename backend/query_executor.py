@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Marks the end of a stream
+END_OF_STREAM = object()
+
+class QueryExecutor:
+    # The InfluxDB client is synchronous. Queries (including reading their results) therefore run on a
+    # bounded thread pool so a slow query never blocks the event loop. Each endpoint may only have a
+    # limited number of queries running at once, further requests wait for a free slot. Waiting and
+    # running together may take at most timeout_seconds.
+    def __init__(self, max_workers=8, max_concurrent_queries_per_endpoint=4, timeout_seconds=30.0):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="influxdb-query")
+        self.max_workers = max_workers
+        self.max_concurrent_queries_per_endpoint = max_concurrent_queries_per_endpoint
+        self.timeout_seconds = timeout_seconds
+        self.semaphores = {}
+        self.stats = {}
+
+    def _get_endpoint(self, endpoint):
+        # Created lazily so the semaphores belong to the running event loop
+        semaphore = self.semaphores.get(endpoint)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.max_concurrent_queries_per_endpoint)
+            self.semaphores[endpoint] = semaphore
+            self.stats[endpoint] = {"running": 0, "waiting": 0, "completed": 0, "failed": 0, "timeouts": 0, "totalSeconds": 0.0}
+        return semaphore, self.stats[endpoint]
+
+    async def _run_limited(self, semaphore, stats, function):
+        stats["waiting"] += 1
+        try:
+            await semaphore.acquire()
+        finally:
+            stats["waiting"] -= 1
+        stats["running"] += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, function)
+        finally:
+            stats["running"] -= 1
+            semaphore.release()
+
+    async def run(self, endpoint, function):
+        # Runs function (without arguments) for the given endpoint and returns its result
+        semaphore, stats = self._get_endpoint(endpoint)
+        start = time.perf_counter()
+        try:
+            result = await asyncio.wait_for(self._run_limited(semaphore, stats, function), self.timeout_seconds)
+        except asyncio.TimeoutError:
+            # The query thread itself is bounded by the timeout of the InfluxDB client
+            stats["timeouts"] += 1
+            raise TimeoutError(f"Query of '{endpoint}' did not finish within {self.timeout_seconds} seconds")
+        except Exception:
+            stats["failed"] += 1
+            raise
+        stats["completed"] += 1
+        stats["totalSeconds"] += time.perf_counter() - start
+        return result
+
+    async def stream(self, endpoint, function, batch_size=1000, max_pending_batches=4):
+        # Async generator over batches of the items of the iterator returned by function. The iterator
+        # is consumed on the thread pool, at most max_pending_batches wait for the client, after that
+        # the query thread waits as well so memory stays bounded however long the stream is. The
+        # endpoint slot is held until the stream finished or the client went away.
+        semaphore, stats = self._get_endpoint(endpoint)
+        stats["waiting"] += 1
+        try:
+            await asyncio.wait_for(semaphore.acquire(), self.timeout_seconds)
+        except asyncio.TimeoutError:
+            stats["timeouts"] += 1
+            raise TimeoutError(f"Query of '{endpoint}' did not start within {self.timeout_seconds} seconds")
+        finally:
+            stats["waiting"] -= 1
+
+        stats["running"] += 1
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        batches = asyncio.Queue()
+        free_slots = threading.Semaphore(max_pending_batches)
+        stopped = threading.Event()
+
+        def put(item):
+            while not free_slots.acquire(timeout=0.1):
+                if stopped.is_set():
+                    return False
+            loop.call_soon_threadsafe(batches.put_nowait, item)
+            return True
+
+        def produce():
+            try:
+                batch = []
+                for item in function():
+                    batch.append(item)
+                    if len(batch) >= batch_size:
+                        if not put(batch):
+                            return
+                        batch = []
+                if len(batch) > 0 and not put(batch):
+                    return
+                put(END_OF_STREAM)
+            except Exception as error:
+                put(error)
+
+        producer = loop.run_in_executor(self.executor, produce)
+        try:
+            while True:
+                try:
+                    item = await asyncio.wait_for(batches.get(), self.timeout_seconds)
+                except asyncio.TimeoutError:
+                    stats["timeouts"] += 1
+                    raise TimeoutError(f"Query of '{endpoint}' did not produce rows within {self.timeout_seconds} seconds")
+                free_slots.release()
+                if item is END_OF_STREAM:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+            stats["completed"] += 1
+        except BaseException:
+            stats["failed"] += 1
+            raise
+        finally:
+            # Lets the query thread give up if the client disconnected
+            stopped.set()
+            stats["running"] -= 1
+            stats["totalSeconds"] += time.perf_counter() - start
+            semaphore.release()
+            producer.add_done_callback(lambda future: future.exception())
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def get_stats(self):
+        return {
+            "maxWorkers": self.max_workers,
+            "maxConcurrentQueriesPerEndpoint": self.max_concurrent_queries_per_endpoint,
+            "timeoutSeconds": self.timeout_seconds,
+            "endpoints": {endpoint: dict(stats) for endpoint, stats in self.stats.items()}
+        }
@@ -0,0 +1,30 @@
+import json
+import random
+import re
+
+# Collapses the indentation of the query templates
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+class QueryLog:
+    # Logs InfluxDB queries as one JSON object per line, e.g
+    #
+    #   {"event": "query", "endpoint": "stations", "seconds": 0.184, "rows": 465, "slow": false, "query": "from(bucket: ..."}
+    #
+    # Printing every query costs real time under load, therefore only a sample of them is logged.
+    # Slow and failed queries are always logged. A sample rate of 0 only logs those.
+    def __init__(self, sample_rate=0.01, slow_query_seconds=1.0, max_query_length=2000):
+        self.sample_rate = sample_rate
+        self.slow_query_seconds = slow_query_seconds
+        self.max_query_length = max_query_length
+        self.random = random.Random()
+
+    def log(self, endpoint, query, seconds, rows=None, error=None):
+        slow = seconds >= self.slow_query_seconds
+        if error is None and not slow and self.random.random() >= self.sample_rate:
+            return
+        entry = {"event": "query", "endpoint": endpoint, "seconds": round(seconds, 4), "rows": rows, "slow": slow}
+        if error is not None:
+            entry["error"] = str(error)
+        # Only formatted when it is actually logged
+        entry["query"] = WHITESPACE_PATTERN.sub(" ", query).strip()[:self.max_query_length]
+        print(json.dumps(entry))
@@ -1,4 +1,5 @@
-from pydantic import BaseModel
+from typing import Literal
+from pydantic import BaseModel, Field
 from defaults import *
 
 class DetectorMeasurement(BaseModel):
@@ -9,11 +10,23 @@ class DetectorMeasurement(BaseModel):
 class DetectorMeasurementsBody(BaseModel):
     detectorMeasurements: list[DetectorMeasurement]
     time: str | None = DEFAULT_TIME_RANGE # Optional
+    maxPoints: int | None = Field(default=None, ge=2) # Optional, see downsampling.py
+    aggregation: Literal["mean", "min", "max", "lttb"] | None = "mean" # Optional
 
 class StationsBody(BaseModel):
     canton: str | None = "" # Optional
     time: str | None = DEFAULT_TIME_RANGE # Optional
 
+class StationsViewportBody(BaseModel):
+    # Bounding box in degrees (WGS84)
+    west: float
+    south: float
+    east: float
+    north: float
+    zoom: float = Field(ge=0, le=30) # Web map zoom level, 0 shows the whole world
+    canton: str | None = "" # Optional
+    time: str | None = DEFAULT_TIME_RANGE # Optional
+
 class CantonTotalNumberOfErrorsBody(BaseModel):
     canton: str | None = ""  # Optional
     time: str | None = DEFAULT_TIME_RANGE # Optional
@@ -0,0 +1,96 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+class ResponseCache:
+    # Size bounded LRU cache for endpoint responses. The data behind the endpoints only changes
+    # when an ingest cycle completed, which bumps the version and thereby invalidates all entries.
+    # Entries additionally expire after max_age_seconds because relative time ranges (e.g -4h) move on.
+    # Identical requests arriving while a response is being computed wait for that computation.
+    def __init__(self, max_entries=256, max_age_seconds=60.0):
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        # Can be bumped from other threads (e.g the write callback), it is only read on the event loop
+        self.version = 0
+        self.entries_version = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+
+    def invalidate(self):
+        self.version += 1
+
+    def _drop_outdated_entries(self):
+        if self.entries_version != self.version:
+            self.entries.clear()
+            self.entries_version = self.version
+
+    async def get_or_compute(self, key, compute):
+        # compute is a function without arguments returning an awaitable with the response
+        self._drop_outdated_entries()
+        version = self.version
+        entry = self.entries.get(key)
+        if entry is not None:
+            created_at, response = entry
+            if time.monotonic() - created_at <= self.max_age_seconds:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return response
+            del self.entries[key]
+
+        in_flight_key = (version, key)
+        future = self.in_flight.get(in_flight_key)
+        if future is not None:
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+            # The request which computed the response was cancelled (e.g its client disconnected),
+            # this one computes it instead
+            return await self.get_or_compute(key, compute)
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[in_flight_key] = future
+        try:
+            response = await compute()
+        except asyncio.CancelledError:
+            # Wakes up the coalesced requests, otherwise they would wait forever
+            future.cancel()
+            raise
+        except Exception as error:
+            future.set_exception(error)
+            # Mark the exception as retrieved in case nobody else was waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(response)
+            # Do not store responses which were computed from data that is outdated by now
+            self._drop_outdated_entries()
+            if version == self.version:
+                self.entries[key] = (time.monotonic(), response)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    self.evictions += 1
+            return response
+        finally:
+            del self.in_flight[in_flight_key]
+
+    def get_stats(self):
+        requests = self.hits + self.misses + self.coalesced
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "evictions": self.evictions,
+            "hitRatio": 0.0 if requests == 0 else (self.hits + self.coalesced) / requests,
+            "entries": len(self.entries),
+            "maxEntries": self.max_entries,
+            "version": self.version
+        }
@@ -0,0 +1,212 @@
+import time
+from influxdb_client import TaskCreateRequest, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
+from hot_window import parse_flux_duration, to_datetime
+
+# Error counts are pre aggregated by InfluxDB tasks into a separate bucket. Each rollup is built
+# from the next finer one (1m from the raw measurements, 15m from 1m and so on). The offset
+# gives late measurements (and the finer rollup) time to arrive before a bin is aggregated.
+ROLLUPS = [
+    # (bin size, offset)
+    ("1m", "2m"),
+    ("15m", "3m"),
+    ("1h", "4m"),
+    ("1d", "5m"),
+]
+STATION_ERROR_ROLLUP = "station_error_rollup"
+CANTON_ERROR_ROLLUP = "canton_error_rollup"
+# The tasks only roll up what arrives after they were created, older bins do not exist unless they
+# were backfilled. From when on the rollups are complete is kept as a point in the rollup bucket.
+ROLLUP_COVERAGE = "rollup_coverage"
+
+ROLLED_UP_SINCE_QUERY = """
+    from(bucket: "%rollup_bucket%")
+        |> range(start: 0)
+        |> filter(fn: (r) => r["_measurement"] == "%rollup_coverage%" and r["_field"] == "since")
+        |> last()
+"""
+
+ROLLUP_FROM_RAW_TEMPLATE = """
+    from(bucket: "%bucket%")
+        |> range(start: -task.every)
+        %error_filter%
+        |> group(columns: ["canton", "stationId"])
+        |> aggregateWindow(every: task.every, fn: count, createEmpty: false, timeSrc: "_start")
+"""
+ROLLUP_FROM_ROLLUP_TEMPLATE = """
+    from(bucket: "%rollup_bucket%")
+        |> range(start: -task.every)
+        |> filter(fn: (r) => r["_measurement"] == "%station_error_rollup%")
+        |> filter(fn: (r) => r["binSize"] == "%source_bin_size%")
+        |> group(columns: ["canton", "stationId"])
+        |> aggregateWindow(every: task.every, fn: sum, createEmpty: false, timeSrc: "_start")
+"""
+ROLLUP_TASK_TEMPLATE = """option task = {name: "%task_name%", every: %bin_size%, offset: %offset%}
+
+stations = %source%
+
+stations
+    |> map(fn: (r) => ({_time: r._time, _measurement: "%station_error_rollup%", _field: "numberOfErrors", _value: r._value, canton: r.canton, stationId: r.stationId, binSize: "%bin_size%"}))
+    |> to(bucket: "%rollup_bucket%")
+
+stations
+    |> group(columns: ["canton"])
+    |> aggregateWindow(every: task.every, fn: sum, createEmpty: false, timeSrc: "_start")
+    |> map(fn: (r) => ({_time: r._time, _measurement: "%canton_error_rollup%", _field: "numberOfErrors", _value: r._value, canton: r.canton, binSize: "%bin_size%"}))
+    |> to(bucket: "%rollup_bucket%")
+"""
+
+# Building blocks for queries which combine rollups with raw measurements
+RAW_SEGMENT_TEMPLATE = """
+    from(bucket: "%bucket%")
+        |> range(start: %start%, stop: %stop%)
+        %error_filter%%canton_filter%
+        |> map(fn: (r) => ({_time: r._time, _value: 1, canton: r.canton, stationId: r.stationId}))
+"""
+ROLLUP_SEGMENT_TEMPLATE = """
+    from(bucket: "%rollup_bucket%")
+        |> range(start: %start%, stop: %stop%)
+        |> filter(fn: (r) => r["_measurement"] == "%measurement%")
+        |> filter(fn: (r) => r["binSize"] == "%bin_size%")%canton_filter%
+        |> map(fn: (r) => ({_time: r._time, _value: r._value, %columns%}))
+"""
+
+def get_task_name(bin_size):
+    return f"error_rollup_{bin_size}"
+
+def create_rollup_task_flux(bin_size, offset, source_bin_size, bucket, rollup_bucket, error_filter):
+    if source_bin_size is None:
+        source = ROLLUP_FROM_RAW_TEMPLATE.strip().replace("%bucket%", bucket).replace("%error_filter%", error_filter)
+    else:
+        source = ROLLUP_FROM_ROLLUP_TEMPLATE.strip().replace("%source_bin_size%", source_bin_size)
+    return ROLLUP_TASK_TEMPLATE.replace("%source%", source) \
+        .replace("%task_name%", get_task_name(bin_size)) \
+        .replace("%bin_size%", bin_size) \
+        .replace("%offset%", offset) \
+        .replace("%station_error_rollup%", STATION_ERROR_ROLLUP) \
+        .replace("%canton_error_rollup%", CANTON_ERROR_ROLLUP) \
+        .replace("%rollup_bucket%", rollup_bucket)
+
+def get_rolled_up_since(db_client, rollup_bucket):
+    # Nanoseconds since epoch from which on the rollups are complete, None if that is not known (yet)
+    query = ROLLED_UP_SINCE_QUERY.replace("%rollup_bucket%", rollup_bucket).replace("%rollup_coverage%", ROLLUP_COVERAGE)
+    for table in db_client.query_api().query(query):
+        for record in table.records:
+            return int(record.get_value())
+    return None
+
+def set_rolled_up_since(db_client, rollup_bucket, since):
+    # Stamped with the time it was written, the last one written counts
+    with db_client.write_api(write_options=SYNCHRONOUS) as write_api:
+        write_api.write(bucket=rollup_bucket, org=db_client.org, record=f"{ROLLUP_COVERAGE} since={int(since)}i {time.time_ns()}",
+                        write_precision=WritePrecision.NS)
+
+def ensure_rollup_tasks(db_client, bucket, rollup_bucket, error_filter):
+    # Creates the rollup bucket and tasks if they do not exist yet and updates tasks whose script changed.
+    # Returns from when on the rollups are complete.
+    buckets_api = db_client.buckets_api()
+    if buckets_api.find_bucket_by_name(rollup_bucket) is None:
+        print(f"Creating bucket '{rollup_bucket}' for the error rollups...")
+        buckets_api.create_bucket(bucket_name=rollup_bucket, org=db_client.org)
+
+    tasks_api = db_client.tasks_api()
+    source_bin_size = None
+    for bin_size, offset in ROLLUPS:
+        flux = create_rollup_task_flux(bin_size, offset, source_bin_size, bucket, rollup_bucket, error_filter)
+        task_name = get_task_name(bin_size)
+        tasks = tasks_api.find_tasks(name=task_name)
+        if len(tasks) == 0:
+            print(f"Creating rollup task '{task_name}'...")
+            # The script already contains the task options (schedule and offset)
+            tasks_api.create_task(task_create_request=TaskCreateRequest(flux=flux, org=db_client.org, status="active",
+                                                                        description=f"Error counts per station and canton in {bin_size} bins"))
+        elif tasks[0].flux != flux:
+            print(f"Updating rollup task '{task_name}'...")
+            tasks[0].flux = flux
+            tasks_api.update_task(tasks[0])
+        source_bin_size = bin_size
+
+    since = get_rolled_up_since(db_client, rollup_bucket)
+    if since is None:
+        # Also for tasks which were created before the coverage was kept, they are only trusted from now on
+        since = time.time_ns()
+        print(f"Error rollups are complete from {format_time(since)} on...")
+        set_rolled_up_since(db_client, rollup_bucket, since)
+    return since
+
+def create_rollup_backfill_flux(bin_size, source_bin_size, bucket, rollup_bucket, error_filter, start, stop):
+    # The script of the rollup task run once over [start, stop), e.g for measurements written by
+    # backfill.py which are older than anything the task will ever look at
+    flux = create_rollup_task_flux(bin_size, "0s", source_bin_size, bucket, rollup_bucket, error_filter)
+    # Without the task options
+    flux = flux.split("\n", 1)[1]
+    return flux.replace("range(start: -task.every)", f"range(start: {format_time(start)}, stop: {format_time(stop)})") \
+        .replace("task.every", bin_size)
+
+def backfill_rollups(db_client, bucket, rollup_bucket, error_filter, start, stop):
+    # Builds all rollup levels for [start, stop) widened to whole days, one day at a time and finest
+    # level first because every level is built from the previous one. Existing bins are overwritten.
+    # A range which reaches the complete rollups extends them back to its start.
+    day = parse_flux_duration("1d")
+    start = start // day * day
+    stop = -(-stop // day) * day
+    since = get_rolled_up_since(db_client, rollup_bucket)
+    query_api = db_client.query_api()
+    for day_start in range(start, stop, day):
+        source_bin_size = None
+        for bin_size, _ in ROLLUPS:
+            query_api.query(create_rollup_backfill_flux(bin_size, source_bin_size, bucket, rollup_bucket, error_filter, day_start, day_start + day))
+            source_bin_size = bin_size
+        print(f"Built the error rollups of {format_time(day_start)}...")
+    if since is not None and start < since <= stop:
+        set_rolled_up_since(db_client, rollup_bucket, start)
+        print(f"Error rollups are complete from {format_time(start)} on...")
+
+def get_rollups(bin_size=None):
+    # Rollups which can be used for the given bin size (coarsest first), all of them without a bin size
+    rollups = []
+    for rollup_bin_size, offset in ROLLUPS:
+        rollup_nanoseconds = parse_flux_duration(rollup_bin_size)
+        if bin_size is not None and (rollup_nanoseconds > bin_size or bin_size % rollup_nanoseconds != 0):
+            continue
+        rollups.append((rollup_bin_size, rollup_nanoseconds, parse_flux_duration(offset)))
+    return list(reversed(rollups))
+
+def plan_segments(start, stop, rollups, now=None, since=None):
+    # Splits [start, stop) into segments which are answered by the coarsest rollup possible. A rollup
+    # bin can only be used once it is complete and its task ran (bin end + offset before now) and if it
+    # does not start before the rollups are complete (since). Whatever is left at the edges is handed to
+    # the next finer rollup and finally to the raw measurements.
+    now = stop if now is None else now
+    if start >= stop:
+        return []
+    if len(rollups) == 0:
+        return [(None, start, stop)]
+    bin_size, nanoseconds, offset = rollups[0]
+    rollup_start = -(-max(start, since or start) // nanoseconds) * nanoseconds
+    rollup_stop = min(stop, now - offset) // nanoseconds * nanoseconds
+    if rollup_start >= rollup_stop:
+        return plan_segments(start, stop, rollups[1:], now, since)
+    return plan_segments(start, rollup_start, rollups[1:], now, since) + [(bin_size, rollup_start, rollup_stop)] + \
+        plan_segments(rollup_stop, stop, rollups[1:], now, since)
+
+def format_time(timestamp):
+    # Flux time literal, e.g 2023-11-27T15:36:00.000000000Z
+    return f"{to_datetime(timestamp):%Y-%m-%dT%H:%M:%S}.{int(timestamp) % 1_000_000_000:09d}Z"
+
+def create_segments_query(segments, bucket, rollup_bucket, error_filter, measurement, columns, canton_filter):
+    # Union of all segments, each row has a _time, the number of errors as _value and the given columns
+    canton_filter = "" if canton_filter is None else f'\n        |> filter(fn: (r) => r["canton"] == "{canton_filter}")'
+    queries = []
+    for bin_size, start, stop in segments:
+        if bin_size is None:
+            query = RAW_SEGMENT_TEMPLATE.replace("%bucket%", bucket).replace("%error_filter%", error_filter)
+        else:
+            query = ROLLUP_SEGMENT_TEMPLATE.replace("%rollup_bucket%", rollup_bucket) \
+                .replace("%measurement%", measurement) \
+                .replace("%bin_size%", bin_size) \
+                .replace("%columns%", ", ".join([f"{column}: r.{column}" for column in columns]))
+        query = query.replace("%start%", format_time(start)).replace("%stop%", format_time(stop)).replace("%canton_filter%", canton_filter)
+        queries.append(f"segment{len(queries)} = {query.strip()}")
+    names = ", ".join([f"segment{index}" for index in range(len(queries))])
+    return "\n".join(queries) + f"\n\nunion(tables: [{names}])"
@@ -0,0 +1,73 @@
+import math
+
+# Clusters are formed on a grid whose cells get smaller with every zoom level, like map tiles
+# (zoom 0 covers 360 degrees of longitude) each split into this many cells per direction
+CLUSTER_CELLS_PER_TILE = 4
+
+class SpatialIndex:
+    # Uniform grid over the longitude and latitude of the stations, built once from the MST and never
+    # changed afterwards. A bounding box only visits the cells it overlaps. Stations are referred to by
+    # their position in the MST, which is also the order of the station index (see station_index.py).
+    def __init__(self, mst, cell_size=0.1):
+        self.cell_size = cell_size
+        self.longitudes = []
+        self.latitudes = []
+        self.cantons = []
+        self.station_ids = []
+        self.cells = {}
+        for position, station in enumerate(mst):
+            longitude = station.get("longitude")
+            latitude = station.get("latitude")
+            self.longitudes.append(longitude)
+            self.latitudes.append(latitude)
+            self.cantons.append(station["canton"])
+            self.station_ids.append(station["id"])
+            if longitude is None or latitude is None:
+                continue
+            self.cells.setdefault(self._get_cell(longitude, latitude), []).append(position)
+
+    def _get_cell(self, longitude, latitude):
+        return (math.floor(longitude / self.cell_size), math.floor(latitude / self.cell_size))
+
+    def query(self, west, south, east, north, canton=None):
+        # Positions of the stations within the bounding box (optionally of a single canton) in MST order
+        min_x, min_y = self._get_cell(west, south)
+        max_x, max_y = self._get_cell(east, north)
+        if (max_x - min_x + 1) * (max_y - min_y + 1) > len(self.cells):
+            # Box larger than the area covered by stations, looking at every occupied cell is cheaper
+            candidates = [position for positions in self.cells.values() for position in positions]
+        else:
+            candidates = []
+            for x in range(min_x, max_x + 1):
+                for y in range(min_y, max_y + 1):
+                    candidates.extend(self.cells.get((x, y), []))
+        return sorted([
+            position for position in candidates
+            if west <= self.longitudes[position] <= east and south <= self.latitudes[position] <= north
+            and (canton is None or self.cantons[position] == canton)
+        ])
+
+    def cluster(self, positions, zoom, station_id_to_error_number_mapping):
+        # Groups the stations into grid cells of the zoom level. Returns the positions of the stations
+        # which are alone in their cell and the clusters of the other cells with their summed errors.
+        cell_size = 360 / (2 ** zoom) / CLUSTER_CELLS_PER_TILE
+        cells = {}
+        for position in positions:
+            cell = (math.floor(self.longitudes[position] / cell_size), math.floor(self.latitudes[position] / cell_size))
+            cells.setdefault(cell, []).append(position)
+        single_positions = []
+        clusters = []
+        for cell_positions in cells.values():
+            if len(cell_positions) == 1:
+                single_positions.append(cell_positions[0])
+                continue
+            longitudes = [self.longitudes[position] for position in cell_positions]
+            latitudes = [self.latitudes[position] for position in cell_positions]
+            clusters.append({
+                "longitude": sum(longitudes) / len(longitudes),
+                "latitude": sum(latitudes) / len(latitudes),
+                "bounds": [min(longitudes), min(latitudes), max(longitudes), max(latitudes)],
+                "numberOfStations": len(cell_positions),
+                "numberOfErrors": sum([station_id_to_error_number_mapping.get(self.station_ids[position], 0) for position in cell_positions])
+            })
+        return sorted(single_positions), clusters
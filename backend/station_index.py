@@ -0,0 +1,60 @@
+import json
+
+ALL_CANTONS = "all"
+
+def encode_station(station):
+    fragment = json.dumps({**station, "numberOfErrors": 0}, separators=(",", ":"))
+    # Cut off the placeholder count and the closing brace
+    return fragment[:fragment.rindex(":") + 1].encode("utf-8")
+
+class StationIndex:
+    # Built once from the MST and never changed afterwards. Every station is encoded to JSON up front,
+    # leaving out the closing brace so the number of errors of a request can simply be appended:
+    #
+    #   {"id": "CH:0002", ..., "detectors": [...], "numberOfErrors": <count>}
+    #
+    # Serializing a response therefore only joins precomputed bytes and never touches the shared stations.
+    def __init__(self, mst, fragments=None):
+        # The fragments can be passed in precomputed (see mst_snapshot.py), they must be in MST order
+        self.station_ids = {ALL_CANTONS: []}
+        self.fragments = {ALL_CANTONS: []}
+        if fragments is None:
+            fragments = [encode_station(station) for station in mst]
+        for station, fragment in zip(mst, fragments):
+            for canton in [ALL_CANTONS, station["canton"]]:
+                self.station_ids.setdefault(canton, []).append(station["id"])
+                self.fragments.setdefault(canton, []).append(fragment)
+        # Common counts are encoded once as well
+        self.counts = [f"{count}}}".encode("utf-8") for count in range(1024)]
+
+    def get_station_ids(self, canton):
+        return self.station_ids.get(canton, [])
+
+    def _encode_count(self, count):
+        if 0 <= count < len(self.counts):
+            return self.counts[count]
+        return f"{count}}}".encode("utf-8")
+
+    def serialize(self, canton, station_id_to_error_number_mapping):
+        # JSON array of the stations of the canton (or all of them) each with its number of errors,
+        # stations without an entry in the mapping had no errors
+        fragments = self.fragments.get(canton)
+        if fragments is None:
+            return b"[]"
+        get_number_of_errors = station_id_to_error_number_mapping.get
+        encode_count = self._encode_count
+        return b"[" + b",".join([
+            fragment + encode_count(get_number_of_errors(station_id, 0))
+            for station_id, fragment in zip(self.station_ids[canton], fragments)
+        ]) + b"]"
+
+    def serialize_positions(self, positions, station_id_to_error_number_mapping):
+        # Same as serialize for the stations at the given positions of the MST (see spatial_index.py)
+        station_ids = self.station_ids[ALL_CANTONS]
+        fragments = self.fragments[ALL_CANTONS]
+        get_number_of_errors = station_id_to_error_number_mapping.get
+        encode_count = self._encode_count
+        return b"[" + b",".join([
+            fragments[position] + encode_count(get_number_of_errors(station_ids[position], 0))
+            for position in positions
+        ]) + b"]"
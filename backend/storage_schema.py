@@ -0,0 +1,75 @@
+# Two storage schemas are supported for the detector measurements:
+#
+#   legacy:  detector_measurement,canton,hasError,id,index,kind,stationId errorReason="..",numberOfInputValuesUsed=..i,value=..
+#   compact: detector_measurement_compact,canton,id,index,stationId errorCode=..i,hasError=0|1i,numberOfInputValuesUsed=..i,value=..
+#
+# In the legacy schema every change of the error state or kind starts a new series and the error
+# reason is a string field which is "none" for almost every point. The compact schema only keeps
+# tags which follow from the detector (canton and station do not add series) and stores the error
+# state and reason as integer fields.
+LEGACY = "legacy"
+COMPACT = "compact"
+SCHEMAS = [LEGACY, COMPACT]
+
+MEASUREMENTS = {
+    LEGACY: "detector_measurement",
+    COMPACT: "detector_measurement_compact",
+}
+
+# Codes are persisted, only ever append to this table
+NO_ERROR_CODE = 0
+UNKNOWN_ERROR_CODE = 255
+ERROR_REASON_CODES = {
+    None: NO_ERROR_CODE,
+    "VD_OFFLINE": 1,
+}
+ERROR_REASONS = {code: error_reason for error_reason, code in ERROR_REASON_CODES.items()}
+
+# Flux filters selecting points with an error, one row per point. Points of detectors without a
+# canton (or station) are not counted, the rollups group by both and could not store them, so the raw
+# queries must not count them either.
+TAGGED_FILTER = """|> filter(fn: (r) => exists r["canton"] and exists r["stationId"])"""
+ERROR_FILTERS = {
+    LEGACY: """|> filter(fn: (r) => r["_measurement"] == "detector_measurement")
+        |> filter(fn: (r) => r["hasError"] == "True")
+        |> filter(fn: (r) => r["_field"] == "value")
+        """ + TAGGED_FILTER,
+    COMPACT: """|> filter(fn: (r) => r["_measurement"] == "detector_measurement_compact")
+        |> filter(fn: (r) => r["_field"] == "hasError")
+        |> filter(fn: (r) => r["_value"] == 1)
+        """ + TAGGED_FILTER,
+}
+# Turns the rows of a detector into one per point with _value 1 for an error and 0 otherwise
+HAS_ERROR_VALUES = {
+    LEGACY: """|> filter(fn: (r) => r["_field"] == "value")
+        |> map(fn: (r) => ({r with _value: if r["hasError"] == "True" then 1 else 0}))""",
+    COMPACT: """|> filter(fn: (r) => r["_field"] == "hasError")""",
+}
+
+def ensure_schema(schema):
+    if schema not in SCHEMAS:
+        raise ValueError(f"Unknown storage schema '{schema}', available are {', '.join(SCHEMAS)}")
+    return schema
+
+def get_error_code(error_reason):
+    # Reasons without a code are stored as unknown together with their text
+    return ERROR_REASON_CODES.get(error_reason, UNKNOWN_ERROR_CODE)
+
+def record_to_measurement(schema, record):
+    # Converts a pivoted row of either schema into the measurement returned by the api
+    if schema == COMPACT:
+        error_code = record["errorCode"]
+        error_reason = ERROR_REASONS.get(error_code)
+        if error_code == UNKNOWN_ERROR_CODE:
+            error_reason = record.values.get("errorReason")
+        has_error = record["hasError"] == 1
+    else:
+        error_reason = None if record["errorReason"] == "none" else record["errorReason"]
+        has_error = False if record["hasError"] == "False" else True
+    return {
+        "value": record["value"],
+        "time": record["_time"],
+        "numberOfInputValuesUsed": record["numberOfInputValuesUsed"],
+        "errorReason": error_reason,
+        "hasError": has_error
+    }
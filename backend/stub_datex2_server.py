@@ -0,0 +1,69 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import argparse
+import gzip
+import os
+import sys
+
+# Minimal stand in for the Datex2 SOAP pull endpoint. It answers every POST with the
+# content of an MSR file so the ingest client can be exercised without a token, e.g
+#
+#   python stub_datex2_server.py --port 8081
+#
+# and DATEX2_PULL_URL=http://127.0.0.1:8081 in the '.env-local' file.
+
+MSR_SAMPLE_FILE_PATH = "./data/msr_sample.xml"
+
+def ensure_file(file_path):
+    if not os.path.isfile(file_path):
+        sys.exit(f"Expected file '{file_path}' but was not found...")
+
+def create_handler(body, compressed_body):
+    class StubDatex2Handler(BaseHTTPRequestHandler):
+        # HTTP/1.1 so connections are kept alive between requests
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            print(f"New connection from {self.client_address[0]}:{self.client_address[1]}")
+
+        def do_POST(self):
+            # Consume the SOAP request so the connection can be reused
+            content_length = int(self.headers.get("Content-Length", 0))
+            self.rfile.read(content_length)
+
+            accepts_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+            response_body = compressed_body if accepts_gzip else body
+            self.send_response(200)
+            self.send_header("Content-Type", "text/xml; charset=utf-8")
+            self.send_header("Content-Length", str(len(response_body)))
+            if accepts_gzip:
+                self.send_header("Content-Encoding", "gzip")
+            self.end_headers()
+            self.wfile.write(response_body)
+
+        def log_message(self, format, *args):
+            print(f"{self.address_string()} - {format % args}")
+
+    return StubDatex2Handler
+
+def run_stub_server(host, port, file_path):
+    ensure_file(file_path)
+    with open(file_path, "rb") as f:
+        body = f.read()
+    handler = create_handler(body, gzip.compress(body))
+    server = ThreadingHTTPServer((host, port), handler)
+    print(f"Serving '{file_path}' on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub Datex2 SOAP pull endpoint serving a MSR file")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--file", default=MSR_SAMPLE_FILE_PATH)
+    arguments = parser.parse_args()
+    run_stub_server(arguments.host, arguments.port, arguments.file)
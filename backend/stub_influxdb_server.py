@@ -0,0 +1,345 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from datetime import datetime, timezone
+import argparse
+import bisect
+import csv
+import gzip
+import io
+import json
+import re
+import threading
+import time
+from downsampling import parse_start
+from hot_window import parse_flux_duration
+
+# Minimal in memory stand in for InfluxDB, e.g
+#
+#   python stub_influxdb_server.py --port 8087
+#
+# with INFLUXDB_URL=http://127.0.0.1:8087 in the '.env-local' file, or started in process by
+# benchmark.py. Written line protocol is kept in memory. Flux is not evaluated, instead the shapes
+# of the queries the backend sends (error counts per station or canton, binned counts per canton and
+# the raw or downsampled rows of detectors) are recognized and answered from the written points.
+# Anything else is answered with an error so a new query shape does not go unnoticed. Tasks, buckets
+# and the other management endpoints do not exist, rollups therefore disable themselves.
+
+RANGE_PATTERN = re.compile(r"range\(start:\s*([^,)]+)(?:,\s*stop:\s*([^)]+))?\)")
+MEASUREMENT_PATTERN = re.compile(r'r\["_measurement"\] == "([^"]*)"')
+CANTON_PATTERN = re.compile(r'r\["canton"\] == "([^"]*)"')
+DETECTOR_PATTERN = re.compile(r'r\["id"\] == "([^"]*)" and r\["index"\] == "([^"]*)"')
+AGGREGATE_WINDOW_PATTERN = re.compile(r"aggregateWindow\(every:\s*([^,]+),\s*fn:\s*(\w+)")
+GROUP_PATTERN = re.compile(r'group\(columns:\s*\["(\w+)"\]\)')
+# Legacy rows with an error carry the tag hasError=True, compact ones the field hasError=1
+LEGACY_ERROR_FILTER = 'r["hasError"] == "True"'
+COMPACT_ERROR_FILTER = 'r["_value"] == 1'
+TAGGED_FILTER = 'exists r["canton"] and exists r["stationId"]'
+FIELD_PATTERN = re.compile(r'(\w+)=("(?:[^"\\]|\\.)*"|[^,]*)')
+TIME_COLUMNS = ["_start", "_stop", "_time"]
+
+class Series:
+    def __init__(self, measurement, tags):
+        self.measurement = measurement
+        self.tags = tags
+        # Sorted by time, one dictionary of fields per point
+        self.times = []
+        self.fields = []
+
+    def append(self, timestamp, fields):
+        if len(self.times) == 0 or timestamp > self.times[-1]:
+            self.times.append(timestamp)
+            self.fields.append(fields)
+            return
+        position = bisect.bisect_left(self.times, timestamp)
+        if position < len(self.times) and self.times[position] == timestamp:
+            # Same series and time overwrites, like InfluxDB does
+            self.fields[position] = {**self.fields[position], **fields}
+        else:
+            self.times.insert(position, timestamp)
+            self.fields.insert(position, fields)
+
+    def iter_points(self, start, stop):
+        begin = bisect.bisect_left(self.times, start)
+        end = bisect.bisect_left(self.times, stop)
+        for position in range(begin, end):
+            yield self.times[position], self.fields[position]
+
+def unescape(value):
+    return re.sub(r"\\(.)", r"\1", value)
+
+def split_unescaped(value, separator):
+    return [unescape(part) for part in re.split(r"(?<!\\)" + re.escape(separator), value)]
+
+def parse_field_value(value):
+    if value.startswith('"'):
+        return value[1:-1].replace('\\"', '"').replace("\\\\", "\\")
+    if value.endswith("i"):
+        return int(value[:-1])
+    if value in ("t", "T", "true", "True"):
+        return True
+    if value in ("f", "F", "false", "False"):
+        return False
+    return float(value)
+
+def format_time(timestamp):
+    seconds, nanoseconds = divmod(timestamp, 1_000_000_000)
+    return datetime.fromtimestamp(seconds, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S") + f".{nanoseconds:09d}Z"
+
+def is_error_query(query):
+    # The counting queries only look at the points with an error, see storage_schema.ERROR_FILTERS
+    return LEGACY_ERROR_FILTER in query or COMPACT_ERROR_FILTER in query
+
+def get_data_type(value):
+    if isinstance(value, bool):
+        return "boolean"
+    if isinstance(value, int):
+        return "long"
+    if isinstance(value, float):
+        return "double"
+    return "string"
+
+def format_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
+
+def to_annotated_csv(columns, data_types, group_columns, tables):
+    # Annotated CSV as returned by /api/v2/query, all tables share the same columns
+    output = io.StringIO()
+    writer = csv.writer(output, lineterminator="\r\n")
+    writer.writerow(["#datatype", "string", "long"] + [data_types[column] for column in columns])
+    writer.writerow(["#group", "false", "false"] + ["true" if column in group_columns else "false" for column in columns])
+    writer.writerow(["#default", "_result", ""] + [""] * len(columns))
+    writer.writerow(["", "result", "table"] + columns)
+    for table_id, rows in enumerate(tables):
+        for row in rows:
+            writer.writerow(["", "", table_id] + [format_value(row.get(column)) for column in columns])
+    writer.writerow([])
+    return output.getvalue()
+
+class StubInfluxDB:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Series key (measurement and tags as written) to its points
+        self.series = {}
+        self.number_of_points = 0
+        self.number_of_writes = 0
+        self.number_of_queries = 0
+        self.server = None
+        self.thread = None
+
+    def write(self, body):
+        number_of_points = 0
+        with self.lock:
+            for line in body.splitlines():
+                line = line.strip()
+                if line == "" or line.startswith("#"):
+                    continue
+                key, fields, timestamp = self._split_line(line)
+                series = self.series.get(key)
+                if series is None:
+                    measurement, *tags = split_unescaped(key, ",")
+                    series = Series(measurement, dict([tag.split("=", 1) for tag in tags]))
+                    self.series[key] = series
+                series.append(timestamp, {name: parse_field_value(value) for name, value in FIELD_PATTERN.findall(fields)})
+                number_of_points += 1
+            self.number_of_points += number_of_points
+            self.number_of_writes += 1
+        return number_of_points
+
+    def _split_line(self, line):
+        # The key ends at the first unescaped space, the timestamp starts after the last one
+        key_end = re.search(r"(?<!\\) ", line).start()
+        fields, _, timestamp = line[key_end + 1:].rpartition(" ")
+        return line[:key_end], fields, int(timestamp)
+
+    def iter_points(self, query, now, only_errors=False):
+        # Points of the range and measurement of the query, optionally only the ones with an error,
+        # of a canton or of the given detectors
+        match = RANGE_PATTERN.search(query)
+        if match is None:
+            raise ValueError("query without a range")
+        start = parse_start(match.group(1), now)
+        stop = now if match.group(2) is None else parse_start(match.group(2), now)
+        if start is None or stop is None:
+            raise ValueError(f"unsupported range '{match.group(0)}'")
+        measurement = MEASUREMENT_PATTERN.search(query)
+        canton = CANTON_PATTERN.search(query)
+        detector_keys = set(DETECTOR_PATTERN.findall(query))
+        only_tagged = TAGGED_FILTER in query
+        with self.lock:
+            series = list(self.series.values())
+        for current in series:
+            if measurement is not None and current.measurement != measurement.group(1):
+                continue
+            if canton is not None and current.tags.get("canton") != canton.group(1):
+                continue
+            if only_tagged and ("canton" not in current.tags or "stationId" not in current.tags):
+                continue
+            if len(detector_keys) > 0 and (current.tags.get("id"), current.tags.get("index")) not in detector_keys:
+                continue
+            if only_errors and current.tags.get("hasError", "True") != "True":
+                continue
+            for timestamp, fields in current.iter_points(start, stop):
+                if only_errors and fields.get("hasError", 1) != 1:
+                    continue
+                yield current, timestamp, fields
+
+    def query(self, query):
+        # Returns the annotated CSV of the query
+        with self.lock:
+            self.number_of_queries += 1
+        now = time.time_ns()
+        match = RANGE_PATTERN.search(query)
+        start = None if match is None else parse_start(match.group(1), now)
+        stop = now if match is None or match.group(2) is None else parse_start(match.group(2), now)
+        aggregate_window = AGGREGATE_WINDOW_PATTERN.search(query)
+        group = GROUP_PATTERN.search(query)
+        if "pivot(" in query and aggregate_window is not None:
+            return self._query_downsampled(query, now, aggregate_window)
+        if "pivot(" in query:
+            return self._query_rows(query, now, start, stop)
+        if group is not None and group.group(1) == "canton" and aggregate_window is not None:
+            return self._query_binned_counts(query, now, start, stop, aggregate_window)
+        if group is not None and group.group(1) in ("stationId", "canton"):
+            return self._query_counts(query, now, group.group(1))
+        raise ValueError("unsupported query shape")
+
+    def _query_counts(self, query, now, column):
+        counts = {}
+        for series, _, _ in self.iter_points(query, now, is_error_query(query)):
+            counts[series.tags.get(column)] = counts.get(series.tags.get(column), 0) + 1
+        tables = [[{column: key, "_value": count}] for key, count in sorted(counts.items(), key=lambda item: item[0] or "")]
+        return to_annotated_csv([column, "_value"], {column: "string", "_value": "long"}, [column], tables)
+
+    def _query_binned_counts(self, query, now, start, stop, aggregate_window):
+        every = parse_flux_duration(aggregate_window.group(1))
+        counts = {}
+        for series, timestamp, _ in self.iter_points(query, now, is_error_query(query)):
+            # Stamped with the end of the bin, the last one ends with the range
+            bin_stop = min(timestamp // every * every + every, stop)
+            key = (series.tags.get("canton"), bin_stop)
+            counts[key] = counts.get(key, 0) + 1
+        tables = {}
+        for (canton, bin_stop), count in sorted(counts.items(), key=lambda item: (item[0][0] or "", item[0][1])):
+            tables.setdefault(canton, []).append({"_start": format_time(start), "_stop": format_time(stop),
+                                                  "_time": format_time(bin_stop), "_value": count, "canton": canton})
+        columns = TIME_COLUMNS + ["_value", "canton"]
+        data_types = {"_start": "dateTime:RFC3339", "_stop": "dateTime:RFC3339", "_time": "dateTime:RFC3339", "_value": "long", "canton": "string"}
+        return to_annotated_csv(columns, data_types, ["_start", "_stop", "canton"], list(tables.values()))
+
+    def _query_rows(self, query, now, start, stop):
+        # Pivoted rows, one table per series
+        tables = {}
+        data_types = {"_start": "dateTime:RFC3339", "_stop": "dateTime:RFC3339", "_time": "dateTime:RFC3339", "_measurement": "string"}
+        tag_columns = set()
+        field_columns = set()
+        for series, timestamp, fields in self.iter_points(query, now):
+            for tag in series.tags:
+                data_types[tag] = "string"
+                tag_columns.add(tag)
+            for field, value in fields.items():
+                data_types.setdefault(field, get_data_type(value))
+                field_columns.add(field)
+            tables.setdefault(id(series), []).append({"_start": format_time(start), "_stop": format_time(stop), "_time": format_time(timestamp),
+                                                      "_measurement": series.measurement, **series.tags, **fields})
+        columns = TIME_COLUMNS + ["_measurement"] + sorted(tag_columns) + sorted(field_columns)
+        return to_annotated_csv(columns, data_types, ["_start", "_stop", "_measurement"] + sorted(tag_columns), list(tables.values()))
+
+    def _query_downsampled(self, query, now, aggregate_window):
+        # Rows of create_downsampled_detector_measurements_query, stamped with the start of the window
+        every = parse_flux_duration(aggregate_window.group(1))
+        function = {"mean": lambda values: sum(values) / len(values), "min": min, "max": max}[aggregate_window.group(2)]
+        windows = {}
+        for series, timestamp, fields in self.iter_points(query, now):
+            key = (series.tags.get("id"), series.tags.get("index"))
+            window = windows.setdefault(key, {}).setdefault(timestamp // every * every, [[], 0, 0])
+            window[0].append(fields.get("value", 0.0))
+            window[1] += fields.get("numberOfInputValuesUsed", 0)
+            has_error = series.tags.get("hasError") == "True" or fields.get("hasError") == 1
+            window[2] = max(window[2], 1 if has_error else 0)
+        tables = [[{"_time": format_time(window_start), "id": detector_id, "index": index, "value": float(function(values)),
+                    "numberOfInputValuesUsed": number_of_input_values_used, "hasError": has_error}
+                   for window_start, (values, number_of_input_values_used, has_error) in sorted(detector_windows.items())]
+                  for (detector_id, index), detector_windows in windows.items()]
+        columns = ["_time", "id", "index", "hasError", "numberOfInputValuesUsed", "value"]
+        data_types = {"_time": "dateTime:RFC3339", "id": "string", "index": "string", "hasError": "long", "numberOfInputValuesUsed": "long", "value": "double"}
+        return to_annotated_csv(columns, data_types, ["id", "index"], tables)
+
+    def get_stats(self):
+        with self.lock:
+            return {"series": len(self.series), "points": self.number_of_points, "writes": self.number_of_writes, "queries": self.number_of_queries}
+
+    def start(self, host="127.0.0.1", port=0):
+        # Serves on a background thread, port 0 picks a free one. Returns the url.
+        self.server = ThreadingHTTPServer((host, port), create_handler(self))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return f"http://{host}:{self.server.server_address[1]}"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def create_handler(stub):
+    class StubInfluxDBHandler(BaseHTTPRequestHandler):
+        # HTTP/1.1 so connections are kept alive between requests
+        protocol_version = "HTTP/1.1"
+
+        def _read_body(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            return body
+
+        def _send(self, status, body=b"", content_type="application/json"):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _send_error(self, status, code, message):
+            self._send(status, json.dumps({"code": code, "message": message}).encode("utf-8"))
+
+        def do_GET(self):
+            if self.path.startswith("/ping") or self.path.startswith("/health"):
+                self._send(200, json.dumps({"status": "pass", **stub.get_stats()}).encode("utf-8"))
+            else:
+                self._send_error(404, "not found", f"{self.path} is not supported by the stub")
+
+        def do_POST(self):
+            body = self._read_body()
+            if self.path.startswith("/api/v2/write"):
+                stub.write(body.decode("utf-8"))
+                self._send(204)
+            elif self.path.startswith("/api/v2/query"):
+                try:
+                    content = stub.query(json.loads(body)["query"])
+                except Exception as error:
+                    self._send_error(400, "invalid", f"stub can not answer the query: {error}")
+                    return
+                self._send(200, content.encode("utf-8"), "text/csv; charset=utf-8")
+            else:
+                self._send_error(404, "not found", f"{self.path} is not supported by the stub")
+
+        def log_message(self, format, *args):
+            pass
+
+    return StubInfluxDBHandler
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="In memory stand in for InfluxDB answering the queries of the backend")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8087)
+    arguments = parser.parse_args()
+    stub = StubInfluxDB()
+    print(f"Serving a stub InfluxDB on {stub.start(arguments.host, arguments.port)}")
+    try:
+        stub.thread.join()
+    except KeyboardInterrupt:
+        stub.stop()
@@ -0,0 +1,292 @@
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime, timezone
+from random import Random
+
+# Synthetic MST and MSR documents of any size, built from the real topology in mst.json. The
+# stations, detectors and indices can be scaled independently, e.g
+#
+#   python synthetic_datex2.py --stations 4650 --detectors 4 --indices 8 --error-rate 0.05 --cycles 60
+#
+# writes mst.xml, the matching mst.json and one gzipped MSR per minute (which backfill.py can load)
+# into ./data/synthetic. The same seed always produces the same documents, so benchmark results of
+# two commits are comparable (see benchmark.py).
+
+MST_FILE_PATH = "./data/mst.json"
+DEFAULT_OUTPUT_DIRECTORY = "./data/synthetic"
+DEFAULT_ERROR_RATE = 0.02
+DEFAULT_SEED = 42
+ERROR_REASON = "VD_OFFLINE"
+# Indices a detector gets beyond the real ones belong to made up vehicle classes, 31/32, 41/42, ...
+# (10 * class + 1 for the flow and + 2 for the speed, like the real indices)
+FIRST_SYNTHETIC_VEHICLE_CLASS = 3
+SYNTHETIC_MEASUREMENTS = ["trafficFlow", "trafficSpeed"]
+
+DOCUMENT_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<SOAP-ENV:Envelope xmlns:SOAP-ENV="http://schemas.xmlsoap.org/soap/envelope/" xmlns:SOAP-ENC="http://schemas.xmlsoap.org/soap/encoding/" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xmlns:xsd="http://www.w3.org/2001/XMLSchema" xmlns:tdpplv1="http://datex2.eu/wsdl/TDP/Soap_Datex2/Pull/v1" xmlns:dx223="http://datex2.eu/schema/2/2_0">
+    <SOAP-ENV:Body>
+        <dx223:d2LogicalModel xsi:type="dx223:D2LogicalModel" modelBaseVersion="2">
+            <dx223:exchange xsi:type="dx223:Exchange">
+                <dx223:supplierIdentification xsi:type="dx223:InternationalIdentifier">
+                    <dx223:country xsi:type="dx223:CountryEnum">ch</dx223:country>
+                    <dx223:nationalIdentifier xsi:type="dx223:String">OTD</dx223:nationalIdentifier>
+                </dx223:supplierIdentification>
+            </dx223:exchange>
+            <dx223:payloadPublication xsi:type="dx223:%publication_type%" lang="en">
+                <dx223:publicationTime xsi:type="dx223:DateTime">%publication_time%</dx223:publicationTime>
+                <dx223:publicationCreator xsi:type="dx223:InternationalIdentifier">
+                    <dx223:country xsi:type="dx223:CountryEnum">ch</dx223:country>
+                    <dx223:nationalIdentifier xsi:type="dx223:String">OTD</dx223:nationalIdentifier>
+                </dx223:publicationCreator>
+"""
+HEADER_INFORMATION = """                <dx223:headerInformation xsi:type="dx223:HeaderInformation">
+                    <dx223:confidentiality xsi:type="dx223:ConfidentialityValueEnum">noRestriction</dx223:confidentiality>
+                    <dx223:informationStatus xsi:type="dx223:InformationStatusEnum">real</dx223:informationStatus>
+                </dx223:headerInformation>
+"""
+DOCUMENT_FOOTER = """             </dx223:payloadPublication>
+        </dx223:d2LogicalModel>
+    </SOAP-ENV:Body>
+</SOAP-ENV:Envelope>
+"""
+
+MEASUREMENT_SITE_RECORD = """                    <dx223:measurementSiteRecord xsi:type="dx223:MeasurementSiteRecord" id="%id%" version="1">
+                        <dx223:measurementSiteNumberOfLanes xsi:type="dx223:NonNegativeInteger">1</dx223:measurementSiteNumberOfLanes>
+%characteristics%                        <dx223:measurementSiteLocation xsi:type="dx223:Point">
+                            <dx223:supplementaryPositionalDescription xsi:type="dx223:SupplementaryPositionalDescription">
+                                <dx223:affectedCarriagewayAndLanes xsi:type="dx223:AffectedCarriagewayAndLanes">
+                                    <dx223:carriageway xsi:type="dx223:CarriagewayEnum">mainCarriageway</dx223:carriageway>
+                                    <dx223:lane xsi:type="dx223:LaneEnum">lane1</dx223:lane>
+                                </dx223:affectedCarriagewayAndLanes>
+                            </dx223:supplementaryPositionalDescription>
+                            <dx223:alertCPoint xsi:type="dx223:AlertCMethod4Point">
+                                <dx223:alertCLocationCountryCode xsi:type="dx223:String">CH</dx223:alertCLocationCountryCode>
+                                <dx223:alertCLocationTableNumber xsi:type="dx223:String">9</dx223:alertCLocationTableNumber>
+                                <dx223:alertCLocationTableVersion xsi:type="dx223:String">7.2</dx223:alertCLocationTableVersion>
+%direction%                                <dx223:alertCMethod4PrimaryPointLocation xsi:type="dx223:AlertCMethod4PrimaryPointLocation">
+%location%                                    <dx223:offsetDistance xsi:type="dx223:OffsetDistance">
+                                        <dx223:offsetDistance xsi:type="dx223:MetresAsNonNegativeInteger">0</dx223:offsetDistance>
+                                    </dx223:offsetDistance>
+                                </dx223:alertCMethod4PrimaryPointLocation>
+                            </dx223:alertCPoint>
+                            <dx223:pointByCoordinates xsi:type="dx223:PointByCoordinates">
+                                <dx223:pointCoordinates xsi:type="dx223:PointCoordinates">
+                                    <dx223:latitude xsi:type="dx223:Float">%latitude%</dx223:latitude>
+                                    <dx223:longitude xsi:type="dx223:Float">%longitude%</dx223:longitude>
+                                </dx223:pointCoordinates>
+                            </dx223:pointByCoordinates>
+                        </dx223:measurementSiteLocation>
+                    </dx223:measurementSiteRecord>
+"""
+CHARACTERISTIC = """                        <dx223:measurementSpecificCharacteristics xsi:type="dx223:_MeasurementSiteRecordIndexMeasurementSpecificCharacteristics" index="%index%">
+                            <dx223:measurementSpecificCharacteristics xsi:type="dx223:MeasurementSpecificCharacteristics">
+                                <dx223:period xsi:type="dx223:Seconds">%period%</dx223:period>
+                                <dx223:specificMeasurementValueType xsi:type="dx223:MeasuredOrDerivedDataTypeEnum">%measurement%</dx223:specificMeasurementValueType>
+                                <dx223:specificVehicleCharacteristics xsi:type="dx223:VehicleCharacteristics">
+                                    <dx223:vehicleType xsi:type="dx223:VehicleTypeEnum">%vehicle_type%</dx223:vehicleType>
+                                </dx223:specificVehicleCharacteristics>
+                            </dx223:measurementSpecificCharacteristics>
+                        </dx223:measurementSpecificCharacteristics>
+"""
+DIRECTION = """                                <dx223:alertCDirection xsi:type="dx223:AlertCDirection">
+                                    <dx223:alertCDirectionCoded xsi:type="dx223:AlertCDirectionEnum">%direction%</dx223:alertCDirectionCoded>
+                                </dx223:alertCDirection>
+"""
+LOCATION = """                                    <dx223:alertCLocation xsi:type="dx223:AlertCLocation">
+                                        <dx223:specificLocation xsi:type="dx223:AlertCLocationCode">%location_id%</dx223:specificLocation>
+                                    </dx223:alertCLocation>
+"""
+
+SITE_MEASUREMENTS = """                <dx223:siteMeasurements xsi:type="dx223:SiteMeasurements">
+                    <dx223:measurementSiteReference xsi:type="dx223:_MeasurementSiteRecordVersionedReference" targetClass="MeasurementSiteRecord" id="%id%" version="1"></dx223:measurementSiteReference>
+                    <dx223:measurementTimeDefault xsi:type="dx223:DateTime">%time%</dx223:measurementTimeDefault>
+%measured_values%                </dx223:siteMeasurements>
+"""
+MEASURED_VALUE = """                    <dx223:measuredValue xsi:type="dx223:_SiteMeasurementsIndexMeasuredValue" index="%index%">
+                        <dx223:measuredValue xsi:type="dx223:MeasuredValue">
+%basic_data%                        </dx223:measuredValue>
+                    </dx223:measuredValue>
+"""
+TRAFFIC_FLOW = """                            <dx223:basicData xsi:type="dx223:TrafficFlow">
+                                <dx223:vehicleFlow xsi:type="dx223:VehicleFlowValue">
+%data_error%                                    <dx223:vehicleFlowRate xsi:type="dx223:VehiclesPerHour">%value%</dx223:vehicleFlowRate>
+                                </dx223:vehicleFlow>
+                            </dx223:basicData>
+"""
+TRAFFIC_SPEED = """                            <dx223:basicData xsi:type="dx223:TrafficSpeed">
+                                <dx223:averageVehicleSpeed xsi:type="dx223:SpeedValue" numberOfInputValuesUsed="%number_of_input_values_used%">
+%data_error%                                    <dx223:speed xsi:type="dx223:KilometresPerHour">%value%</dx223:speed>
+                                </dx223:averageVehicleSpeed>
+                            </dx223:basicData>
+"""
+DATA_ERROR = """                                    <dx223:dataError xsi:type="dx223:Boolean">true</dx223:dataError>
+                                    <dx223:reasonForDataError xsi:type="dx223:MultilingualString">
+                                        <dx223:values>
+                                            <dx223:value xsi:type="dx223:MultilingualStringValue" lang="en">%error_reason%</dx223:value>
+                                        </dx223:values>
+                                    </dx223:reasonForDataError>
+"""
+
+def ensure_file(file_path):
+    if not os.path.isfile(file_path):
+        sys.exit(f"Expected file '{file_path}' but was not found...")
+
+def load_mst(file_path=MST_FILE_PATH):
+    ensure_file(file_path)
+    with open(file_path, "r") as f:
+        return json.load(f)
+
+def create_characteristics(template_characteristics, number_of_indices):
+    # The real characteristics cut or extended by made up vehicle classes
+    if number_of_indices is None:
+        return [dict(characteristic) for characteristic in template_characteristics]
+    characteristics = [dict(characteristic) for characteristic in template_characteristics[:number_of_indices]]
+    used_indices = set([characteristic["index"] for characteristic in characteristics])
+    number = 0
+    while len(characteristics) < number_of_indices:
+        index = 10 * (FIRST_SYNTHETIC_VEHICLE_CLASS + number // 2) + number % 2 + 1
+        measurement = SYNTHETIC_MEASUREMENTS[number % 2]
+        number += 1
+        if index in used_indices:
+            continue
+        characteristics.append({"period": 60, "measurement": measurement, "vehicleType": "anyVehicle", "index": index})
+    return characteristics
+
+def create_topology(mst, number_of_stations=None, detectors_per_station=None, indices_per_detector=None):
+    # Stations in the format of mst.json. The real stations come first, every further station is a copy
+    # of a real one (same canton, location and detectors) under a new number. A value of None keeps
+    # the real number of stations, detectors or indices.
+    number_of_stations = len(mst) if number_of_stations is None else number_of_stations
+    next_number_id = max([station["numberId"] for station in mst]) + 1
+    topology = []
+    for position in range(number_of_stations):
+        template = mst[position % len(mst)]
+        is_copy = position >= len(mst)
+        number_id = next_number_id if is_copy else template["numberId"]
+        if is_copy:
+            next_number_id += 1
+        station_id = f"CH:{number_id:04d}"
+        template_detectors = template["detectors"]
+        number_of_detectors = len(template_detectors) if detectors_per_station is None else detectors_per_station
+        # Detectors keep the number of the real one (not every station starts with .01), further ones follow the last
+        template_numbers = [int(detector["id"].rsplit(".", 1)[1]) for detector in template_detectors]
+        detectors = []
+        for detector_number in range(number_of_detectors):
+            detector = dict(template_detectors[detector_number % len(template_detectors)])
+            if detector_number < len(template_numbers):
+                number = template_numbers[detector_number]
+            else:
+                number = max(template_numbers) + 1 + detector_number - len(template_numbers)
+            detector["id"] = f"{station_id}.{number:02d}"
+            detector["characteristics"] = create_characteristics(detector["characteristics"], indices_per_detector)
+            detectors.append(detector)
+        topology.append({**template, "id": station_id, "numberId": number_id, "detectors": detectors})
+    return topology
+
+def create_location_information(topology):
+    # Same content as mst_locations.csv (see preprocessing.py), needed to enrich copied stations
+    return {station["numberId"]: {
+        "name": station["name"],
+        "canton": station["canton"],
+        "eastLv95": station["eastLv95"],
+        "northLv95": station["northLv95"]
+    } for station in topology}
+
+def format_time(timestamp):
+    # Nanoseconds since epoch in the format of the feed, e.g 2023-11-27T15:36:00.000000Z
+    return datetime.fromtimestamp(timestamp / 1_000_000_000, tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def create_document(publication_type, publication_time, body):
+    header = DOCUMENT_HEADER.replace("%publication_type%", publication_type).replace("%publication_time%", format_time(publication_time))
+    return (header + body + DOCUMENT_FOOTER).encode("utf-8")
+
+def create_measurement_site_record(detector):
+    characteristics = "".join([
+        CHARACTERISTIC.replace("%index%", str(characteristic["index"])).replace("%period%", str(characteristic["period"]))
+            .replace("%measurement%", characteristic["measurement"]).replace("%vehicle_type%", characteristic["vehicleType"])
+        for characteristic in detector["characteristics"]
+    ])
+    direction = "" if detector.get("direction") is None else DIRECTION.replace("%direction%", detector["direction"])
+    location_id = detector.get("locationId", -1)
+    location = "" if location_id == -1 else LOCATION.replace("%location_id%", str(location_id))
+    return MEASUREMENT_SITE_RECORD.replace("%id%", detector["id"]).replace("%characteristics%", characteristics) \
+        .replace("%direction%", direction).replace("%location%", location) \
+        .replace("%latitude%", str(detector["latitude"])).replace("%longitude%", str(detector["longitude"]))
+
+def create_mst_xml(topology, publication_time=None):
+    publication_time = time.time_ns() if publication_time is None else publication_time
+    records = "".join([create_measurement_site_record(detector) for station in topology for detector in station["detectors"]])
+    body = HEADER_INFORMATION \
+        + """                <dx223:measurementSiteTable xsi:type="dx223:MeasurementSiteTable" id="OTD:TrafficData" version="69">\n""" \
+        + records + """                </dx223:measurementSiteTable>\n"""
+    return create_document("MeasurementSiteTablePublication", publication_time, body)
+
+def create_measured_value(characteristic, has_error, random):
+    data_error = DATA_ERROR.replace("%error_reason%", ERROR_REASON) if has_error else ""
+    if characteristic["measurement"] == "trafficSpeed":
+        value = 0 if has_error else round(random.uniform(40, 130), 1)
+        number_of_input_values_used = 0 if has_error else random.randint(1, 40)
+        basic_data = TRAFFIC_SPEED.replace("%number_of_input_values_used%", str(number_of_input_values_used))
+    else:
+        # Vehicles per hour of a one minute period
+        value = 0 if has_error else random.randint(0, 40) * 60
+        basic_data = TRAFFIC_FLOW
+    basic_data = basic_data.replace("%data_error%", data_error).replace("%value%", str(value))
+    return MEASURED_VALUE.replace("%index%", str(characteristic["index"])).replace("%basic_data%", basic_data)
+
+def create_msr_xml(topology, measurement_time, error_rate=DEFAULT_ERROR_RATE, random=None):
+    # One pull of every detector measured at measurement_time (nanoseconds since epoch), each value has
+    # an error with the given probability
+    random = Random(DEFAULT_SEED) if random is None else random
+    time_str = format_time(measurement_time)
+    site_measurements = []
+    for station in topology:
+        for detector in station["detectors"]:
+            measured_values = "".join([
+                create_measured_value(characteristic, random.random() < error_rate, random)
+                for characteristic in detector["characteristics"]
+            ])
+            site_measurements.append(SITE_MEASUREMENTS.replace("%id%", detector["id"]).replace("%time%", time_str)
+                                     .replace("%measured_values%", measured_values))
+    body = """                <dx223:measurementSiteTableReference xsi:type="dx223:_MeasurementSiteTableVersionedReference" targetClass="MeasurementSiteTable" id="OTD:TrafficData" version="69"></dx223:measurementSiteTableReference>\n""" \
+        + HEADER_INFORMATION + "".join(site_measurements)
+    return create_document("MeasuredDataPublication", measurement_time, body)
+
+def get_measurement_times(number_of_cycles, stop=None, period_seconds=60):
+    # Start of the last number_of_cycles periods before stop, oldest first
+    stop = time.time_ns() if stop is None else stop
+    period = period_seconds * 1_000_000_000
+    last = stop // period * period
+    return [last - (number_of_cycles - 1 - cycle) * period for cycle in range(number_of_cycles)]
+
+def generate(output_directory, number_of_stations, detectors_per_station, indices_per_detector, error_rate, number_of_cycles, seed):
+    mst = load_mst()
+    topology = create_topology(mst, number_of_stations, detectors_per_station, indices_per_detector)
+    os.makedirs(output_directory, exist_ok=True)
+    with open(os.path.join(output_directory, "mst.xml"), "wb") as f:
+        f.write(create_mst_xml(topology))
+    with open(os.path.join(output_directory, "mst.json"), "w") as f:
+        json.dump(topology, f, indent=4)
+    random = Random(seed)
+    number_of_values = sum([len(detector["characteristics"]) for station in topology for detector in station["detectors"]])
+    for measurement_time in get_measurement_times(number_of_cycles):
+        file_name = datetime.fromtimestamp(measurement_time / 1_000_000_000, tz=timezone.utc).strftime("msr-%Y%m%dT%H%M%S.xml.gz")
+        with open(os.path.join(output_directory, file_name), "wb") as f:
+            f.write(gzip.compress(create_msr_xml(topology, measurement_time, error_rate, random)))
+    print(f"Wrote the MST of {len(topology)} stations and {number_of_cycles} MSR files with {number_of_values} values each into '{output_directory}'...")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic MST and MSR documents from the real topology")
+    parser.add_argument("--stations", type=int, default=None, help="number of stations, defaults to the real ones")
+    parser.add_argument("--detectors", type=int, default=None, help="detectors per station, defaults to the real ones")
+    parser.add_argument("--indices", type=int, default=None, help="indices per detector, defaults to the real ones")
+    parser.add_argument("--error-rate", type=float, default=DEFAULT_ERROR_RATE, help="probability of a value having an error")
+    parser.add_argument("--cycles", type=int, default=60, help="number of MSR files, one per minute up to now")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--output", default=DEFAULT_OUTPUT_DIRECTORY)
+    arguments = parser.parse_args()
+    generate(arguments.output, arguments.stations, arguments.detectors, arguments.indices, arguments.error_rate, arguments.cycles, arguments.seed)
@@ -0,0 +1,25 @@
+import time
+from hot_window import HotWindow
+
+def create_msr(time_str, has_error=False):
+    return {"detector_measurements": [{
+        "id": "CH:0001.01",
+        "time": time_str,
+        "canton": "ZH",
+        "stationId": "CH:0001",
+        "sensorMeasurements": [{"index": "1", "value": 42.0, "hasError": has_error, "errorReason": None, "numberOfInputValuesUsed": 3}]
+    }]}
+
+def test_append_msr_without_time_uses_the_time_of_the_append():
+    hot_window = HotWindow(hours=1)
+    before = time.time_ns()
+    assert hot_window.append_msr(create_msr(None)) == 1
+    measurements = hot_window.get_measurements("CH:0001.01", 1, before - 1)
+    assert len(measurements) == 1
+    assert measurements[0]["value"] == 42.0
+    assert measurements[0]["time"].timestamp() * 1e9 >= before - 1_000_000
+
+def test_append_msr_with_time():
+    hot_window = HotWindow(hours=1)
+    assert hot_window.append_msr(create_msr("2024-01-01T00:00:00Z")) == 1
+    assert len(hot_window.get_measurements("CH:0001.01", 1, 0)) == 1
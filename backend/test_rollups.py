@@ -0,0 +1,119 @@
+import csv
+import io
+import os
+import time
+import uuid
+import pytest
+import rollups
+import storage_schema
+from hot_window import HotWindow
+from line_protocol import create_tag_sets, detector_measurements_to_lines
+from stub_influxdb_server import StubInfluxDB
+
+# The comparison of the rollups with the raw measurements needs a real InfluxDB (the stub has no tasks),
+# e.g ROLLUP_TEST_INFLUXDB_URL=http://localhost:8086 ROLLUP_TEST_INFLUXDB_TOKEN=.. ROLLUP_TEST_INFLUXDB_ORG=..
+INFLUXDB_URL = os.environ.get("ROLLUP_TEST_INFLUXDB_URL")
+INFLUXDB_TOKEN = os.environ.get("ROLLUP_TEST_INFLUXDB_TOKEN")
+INFLUXDB_ORG = os.environ.get("ROLLUP_TEST_INFLUXDB_ORG")
+
+# Same shape as query_cantons_total_number_of_errors without a canton
+RAW_CANTON_COUNT_QUERY = """
+    from(bucket: "%bucket%")
+        |> range(start: %start%, stop: %stop%)
+        %error_filter%
+        |> group(columns: ["canton"])
+        |> count()
+"""
+ROLLUP_CANTON_COUNT_QUERY = """
+    from(bucket: "%rollup_bucket%")
+        |> range(start: %start%, stop: %stop%)
+        |> filter(fn: (r) => r["_measurement"] == "%canton_error_rollup%")
+        |> filter(fn: (r) => r["binSize"] == "1m")
+        |> group(columns: ["canton"])
+        |> sum()
+"""
+
+def create_detector_measurements(time_str):
+    # Two erroneous sites of Zurich and one without a canton
+    detector_measurements = []
+    for detector_id, canton in [("CH:0001.01", "ZH"), ("CH:0002.01", "ZH"), ("CH:0003.01", None)]:
+        detector_measurements.append({
+            "id": detector_id,
+            "time": time_str,
+            "canton": canton,
+            "stationId": detector_id.split(".")[0],
+            "sensorMeasurements": [{"index": "1", "value": 0.0, "hasError": True, "errorReason": "VD_OFFLINE", "kind": None, "numberOfInputValuesUsed": 0}]
+        })
+    return detector_measurements
+
+def count_per_canton(csv_text):
+    counts = {}
+    rows = [row for row in csv.reader(io.StringIO(csv_text)) if len(row) > 0 and not row[0].startswith("#")]
+    header = rows[0]
+    for row in rows[1:]:
+        record = dict(zip(header, row))
+        counts[record["canton"]] = counts.get(record["canton"], 0) + int(record["_value"])
+    return counts
+
+@pytest.mark.parametrize("schema", storage_schema.SCHEMAS)
+def test_rollup_and_raw_queries_share_the_error_filter(schema):
+    error_filter = storage_schema.ERROR_FILTERS[schema]
+    assert storage_schema.TAGGED_FILTER in error_filter
+    rollup_flux = rollups.create_rollup_task_flux("1m", "2m", None, "bucket", "rollup_bucket", error_filter)
+    raw_segment_flux = rollups.create_segments_query([(None, 0, 60_000_000_000)], "bucket", "rollup_bucket", error_filter,
+                                                     rollups.CANTON_ERROR_ROLLUP, ["canton"], None)
+    assert error_filter in rollup_flux
+    assert error_filter in raw_segment_flux
+
+@pytest.mark.parametrize("schema", storage_schema.SCHEMAS)
+def test_errors_without_canton_are_not_counted(schema):
+    now = time.time_ns()
+    time_str = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(now // 1_000_000_000 - 60))
+    detector_measurements = create_detector_measurements(time_str)
+    stub = StubInfluxDB()
+    stub.write("\n".join(detector_measurements_to_lines(detector_measurements, create_tag_sets(schema))))
+    query = RAW_CANTON_COUNT_QUERY.replace("%bucket%", "bucket").replace("%start%", rollups.format_time(now - 3_600_000_000_000)).replace("%stop%", rollups.format_time(now)) \
+        .replace("%error_filter%", storage_schema.ERROR_FILTERS[schema])
+    assert count_per_canton(stub.query(query)) == {"ZH": 2}
+
+    hot_window = HotWindow(hours=1)
+    hot_window.append_msr({"detector_measurements": detector_measurements})
+    assert hot_window.get_number_of_errors_per_canton(now - 3_600_000_000_000) == {"ZH": 2}
+    assert hot_window.get_number_of_errors_per_station(now - 3_600_000_000_000) == {"CH:0001": 1, "CH:0002": 1}
+
+@pytest.mark.skipif(INFLUXDB_URL is None, reason="needs a real InfluxDB, see ROLLUP_TEST_INFLUXDB_URL")
+@pytest.mark.parametrize("schema", storage_schema.SCHEMAS)
+def test_rollups_equal_raw_counts(schema):
+    from influxdb_client import InfluxDBClient, WritePrecision
+    from influxdb_client.client.write_api import SYNCHRONOUS
+
+    error_filter = storage_schema.ERROR_FILTERS[schema]
+    # A whole minute a day ago, the rollups are built for whole days
+    day = 24 * 3_600_000_000_000
+    start = (time.time_ns() - day) // 60_000_000_000 * 60_000_000_000
+    stop = start + 60_000_000_000
+    time_str = f"{rollups.format_time(start + 1_000_000_000)[:19]}Z"
+    lines = detector_measurements_to_lines(create_detector_measurements(time_str), create_tag_sets(schema))
+
+    with InfluxDBClient(url=INFLUXDB_URL, token=INFLUXDB_TOKEN, org=INFLUXDB_ORG) as db_client:
+        buckets_api = db_client.buckets_api()
+        suffix = uuid.uuid4().hex[:8]
+        bucket = buckets_api.create_bucket(bucket_name=f"rollup_test_{suffix}", org=INFLUXDB_ORG)
+        rollup_bucket = buckets_api.create_bucket(bucket_name=f"rollup_test_rollups_{suffix}", org=INFLUXDB_ORG)
+        try:
+            with db_client.write_api(write_options=SYNCHRONOUS) as write_api:
+                write_api.write(bucket=bucket.name, org=INFLUXDB_ORG, record=lines, write_precision=WritePrecision.NS)
+            rollups.backfill_rollups(db_client, bucket.name, rollup_bucket.name, error_filter, start, stop)
+
+            def query_counts(query):
+                query = query.replace("%bucket%", bucket.name).replace("%rollup_bucket%", rollup_bucket.name) \
+                    .replace("%canton_error_rollup%", rollups.CANTON_ERROR_ROLLUP).replace("%error_filter%", error_filter) \
+                    .replace("%start%", rollups.format_time(start)).replace("%stop%", rollups.format_time(stop))
+                return {record["canton"]: record.get_value() for table in db_client.query_api().query(query) for record in table.records}
+
+            raw_counts = query_counts(RAW_CANTON_COUNT_QUERY)
+            assert raw_counts == {"ZH": 2}
+            assert query_counts(ROLLUP_CANTON_COUNT_QUERY) == raw_counts
+        finally:
+            buckets_api.delete_bucket(bucket)
+            buckets_api.delete_bucket(rollup_bucket)
@@ -0,0 +1,407 @@
+import os
+import struct
+import threading
+import time
+import zlib
+
+# Append only spool of line protocol on the local disk. Every ingest cycle is appended as one record,
+# a drainer replays the records into InfluxDB and deletes the segments once all of their records were
+# written. Nothing is lost while InfluxDB is slow or down, the spool simply grows until it is back.
+#
+# The spool is a directory of numbered segment files, each a sequence of records:
+#
+#   length (4 bytes) | crc32 (4 bytes) | number of lines (4 bytes) | appended at in ns (8 bytes) | payload
+#
+# The checksum covers everything after it. A record torn by a crash is cut off when the spool is
+# opened again, a corrupted record ends the replay of its segment.
+
+RECORD_HEADER = struct.Struct("<IIIQ")
+SEGMENT_FILE_EXTENSION = ".segment"
+
+def get_segment_file_name(sequence):
+    return f"{sequence:012d}{SEGMENT_FILE_EXTENSION}"
+
+def create_record(payload, number_of_lines, appended_at):
+    checked = RECORD_HEADER.pack(0, 0, number_of_lines, appended_at)[8:] + payload
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(checked), number_of_lines, appended_at) + payload
+
+def read_record(f):
+    # Returns (payload, number of lines, appended at) or None at the end of the segment or a corrupted record
+    header = f.read(RECORD_HEADER.size)
+    if len(header) < RECORD_HEADER.size:
+        return None
+    length, crc, number_of_lines, appended_at = RECORD_HEADER.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length or zlib.crc32(header[8:] + payload) != crc:
+        return None
+    return payload, number_of_lines, appended_at
+
+class SpoolBatch:
+    def __init__(self, payloads, number_of_lines, position, consumed_sequences, oldest_appended_at=None, newest_appended_at=None):
+        self.payloads = payloads
+        self.number_of_lines = number_of_lines
+        self.number_of_bytes = sum([len(payload) for payload in payloads])
+        # Append times in ns of the records, None for a batch without records
+        self.oldest_appended_at = oldest_appended_at
+        self.newest_appended_at = newest_appended_at
+        # Where the next batch starts once this one was acknowledged
+        self.position = position
+        # Segments which were read completely and can be deleted after the acknowledgement
+        self.consumed_sequences = consumed_sequences
+
+    def get_body(self):
+        return b"\n".join(self.payloads)
+
+class WriteSpool:
+    # append is called by the ingest, read_batch and acknowledge by a single drainer thread. When the
+    # spool grows beyond max_bytes the oldest segments are dropped.
+    def __init__(self, directory, segment_max_bytes=16 * 1024 * 1024, max_bytes=2 * 1024 * 1024 * 1024, fsync=True):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.max_bytes = max_bytes
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        # Signalled on every append so the drainer does not have to poll
+        self.appended = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        # Size of every segment, the last one is appended to
+        self.segment_sizes = {}
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(SEGMENT_FILE_EXTENSION):
+                sequence = int(file_name[:-len(SEGMENT_FILE_EXTENSION)])
+                self.segment_sizes[sequence] = os.path.getsize(os.path.join(directory, file_name))
+        if len(self.segment_sizes) == 0:
+            self.segment_sizes[0] = 0
+        self.current_sequence = max(self.segment_sizes.keys())
+        self._repair_current_segment()
+        self.current_file = open(self._get_path(self.current_sequence), "ab")
+        # Read position of the drainer, a restart replays the oldest segment from its start (InfluxDB
+        # simply overwrites points which were written before)
+        self.position = (min(self.segment_sizes.keys()), 0)
+        self.oldest_appended_at = self._peek_appended_at()
+        self.appended_records = 0
+        self.dropped_bytes = 0
+        self.corrupted_segments = 0
+        if self.get_size() > 0:
+            self.appended.set()
+
+    def _get_path(self, sequence):
+        return os.path.join(self.directory, get_segment_file_name(sequence))
+
+    def _peek_appended_at(self):
+        # Append time of the record at the read position, None if everything was read
+        sequence, offset = self.position
+        while sequence in self.segment_sizes:
+            if offset < self.segment_sizes[sequence]:
+                with open(self._get_path(sequence), "rb") as f:
+                    f.seek(offset)
+                    header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return None
+                return RECORD_HEADER.unpack(header)[3]
+            sequence, offset = sequence + 1, 0
+        return None
+
+    def _repair_current_segment(self):
+        # Cuts off a record which was only partially written when the process died
+        path = self._get_path(self.current_sequence)
+        valid_size = 0
+        if os.path.isfile(path):
+            with open(path, "rb") as f:
+                while read_record(f) is not None:
+                    valid_size = f.tell()
+        with open(path, "ab") as f:
+            if f.tell() != valid_size:
+                print(f"Cutting off {f.tell() - valid_size} bytes of a torn record at the end of '{path}'")
+                f.truncate(valid_size)
+        self.segment_sizes[self.current_sequence] = valid_size
+
+    def append(self, lines):
+        payload = "\n".join(lines).encode("utf-8")
+        appended_at = time.time_ns()
+        record = create_record(payload, len(lines), appended_at)
+        with self.lock:
+            if self.segment_sizes[self.current_sequence] > 0 and self.segment_sizes[self.current_sequence] + len(record) > self.segment_max_bytes:
+                self._rotate()
+            self.current_file.write(record)
+            self.current_file.flush()
+            if self.fsync:
+                os.fsync(self.current_file.fileno())
+            # Only now the drainer may read the record
+            self.segment_sizes[self.current_sequence] += len(record)
+            if self.oldest_appended_at is None:
+                self.oldest_appended_at = appended_at
+            self.appended_records += 1
+            self._drop_oldest_segments()
+        self.appended.set()
+
+    def _rotate(self):
+        self.current_file.close()
+        self.current_sequence += 1
+        self.segment_sizes[self.current_sequence] = 0
+        self.current_file = open(self._get_path(self.current_sequence), "ab")
+
+    def _drop_oldest_segments(self):
+        # Keeps the disk from filling up during a long outage, the oldest data is given up first
+        while sum(self.segment_sizes.values()) > self.max_bytes and len(self.segment_sizes) > 1:
+            sequence = min(self.segment_sizes.keys())
+            self.dropped_bytes += self.segment_sizes.pop(sequence)
+            os.remove(self._get_path(sequence))
+            if self.position[0] == sequence:
+                self.position = (min(self.segment_sizes.keys()), 0)
+                self.oldest_appended_at = self._peek_appended_at()
+            print(f"Write spool exceeded {self.max_bytes} bytes, dropped segment {sequence}")
+
+    def read_batch(self, max_bytes):
+        # Returns the records after the read position up to about max_bytes, None if there are none
+        with self.lock:
+            sequence, offset = self.position
+            segment_sizes = dict(self.segment_sizes)
+            current_sequence = self.current_sequence
+        payloads = []
+        number_of_lines = 0
+        consumed_sequences = []
+        number_of_bytes = 0
+        oldest_appended_at = None
+        newest_appended_at = None
+        while number_of_bytes < max_bytes and sequence in segment_sizes:
+            end = segment_sizes[sequence]
+            corrupted = False
+            if offset < end:
+                with open(self._get_path(sequence), "rb") as f:
+                    f.seek(offset)
+                    while offset < end and number_of_bytes < max_bytes:
+                        record = read_record(f)
+                        if record is None:
+                            corrupted = True
+                            break
+                        payload, lines, appended_at = record
+                        payloads.append(payload)
+                        number_of_lines += lines
+                        number_of_bytes += len(payload)
+                        oldest_appended_at = appended_at if oldest_appended_at is None else min(oldest_appended_at, appended_at)
+                        newest_appended_at = appended_at if newest_appended_at is None else max(newest_appended_at, appended_at)
+                        offset = f.tell()
+            if corrupted:
+                # Everything after a corrupted record is unreadable, the rest of the segment is given up
+                print(f"Skipping the rest of write spool segment {sequence} after a corrupted record at offset {offset}")
+                with self.lock:
+                    self.corrupted_segments += 1
+                offset = end
+            if offset < end or sequence == current_sequence:
+                break
+            consumed_sequences.append(sequence)
+            sequence, offset = sequence + 1, 0
+        if len(payloads) == 0 and len(consumed_sequences) == 0:
+            return None
+        return SpoolBatch(payloads, number_of_lines, (sequence, offset), consumed_sequences, oldest_appended_at, newest_appended_at)
+
+    def acknowledge(self, batch):
+        # The batch was written, its records are never read again
+        with self.lock:
+            self.position = batch.position
+            for sequence in batch.consumed_sequences:
+                if sequence in self.segment_sizes and sequence != self.current_sequence:
+                    del self.segment_sizes[sequence]
+                    os.remove(self._get_path(sequence))
+            # The segment may have been dropped while the batch was written
+            if self.position[0] not in self.segment_sizes:
+                self.position = (min(self.segment_sizes.keys()), 0)
+            # Everything was written, start a new segment so the acknowledged records are gone right away
+            # instead of with the next rotation (and are not replayed again after a restart)
+            if self.position == (self.current_sequence, self.segment_sizes[self.current_sequence]) and self.position[1] > 0:
+                sequence = self.current_sequence
+                self._rotate()
+                del self.segment_sizes[sequence]
+                os.remove(self._get_path(sequence))
+                self.position = (self.current_sequence, 0)
+            self.oldest_appended_at = self._peek_appended_at()
+
+    def get_size(self):
+        # Bytes which were not acknowledged yet
+        with self.lock:
+            sequence, offset = self.position
+            return sum([size for segment_sequence, size in self.segment_sizes.items() if segment_sequence >= sequence]) - offset
+
+    def get_lag_seconds(self):
+        # Age of the oldest record which was not acknowledged yet
+        with self.lock:
+            oldest_appended_at = self.oldest_appended_at
+        return 0.0 if oldest_appended_at is None else max(time.time_ns() - oldest_appended_at, 0) / 1e9
+
+    def close(self):
+        with self.lock:
+            self.current_file.close()
+
+    def get_stats(self):
+        pending_bytes = self.get_size()
+        lag_seconds = self.get_lag_seconds()
+        with self.lock:
+            return {
+                "directory": self.directory,
+                "segments": len(self.segment_sizes),
+                "pendingBytes": pending_bytes,
+                "diskBytes": sum(self.segment_sizes.values()),
+                "lagSeconds": lag_seconds,
+                "appendedRecords": self.appended_records,
+                "droppedBytes": self.dropped_bytes,
+                "corruptedSegments": self.corrupted_segments
+            }
+
+class SpoolDrainer:
+    # Replays the spool into InfluxDB on its own thread, in batches of up to batch_max_bytes as fast as
+    # write (a function taking the line protocol body) returns. A failed write is retried with an
+    # increasing backoff, the batch stays in the spool until it was written. Unless is_permanent tells
+    # that the error will never go away (e.g InfluxDB rejected the points), then the batch is given up.
+    #
+    # Records written more than late_after_seconds after they were appended (e.g after an outage) are
+    # reported to on_replayed with the range of their append times once the spool was drained.
+    def __init__(self, spool, write, batch_max_bytes=8 * 1024 * 1024, max_backoff_seconds=30.0, on_written=None, on_failed=None,
+                 is_permanent=None, on_rejected=None, late_after_seconds=60.0, on_replayed=None):
+        self.spool = spool
+        self.write = write
+        self.batch_max_bytes = batch_max_bytes
+        self.max_backoff_seconds = max_backoff_seconds
+        # Called with the batch and the duration after it was written or with the error if it failed
+        # or was rejected, e.g to update metrics
+        self.on_written = on_written
+        self.on_failed = on_failed
+        self.is_permanent = is_permanent
+        self.on_rejected = on_rejected
+        self.late_after_seconds = late_after_seconds
+        self.on_replayed = on_replayed
+        # Append times (oldest, newest) of the records which were written late and not reported yet
+        self.late_range = None
+        self.stopped = threading.Event()
+        self.drained = threading.Event()
+        self.thread = None
+        self.written_batches = 0
+        self.written_lines = 0
+        self.written_bytes = 0
+        self.failed_writes = 0
+        self.rejected_batches = 0
+        self.rejected_lines = 0
+        self.last_lines_per_second = None
+        self.last_error = None
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name="write-spool-drainer", daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout_seconds=10.0):
+        self.stopped.set()
+        self.spool.appended.set()
+        if self.thread is not None:
+            self.thread.join(timeout_seconds)
+            self.thread = None
+
+    def wait_until_drained(self, timeout_seconds=None):
+        # Returns False if the spool still had records after timeout_seconds
+        deadline = None if timeout_seconds is None else time.monotonic() + timeout_seconds
+        while self.spool.get_size() > 0:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                return False
+            self.drained.clear()
+            if self.spool.get_size() == 0:
+                break
+            self.drained.wait(0.1 if remaining is None else min(remaining, 0.1))
+        return True
+
+    def _write_batch(self, batch):
+        # Returns once the batch was written or the drainer was stopped
+        attempt = 0
+        while not self.stopped.is_set():
+            start = time.perf_counter()
+            try:
+                if len(batch.payloads) > 0:
+                    self.write(batch.get_body())
+            except Exception as error:
+                self.last_error = str(error)
+                if self.is_permanent is not None and self.is_permanent(error):
+                    self._reject_batch(batch, error)
+                    return
+                self.failed_writes += 1
+                if self.on_failed is not None:
+                    self.on_failed(batch, error)
+                backoff = min(2 ** attempt, self.max_backoff_seconds)
+                print(f"Failed to replay {batch.number_of_lines} spooled lines into db because {error}, retrying in {backoff} seconds...")
+                self.stopped.wait(backoff)
+                attempt += 1
+                continue
+            duration = time.perf_counter() - start
+            self.last_error = None
+            self.spool.acknowledge(batch)
+            self.written_batches += 1
+            self.written_lines += batch.number_of_lines
+            self.written_bytes += batch.number_of_bytes
+            self.last_lines_per_second = batch.number_of_lines / duration if duration > 0 else None
+            self._track_late_records(batch)
+            if self.on_written is not None:
+                self.on_written(batch, duration)
+            return
+
+    def _reject_batch(self, batch, error):
+        # Retrying would block the spool forever, the batch is logged and acknowledged instead
+        first_line = batch.payloads[0].split(b"\n", 1)[0].decode("utf-8", "replace") if len(batch.payloads) > 0 else ""
+        print(f"InfluxDB rejected {batch.number_of_lines} spooled lines because {error}, giving them up. First line: {first_line[:500]}")
+        self.spool.acknowledge(batch)
+        # A partial write keeps the valid points of the batch
+        self._track_late_records(batch)
+        self.rejected_batches += 1
+        self.rejected_lines += batch.number_of_lines
+        if self.on_rejected is not None:
+            self.on_rejected(batch, error)
+
+    def _track_late_records(self, batch):
+        if self.on_replayed is None or batch.oldest_appended_at is None:
+            return
+        if time.time_ns() - batch.oldest_appended_at <= self.late_after_seconds * 1e9:
+            return
+        if self.late_range is None:
+            self.late_range = (batch.oldest_appended_at, batch.newest_appended_at)
+        else:
+            self.late_range = (min(self.late_range[0], batch.oldest_appended_at), max(self.late_range[1], batch.newest_appended_at))
+
+    def _report_late_records(self):
+        late_range = self.late_range
+        self.late_range = None
+        self.on_replayed(*late_range)
+
+    def _run(self):
+        failures = 0
+        while not self.stopped.is_set():
+            try:
+                # Cleared before reading so an append in between is never missed
+                self.spool.appended.clear()
+                batch = self.spool.read_batch(self.batch_max_bytes)
+                if batch is None:
+                    if self.late_range is not None:
+                        self._report_late_records()
+                    self.drained.set()
+                    self.spool.appended.wait()
+                    continue
+                self._write_batch(batch)
+                failures = 0
+            except Exception as error:
+                # e.g a segment was dropped while it was read, the thread must not die
+                failures += 1
+                self.last_error = str(error)
+                backoff = min(2 ** (failures - 1), self.max_backoff_seconds)
+                print(f"Failed to drain the write spool because {error}, retrying in {backoff} seconds...")
+                self.stopped.wait(backoff)
+        self.drained.set()
+
+    def get_stats(self):
+        return {
+            **self.spool.get_stats(),
+            "writtenBatches": self.written_batches,
+            "writtenLines": self.written_lines,
+            "writtenBytes": self.written_bytes,
+            "failedWrites": self.failed_writes,
+            "rejectedBatches": self.rejected_batches,
+            "rejectedLines": self.rejected_lines,
+            "lastLinesPerSecond": self.last_lines_per_second,
+            "lastError": self.last_error
+        }
@@ -2,26 +2,31 @@ const TIME_RANGES = [
     {
         label: "Last 10 Minutes",
         value: "-10m",
+        minutes: 10,
         binSize: "1m"
     },
     {
         label: "Last Hour",
         value: "-1h",
+        minutes: 60,
         binSize: "10m"
     },
     {
         label: "Last 4 Hours",
         value: "-4h",
+        minutes: 240,
         binSize: "30m"
     },
     {
         label: "Last Day",
         value: "-24h",
+        minutes: 1440,
         binSize: "1h"
     },
     {
         label: "Last Week",
         value: "-7d",
+        minutes: 10080,
         binSize: "1d"
     }
 ];
@@ -83,6 +88,15 @@ export function getBinSizeForTimeRangeValue(timeRangeValue) {
     return TIME_RANGES[index].binSize;
 }
 
+export function getMinutesForTimeRangeValue(timeRangeValue) {
+    const index = TIME_RANGES.findIndex(t => t.value === timeRangeValue);
+    if (index < 0) {
+        console.warn(`Did not find corresponding Time Range for value ${timeRangeValue}, the shortest one will be returned`);
+        return TIME_RANGES[0].minutes;
+    }
+    return TIME_RANGES[index].minutes;
+}
+
 export const DEFAULT_FILTER_SETTINGS = {
     canton: "all",
     timeRange: FILTER_VALUE_MAP.timeRanges.default,